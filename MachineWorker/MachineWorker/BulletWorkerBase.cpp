@@ -48,7 +48,7 @@ int BulletWorkerBase::runBlocking(int numCreatures) {
 			}
 			else {
 				btVector3 position = btVector3(0.*(numCompleted%NUM_IN_FLIGHT), 0, 0);	// prevent crashing
-				CreatureBase* creature = new CreatureBase(&bullet, position, jsonObject.get_child("creature"));
+				CreatureBase* creature = new CreatureBase(&bullet, position, jsonObject.get_child("creature"), jsonObject.get<int>("genomeVersion", 1));
 				workEvaluator.add(jsonObject.get_child("task"), creature);
 				creatures.push_back(creature);
 			}
@@ -59,7 +59,7 @@ int BulletWorkerBase::runBlocking(int numCreatures) {
 		auto jsonObject = communicator->getWork();
 		if (!jsonObject.empty() && jsonObject.get<std::string>("status") == "OK") {
 		btVector3 position = btVector3(0.*(numCompleted%NUM_IN_FLIGHT), 0, 0);	// prevent crashing
-		CreatureBase* creature = new CreatureBase(&bullet, position, jsonObject.get_child("creature"));
+		CreatureBase* creature = new CreatureBase(&bullet, position, jsonObject.get_child("creature"), jsonObject.get<int>("genomeVersion", 1));
 		workEvaluator.add(jsonObject.get_child("task"), creature);
 		numToCreate--;
 		creatures.push_back(creature);
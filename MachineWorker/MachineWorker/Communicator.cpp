@@ -19,7 +19,7 @@ std::string Communicator::getSendResultSerialized(WorkEvaluator::TASK* task) {
 		
 		//printf("fitness=%f\n", moveFarTask->maxDistance);
 
-		resultSerialized = "{\"id\":\"" + task->id + "\",\"experimentId\":\"" + task->experimentId + "\",\"maxDistance\":" + std::to_string(moveFarTask->maxDistance) + ", \"simulatedTime\": " + std::to_string(WorkEvaluator::MOVE_FAR_TASK::NUMBER_OF_TICKS / 60) + "}";
+		resultSerialized = "{\"id\":\"" + task->id + "\",\"experimentId\":\"" + task->experimentId + "\",\"maxDistance\":" + std::to_string(moveFarTask->maxDistance) + ", \"simulatedTime\": " + std::to_string(moveFarTask->numberOfTicks / 60.) + "}";
 	}
 	return resultSerialized;
 }
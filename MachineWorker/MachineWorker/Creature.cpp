@@ -1,7 +1,7 @@
 #include "Creature.h"
 
-Creature::Creature(BulletInterface* bullet, UWorld* unrealWorld, UMaterial* capsuleMaterial, btVector3 position, pt::ptree jsonObject)
-	: CreatureBase::CreatureBase(bullet, position, jsonObject)
+Creature::Creature(BulletInterface* bullet, UWorld* unrealWorld, UMaterial* capsuleMaterial, btVector3 position, pt::ptree jsonObject, int genomeVersion)
+	: CreatureBase::CreatureBase(bullet, position, jsonObject, genomeVersion)
 {	
 	// Rendering:
 	unrealCreature = unrealWorld->SpawnActor<AUnrealCreature>(AUnrealCreature::StaticClass(), FVector(0,0,0), FRotator(0.f, 0.f, 0.f), FActorSpawnParameters());
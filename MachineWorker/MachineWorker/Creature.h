@@ -24,7 +24,7 @@ namespace pt = boost::property_tree;
 class MACHINEWORKER_API Creature : public CreatureBase
 {
 public:
-	Creature(BulletInterface* bullet, UWorld* unrealWorld, UMaterial* capsuleMaterial, btVector3 position, pt::ptree jsonObject);  // Physics and rendering
+	Creature(BulletInterface* bullet, UWorld* unrealWorld, UMaterial* capsuleMaterial, btVector3 position, pt::ptree jsonObject, int genomeVersion);  // Physics and rendering
 	~Creature();
 
 	void terminate();
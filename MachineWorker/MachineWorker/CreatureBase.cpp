@@ -1,6 +1,6 @@
 #include "CreatureBase.h"
 
-CreatureBase::CreatureBase(BulletInterface* bullet, btVector3 position, pt::ptree jsonObject)
+CreatureBase::CreatureBase(BulletInterface* bullet, btVector3 position, pt::ptree jsonObject, int genomeVersion)
 {
 	// Structure:
 	structure = new CreatureStructure(jsonObject.get_child("structure"));
@@ -10,7 +10,7 @@ CreatureBase::CreatureBase(BulletInterface* bullet, btVector3 position, pt::ptre
 
 	//printf("inputs=%i, outputs=%i\n", structure->getNumInputs(), structure->getNumOutputs());
 
-	motorController = new LinearMotorController(structure->getNumInputs(), structure->getNumOutputs(), jsonObject.get_child("motorController"));
+	motorController = new LinearMotorController(structure->getNumInputs(), structure->getNumOutputs(), jsonObject.get_child("motorController"), genomeVersion);
 }
 
 CreatureBase::~CreatureBase()
@@ -90,7 +90,7 @@ void ACreatureController::spawnBestCreature() {
 
 	if (!jsonObject.empty()) {
 		btVector3 position = btVector3(0, 0, 0);
-		previewCreature = new Creature(&bullet, GetWorld(), capsuleMaterial, position, jsonObject.get_child("creature"));
+		previewCreature = new Creature(&bullet, GetWorld(), capsuleMaterial, position, jsonObject.get_child("creature"), jsonObject.get<int>("genomeVersion", 1));
 
 		bestCreatureEvaluator.add(jsonObject.get_child("task"), previewCreature);
 	}
@@ -1,11 +1,12 @@
 #include "LinearMotorController.h"
 
-LinearMotorController::LinearMotorController(int numInputs, int numOutputs, pt::ptree serialized)
+LinearMotorController::LinearMotorController(int numInputs, int numOutputs, pt::ptree serialized, int genomeVersion)
 {
 	this->numInputs = numInputs;
 	this->numOutputs = numOutputs;
 
 	int layersIndex = 0;
+	int layerInputs = numInputs;
 	auto layersPtree = serialized.get_child("layers");
 	layers = std::vector<LAYER>(layersPtree.size());
 	for (pt::ptree::value_type &layer : layersPtree) {
@@ -23,6 +24,27 @@ LinearMotorController::LinearMotorController(int numInputs, int numOutputs, pt::
 			biases[biasIndex++] = bias.second.get_value<float>();
 		}
 
+		// Genome v2 has one bias per output. v1 genomes (the "genomeVersion" of the work unit is missing or 1) have one
+		// per weight, which were summed up per output anyway, so they are folded into the v2 layout.
+		int layerOutputs = weights.size() / layerInputs;
+		if (genomeVersion == 2) {
+			if ((int)biases.size() != layerOutputs)
+				throw "Malformed genome v2. There must be one bias per output.";
+		}
+		else if (genomeVersion == 1) {
+			if ((int)biases.size() != layerOutputs*layerInputs)
+				throw "Malformed genome v1. There must be one bias per weight.";
+			std::vector<float> biasesPerOutput(layerOutputs, 0.f);
+			for (int i = 0; i < layerOutputs; i++)
+				for (int j = 0; j < layerInputs; j++)
+					biasesPerOutput[i] += biases[i*layerInputs + j];
+			biases = biasesPerOutput;
+		}
+		else {
+			throw "Unknown genome version.";
+		}
+		layerInputs = layerOutputs;
+
 		LAYER layerStruct = {
 			layer.second.get<std::string>("activation"),
 			weights,
@@ -47,11 +69,11 @@ std::vector<float> LinearMotorController::multiplyMatrix(const std::vector<float
 	std::vector<float> outputVector = std::vector<float>(outputSize);
 
 
-	// Manually perform vector matrix multiplication
+	// Manually perform vector matrix multiplication, one bias per output
 	for (int i = 0; i < outputSize; i++) {
-		outputVector[i] = 0.;
+		outputVector[i] = biases[i];
 		for (int j = 0; j < inputSize; j++) {
-			outputVector[i] += inputVector[j] * matrix[i*inputSize + j] + biases[i*inputSize + j];
+			outputVector[i] += inputVector[j] * matrix[i*inputSize + j];
 		}
 	}
 
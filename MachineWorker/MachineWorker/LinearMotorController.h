@@ -17,7 +17,7 @@ namespace pt = boost::property_tree;
 class LinearMotorController : public IMotorController
 {
 public:
-	LinearMotorController(int numInputs, int numOutputs, pt::ptree serialized);
+	LinearMotorController(int numInputs, int numOutputs, pt::ptree serialized, int genomeVersion);
 	~LinearMotorController();
 
 	struct LAYER {
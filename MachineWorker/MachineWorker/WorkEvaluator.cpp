@@ -1,4 +1,5 @@
 #include "WorkEvaluator.h"
+#include <algorithm>
 
 WorkEvaluator::WorkEvaluator()
 {
@@ -28,7 +29,8 @@ void WorkEvaluator::add(pt::ptree jsonObject, CreatureBase* creatureToTrack) {
 	if (name == "MOVE_FAR") {
 		btVector3 startingPosition = creatureToTrack->getCenterOfMassPosition();
 		startingPosition.setZ(0);
-		MOVE_FAR_TASK* moveFarTask = new MOVE_FAR_TASK(taskInfo, startingPosition, 0.);
+		double duration = jsonObject.get<double>("duration", MOVE_FAR_TASK::NUMBER_OF_TICKS / 60.);	// Optional, in simulated seconds. Shorter for early evaluations when racing.
+		MOVE_FAR_TASK* moveFarTask = new MOVE_FAR_TASK(taskInfo, startingPosition, 0., std::max(1, (int)(duration * 60)));
 		delete taskInfo;
 		tasks.push_back(moveFarTask);
 	}
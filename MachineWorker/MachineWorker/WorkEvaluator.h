@@ -36,14 +36,17 @@ public:
 
 	class MOVE_FAR_TASK : public TASK {
 		public:
-			MOVE_FAR_TASK(TASK* task, btVector3 startingPosition, double maxDistance) : TASK(task->name, task->id, task->experimentId, task->creature) {
+			MOVE_FAR_TASK(TASK* task, btVector3 startingPosition, double maxDistance, int numberOfTicks = NUMBER_OF_TICKS) : TASK(task->name, task->id, task->experimentId, task->creature) {
 				this->startingPosition = startingPosition;
 				this->maxDistance = maxDistance;
+				this->numberOfTicks = numberOfTicks;
+				this->remainingTicks = numberOfTicks;
 			}
-			static const int NUMBER_OF_TICKS = 60*60*1;
+			static const int NUMBER_OF_TICKS = 60*60*1;	// 3600 = 60*60 = 60 FPS/s * 60 secs = 1 minutte. Default when the task has no "duration"
 			btVector3 startingPosition;
 			double maxDistance;
-			int remainingTicks = NUMBER_OF_TICKS;	// 3600 = 60*60 = 60 FPS/s * 60 secs = 1 minutte
+			int numberOfTicks;
+			int remainingTicks;
 	};
 
 	void add(pt::ptree jsonObject, CreatureBase* creatureToTrack);
@@ -0,0 +1,190 @@
+from Communicator import dispatch, decodeFrameHeader, encodeFrame, compressBody, decompressBody, Session, FRAME_MAGIC, FRAME_HEADER, ProtocolError
+from Metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import threading
+import asyncio
+import json
+import time
+
+# Same interface as Communicator, but all connections are served by a single asyncio event loop instead of a thread per connection.
+# Callbacks run on the event loop thread, one request at a time. Slow blocking work (saving state to disk) is handed to
+# runBlocking which offloads it to a small bounded executor so it doesn't stall the loop. Calls that find the executor
+# full are coalesced: only the latest arguments are kept and run when a task finishes, or before start() returns.
+class AsyncCommunicator():
+	def __init__(self, getWorkCallback, getWorkBatchCallback, doStepBatchCallback, registerResultCallback, getServerStatusCallback, getBestCreatureCallback, helloCallback = None, host = "127.0.0.1", port = 9999, getMetricsCallback = None, compression = None, maxBackgroundTasks = 2):
+		self.HOST = host
+		self.PORT = port
+		self.isStopped = False
+
+		self.callbacks = { "getWork": getWorkCallback, "getWorkBatch": getWorkBatchCallback, "doStepBatch": doStepBatchCallback, "registerResult": registerResultCallback, "getServerStatus" : getServerStatusCallback, "getBestCreature": getBestCreatureCallback, "hello": helloCallback, "getMetrics": getMetricsCallback }
+		self.metrics = Metrics()
+		self.compression = compression	# Offered to framed sessions, { "level", "threshold" } or None
+		self.loop = None
+		self.stopEvent = None
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.maxBackgroundTasks = maxBackgroundTasks	# Running + queued
+		self.backgroundLock = threading.RLock()	# Guards backgroundTasks and pendingBackgroundCalls, which are also changed on the executor thread
+		self.backgroundTasks = set()
+		self.pendingBackgroundCalls = {}	# function -> latest args of a call that found the executor full
+		self.connections = {}	# asyncio task serving a connection -> its stream writer
+
+	def start(self):
+		try:
+			asyncio.run(self.serve())
+		finally:
+			self.flushBackgroundTasks()		# Let a pending saveState finish before returning
+			self.executor.shutdown(wait=True)
+
+	# Waits for the background tasks and runs coalesced calls on the calling thread. Only once the loop has stopped.
+	def flushBackgroundTasks(self):
+		while True:
+			with self.backgroundLock:
+				tasks = list(self.backgroundTasks)
+				calls = []
+				if not tasks:
+					calls = list(self.pendingBackgroundCalls.items())
+					self.pendingBackgroundCalls = {}
+			if tasks:
+				concurrent.futures.wait(tasks)
+			elif calls:
+				for function, args in calls:
+					function(*args)
+			else:
+				return
+
+	def stop(self):
+		self.isStopped = True
+		if self.loop == None:
+			return
+		try:
+			isLoopThread = asyncio.get_running_loop() is self.loop
+		except RuntimeError:
+			isLoopThread = False
+		if isLoopThread:
+			self.stopEvent.set()
+		else:
+			self.loop.call_soon_threadsafe(self.stopEvent.set)
+
+	# Calls function(*args) in the background executor when called from the event loop, otherwise calls it directly.
+	# Returns a future when offloaded. If the executor already has maxBackgroundTasks tasks running or queued, the call
+	# replaces any earlier pending call of function, runs when a task finishes, and None is returned.
+	def runBlocking(self, function, *args):
+		try:
+			asyncio.get_running_loop()
+		except RuntimeError:
+			return function(*args)	# Not on the event loop, e.g. saving state after the loop has stopped
+
+		with self.backgroundLock:
+			if len(self.backgroundTasks) >= self.maxBackgroundTasks:
+				print("Background executor busy. " + function.__name__ + " runs when a task finishes.")
+				self.pendingBackgroundCalls[function] = args
+				return None
+			return self.submitBackground(function, args)
+
+	# Must be called with self.backgroundLock held
+	def submitBackground(self, function, args):
+		future = self.executor.submit(function, *args)
+		self.backgroundTasks.add(future)
+		future.add_done_callback(lambda future: self.onBackgroundDone(function, future))
+		return future
+
+	def onBackgroundDone(self, function, future):
+		if future.exception():
+			print("Background " + function.__name__ + " failed: " + str(future.exception()))
+		with self.backgroundLock:
+			self.backgroundTasks.discard(future)
+			if self.pendingBackgroundCalls:
+				pendingFunction, args = next(iter(self.pendingBackgroundCalls.items()))
+				del self.pendingBackgroundCalls[pendingFunction]
+				self.submitBackground(pendingFunction, args)
+
+	async def serve(self):
+		self.loop = asyncio.get_running_loop()
+		self.stopEvent = asyncio.Event()
+		if self.isStopped:
+			return
+
+		server = await asyncio.start_server(self.handleConnection, self.HOST, self.PORT, reuse_address=True)
+		print("Listening on " + self.HOST + ":" + str(self.PORT) + " (asyncio)")
+		async with server:
+			await self.stopEvent.wait()
+
+		# End open worker sessions so their tasks finish instead of being cancelled
+		for writer in self.connections.values():
+			writer.close()
+		await asyncio.gather(*self.connections.keys(), return_exceptions=True)
+
+	async def handleConnection(self, reader, writer):
+		task = asyncio.current_task()
+		self.connections[task] = writer
+		try:
+			firstByte = await reader.readexactly(1)
+			if firstByte == FRAME_MAGIC[:1]:
+				await self.handleFramed(reader, writer, firstByte)
+			else:
+				await self.handleLegacy(reader, writer, firstByte)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		except (ProtocolError, ValueError) as e:	# ValueError: malformed json
+			print("Closing connection: " + str(e))
+		finally:
+			writer.close()
+			del self.connections[task]
+
+	# Persistent framed session, see RequestHandler.handleFramed
+	async def handleFramed(self, reader, writer, firstByte):
+		header = firstByte + await reader.readexactly(FRAME_HEADER.size - 1)
+		session = Session(writer.get_extra_info("peername"), self.compression)
+
+		while True:
+			messageType, flags, bodyLength = decodeFrameHeader(header)
+			body = decompressBody(await reader.readexactly(bodyLength), flags, self.metrics)
+
+			data = { "type": messageType }
+			if len(body) > 0:
+				data["data"] = json.loads(body)
+
+			startTime = time.perf_counter()
+			response = dispatch(self.callbacks, messageType, data, session)
+			handlerTime = time.perf_counter() - startTime
+
+			responseBody, responseFlags = compressBody(response.encode("utf-8"), session.compression, self.metrics)
+			responseFrame = encodeFrame(messageType, responseBody, responseFlags)
+			writer.write(responseFrame)
+			await writer.drain()
+			self.metrics.record(messageType, FRAME_HEADER.size + bodyLength, len(responseFrame), handlerTime)
+
+			try:
+				header = await reader.readexactly(FRAME_HEADER.size)
+			except asyncio.IncompleteReadError:
+				return	# Worker ended the session
+
+	# One brace-counted json request per connection, see RequestHandler.handleLegacy
+	async def handleLegacy(self, reader, writer, firstByte):
+		if firstByte != b"{":
+			print("Received a packet that was not json. Ignoring....")
+			return
+
+		BLOCK_SIZE = 4096
+		blocks = [firstByte]
+		bracketCount = 1
+		while bracketCount != 0:
+			block = await reader.read(BLOCK_SIZE)
+			if not block:
+				break
+			bracketCount += block.count(b"{") - block.count(b"}")
+			blocks.append(block)
+
+		request = b"".join(blocks)
+		data = json.loads(request)
+		startTime = time.perf_counter()
+		response = dispatch(self.callbacks, data["type"], data, Session(writer.get_extra_info("peername")))
+		handlerTime = time.perf_counter() - startTime
+
+		responseBytes = b""
+		if data["type"] != "RESULT":
+			responseBytes = response.encode("utf-8")
+			writer.write(responseBytes)
+			await writer.drain()
+		self.metrics.record(data["type"], len(request), len(responseBytes), handlerTime)
@@ -1,19 +1,165 @@
 import socketserver
+import socket
+import struct
 import json
 import sys
 import time
+import zlib
 from pprint import pprint
+from Metrics import Metrics
+
+# Framed protocol: every message is a fixed size header followed by a body of exactly bodyLength bytes.
+# Header: magic (2 bytes), message type (1 byte), flags (1 byte), body length (4 bytes, network byte order).
+# The body is the utf-8 json of what legacy mode sends as "data" (requests) or the plain response (responses).
+# Legacy json messages always start with "{", so the first byte of a connection tells which mode is used.
+FRAME_MAGIC = b"ME"
+FRAME_HEADER = struct.Struct("!2sBBI")
+MAX_FRAME_BODY_SIZE = 256*1024*1024
+
+# Frame flags
+FRAME_FLAG_COMPRESSED = 1	# Body is zlib compressed. Only sent on sessions that negotiated compression in HELLO.
+
+# Message type ids used in the framed header. Same order as Communicator::TYPE in MachineWorker.
+# HELLO only exists in framed mode: it negotiates session capabilities like the genome cache.
+# GET_METRICS is for monitoring tools, workers don't use it.
+MESSAGE_TYPES = ["PING", "GET_WORK", "GET_WORK_BATCH", "RESULT", "GET_SERVER_STATUS", "GET_BEST_CREATURE", "STEP_BATCH", "HELLO", "GET_METRICS"]
+MESSAGE_TYPE_IDS = { name: i for i, name in enumerate(MESSAGE_TYPES) }
+
+class ProtocolError(Exception):
+	pass
+
+# Returns the bytes of a complete frame (header + body) for messageType (name or id)
+def encodeFrame(messageType, body, flags = 0):
+	if isinstance(messageType, str):
+		messageType = MESSAGE_TYPE_IDS[messageType]
+	if isinstance(body, str):
+		body = body.encode("utf-8")
+	return FRAME_HEADER.pack(FRAME_MAGIC, messageType, flags, len(body)) + body
+
+# Returns (messageTypeName, flags, bodyLength) from the FRAME_HEADER.size bytes of a header
+def decodeFrameHeader(header):
+	magic, messageType, flags, bodyLength = FRAME_HEADER.unpack(header)
+	if magic != FRAME_MAGIC:
+		raise ProtocolError("Bad frame magic " + str(magic))
+	if messageType >= len(MESSAGE_TYPES):
+		raise ProtocolError("Unknown message type id " + str(messageType))
+	if bodyLength > MAX_FRAME_BODY_SIZE:
+		raise ProtocolError("Frame body of " + str(bodyLength) + " bytes exceeds max size")
+	return (MESSAGE_TYPES[messageType], flags, bodyLength)
+
+# Fills all of buffer (bytearray or memoryview) from sock. Returns False if the connection closed before the buffer was full.
+def receiveInto(sock, buffer):
+	view = memoryview(buffer)
+	received = 0
+	while received < len(view):
+		numBytes = sock.recv_into(view[received:])
+		if numBytes == 0:
+			return False
+		received += numBytes
+	return True
+
+# Reads one frame from sock. The body is read with a single buffer preallocated from the length in the header.
+# Returns (messageTypeName, flags, body) or None if the connection was closed.
+def receiveFrame(sock, headerBuffer = None):
+	if headerBuffer is None:
+		headerBuffer = bytearray(FRAME_HEADER.size)
+	if not receiveInto(sock, headerBuffer):
+		return None
+
+	messageType, flags, bodyLength = decodeFrameHeader(headerBuffer)
+	body = bytearray(bodyLength)
+	if not receiveInto(sock, body):
+		raise ProtocolError("Connection closed in the middle of a " + messageType + " frame")
+
+	return (messageType, flags, body)
+
+def sendFrame(sock, messageType, body, flags = 0):
+	sock.sendall(encodeFrame(messageType, body, flags))
+
+# Compresses body (bytes) when compression settings ({ "level", "threshold" }) are given and body has at least threshold bytes.
+# Returns (body, frame flags). Compression ratio and CPU time are recorded in metrics, if given.
+def compressBody(body, compression, metrics = None):
+	if compression == None or len(body) < compression["threshold"]:
+		return (body, 0)
+
+	startTime = time.thread_time()
+	compressed = zlib.compress(body, compression["level"])
+	if metrics:
+		metrics.recordCompression("compressed", len(body), len(compressed), time.thread_time() - startTime)
+	return (compressed, FRAME_FLAG_COMPRESSED)
+
+# Returns the plain body of a received frame
+def decompressBody(body, flags, metrics = None):
+	if not flags & FRAME_FLAG_COMPRESSED:
+		return body
+
+	startTime = time.thread_time()
+	decompressor = zlib.decompressobj()
+	try:
+		decompressed = decompressor.decompress(body, MAX_FRAME_BODY_SIZE)
+	except zlib.error as e:
+		raise ProtocolError("Bad compressed frame body: " + str(e))
+	if decompressor.unconsumed_tail or not decompressor.eof:
+		raise ProtocolError("Compressed frame body is truncated or exceeds max size")
+	if metrics:
+		metrics.recordCompression("decompressed", len(decompressed), len(body), time.thread_time() - startTime)
+	return decompressed
+
+# State of one connection. Framed connections are persistent sessions, a legacy connection only carries a single request.
+class Session():
+	def __init__(self, clientAddress, compressionOffer = None):
+		self.clientAddress = clientAddress
+		self.genomeCache = None		# Trainer side mirror of the worker's GenomeCache, if the worker has one
+		self.compressionOffer = compressionOffer	# Compression settings the server accepts, None if disabled
+		self.compression = None		# Compression settings in use, once negotiated
+
+# Enables compression for a session if the HELLO request asks for it and the server offers it.
+# Returns the compression part of the HELLO response. Both sides then compress bodies of at least threshold bytes.
+def helloCompression(data, session):
+	if not "compression" in data or session.compressionOffer == None or not "zlib" in data["compression"].get("algorithms", []):
+		return {}
+	session.compression = session.compressionOffer
+	return { "compression": { "algorithm": "zlib", "level": session.compression["level"], "threshold": session.compression["threshold"] } }
+
+# Runs the callback for messageType and returns the serialized response
+def dispatch(callbacks, messageType, data, session = None):
+	if messageType == "PING":
+		data["response"] = "PING"
+		response = json.dumps(data);
+	elif messageType == "GET_WORK":
+		response = callbacks["getWork"](session=session)
+	elif messageType == "GET_WORK_BATCH":
+		response = callbacks["getWorkBatch"](data["data"], session)
+	elif messageType == "STEP_BATCH":
+		response = callbacks["doStepBatch"](data["data"], session)
+	elif messageType == "GET_BEST_CREATURE":
+		response = callbacks["getBestCreature"](session)
+	elif messageType == "GET_SERVER_STATUS":
+		response = callbacks["getServerStatus"]()
+	elif messageType == "RESULT":
+		response = callbacks["registerResult"](data["data"])
+	elif messageType == "HELLO" and session and callbacks["hello"]:
+		response = callbacks["hello"](data.get("data", {}), session)
+	elif messageType == "GET_METRICS" and callbacks["getMetrics"]:
+		response = callbacks["getMetrics"]()
+	else:
+		raise ProtocolError("Unsupported message type " + str(messageType))
+
+	return response
 
 # Handles all communication with clients, serving workloads, getting results.
 class Communicator():
-	def __init__(self, getWorkCallback, getWorkBatchCallback, doStepBatchCallback, registerResultCallback, getServerStatusCallback, getBestCreatureCallback):
-		self.HOST = "127.0.0.1"
-		self.PORT = 9999
+	def __init__(self, getWorkCallback, getWorkBatchCallback, doStepBatchCallback, registerResultCallback, getServerStatusCallback, getBestCreatureCallback, helloCallback = None, host = "127.0.0.1", port = 9999, getMetricsCallback = None, compression = None):
+		self.HOST = host
+		self.PORT = port
 		self.isStopped = False
-		
-		self.server = socketserver.ThreadingTCPServer((self.HOST, self.PORT), RequestHandler)
+		self.metrics = Metrics()
+
+		self.server = ThreadingTCPServer((self.HOST, self.PORT), RequestHandler)
 		#self.server = socketserver.TCPServer((self.HOST, self.PORT), RequestHandler)
-		self.server.callbacks = { "getWork": getWorkCallback, "getWorkBatch": getWorkBatchCallback, "doStepBatch": doStepBatchCallback, "registerResult": registerResultCallback, "getServerStatus" : getServerStatusCallback, "getBestCreature": getBestCreatureCallback }
+		self.server.callbacks = { "getWork": getWorkCallback, "getWorkBatch": getWorkBatchCallback, "doStepBatch": doStepBatchCallback, "registerResult": registerResultCallback, "getServerStatus" : getServerStatusCallback, "getBestCreature": getBestCreatureCallback, "hello": helloCallback, "getMetrics": getMetricsCallback }
+		self.server.metrics = self.metrics
+		self.server.compression = compression	# Offered to framed sessions, { "level", "threshold" } or None
 
 	def start(self):
 		print("Listening on " + self.HOST + ":" + str(self.PORT))
@@ -23,8 +169,59 @@ class Communicator():
 		self.isStopped = True
 		self.server.shutdown()
 
+	# Handler threads may block, so blocking work simply runs on the calling thread
+	def runBlocking(self, function, *args):
+		return function(*args)
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True	# Persistent worker sessions must not keep the process alive after stop()
+
 class RequestHandler(socketserver.BaseRequestHandler):
 	def handle(self):
+		# Detect protocol mode from the first byte without consuming it
+		firstByte = self.request.recv(1, socket.MSG_PEEK)
+		if not firstByte:
+			return
+
+		if firstByte == FRAME_MAGIC[:1]:
+			self.handleFramed()
+		else:
+			self.handleLegacy()
+
+	# A framed connection is a persistent session: requests are served in the order they arrive until the worker disconnects.
+	# Workers may pipeline several requests without waiting, responses are sent back in the same order.
+	def handleFramed(self):
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		headerBuffer = bytearray(FRAME_HEADER.size)
+		session = Session(self.client_address, self.server.compression)
+
+		while True:
+			try:
+				frame = receiveFrame(self.request, headerBuffer)
+				if frame == None:
+					return
+				messageType, flags, body = frame
+				bodyLength = len(body)
+				body = decompressBody(body, flags, self.server.metrics)
+				data = { "type": messageType }
+				if len(body) > 0:
+					data["data"] = json.loads(body)
+
+				startTime = time.perf_counter()
+				response = dispatch(self.server.callbacks, messageType, data, session)
+				handlerTime = time.perf_counter() - startTime
+			except (ProtocolError, ConnectionError, ValueError) as e:	# ValueError: malformed json
+				print("Closing session with " + self.client_address[0] + ": " + str(e))
+				return
+
+			# Unlike legacy mode every framed request gets a response, RESULT included
+			responseBody, responseFlags = compressBody(response.encode("utf-8"), session.compression, self.server.metrics)
+			responseFrame = encodeFrame(messageType, responseBody, responseFlags)
+			self.request.sendall(responseFrame)
+			self.server.metrics.record(messageType, FRAME_HEADER.size + bodyLength, len(responseFrame), handlerTime)
+
+	def handleLegacy(self):
 		def receiveJson():
 			BLOCK_SIZE = 4096
 			allBlocks = ""
@@ -46,9 +243,9 @@ class RequestHandler(socketserver.BaseRequestHandler):
 						jsonEnded = True
 					allBlocks += block
 					isFirstBlock = False
-			
+
 			return allBlocks
-		
+
 		# receive request:
 		self.data = receiveJson()
 
@@ -59,27 +256,18 @@ class RequestHandler(socketserver.BaseRequestHandler):
 		data = json.loads(self.data)
 		#print("Communicator data type=" + data["type"])
 
-		if data["type"] == "PING":
-			data["response"] = "PING"
-			response = json.dumps(data);
-		elif data["type"] == "GET_WORK":
-			response = self.server.callbacks["getWork"]()
-		elif data["type"] == "GET_WORK_BATCH":
-			response = self.server.callbacks["getWorkBatch"](data["data"])
-		elif data["type"] == "STEP_BATCH":
-			response = self.server.callbacks["doStepBatch"](data["data"])
-		elif data["type"] == "GET_BEST_CREATURE":
-			response = self.server.callbacks["getBestCreature"]()
-		elif data["type"] == "GET_SERVER_STATUS":
-			response = self.server.callbacks["getServerStatus"]()
-		elif data["type"] == "RESULT":
-			response = self.server.callbacks["registerResult"](data["data"])
-		
+		startTime = time.perf_counter()
+		response = dispatch(self.server.callbacks, data["type"], data, Session(self.client_address))
+		handlerTime = time.perf_counter() - startTime
+
 		#pprint(response)
 
 		# send response:
 		#print("--> {}: sent {} bytes (of {}) to {}: {}".format(data["type"], len(response), str(self.PACKET_SIZE), self.client_address[0], response))
 		#print("--> {}: sent {} bytes (of {}) to {}".format(data["type"], len(response), str(self.PACKET_SIZE), self.client_address[0]))
 
+		responseBytes = b""
 		if data["type"] != "RESULT":
-			self.request.sendall(response.encode("utf-8"))
\ No newline at end of file
+			responseBytes = response.encode("utf-8")
+			self.request.sendall(responseBytes)
+		self.server.metrics.record(data["type"], len(self.data.encode("utf-8")), len(responseBytes), handlerTime)
\ No newline at end of file
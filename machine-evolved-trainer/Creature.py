@@ -1,12 +1,24 @@
 from CreatureStructure import CreatureStructure, CAPSULE
 from LinearMotorController import LinearMotorController
+from Genome import encodeGenome, getGenomeHash, GENOME_VERSION
 
 from math import sqrt
 import random
 import json
+import threading
+import copy
 import uuid
 
+# Children from mutate and crossover get their id and generator type right away but the change of their parameters is
+# only recorded. A child shares the motor controller of its parent until materialize, which runs the first time the
+# child is sent or serialized, copies the parameters and applies the change. So offspring are built as workers ask for
+# them instead of all at once when a generation rolls over.
+#
+# Each creature has its own materializeLock, so children are materialized in parallel. A child waits for the locks of
+# its parent and crossover partner, which are older creatures, so the waits can't form a cycle.
 class Creature():
+	genomeVersion = GENOME_VERSION	# LinearMotorController always has the current bias layout, loaded creatures are folded
+
 	# structureJson: Object hierarchy of actuall structure (capsules etc) if it exists from before
 	# generatorJson: Configuration for generator
 	def __init__(self, structureJson = None, generatorJson = None):
@@ -24,6 +36,24 @@ class Creature():
 
 		self.id = str(uuid.uuid4())
 		self.nextFitnessLog = ""
+		self.genome = None	# Cached (hash, encoded genome), cleared whenever the creature changes
+		self.delta = None	# (parent genome hash, changed weight indices) for offspring of an encoded parent
+		self.evaluationDuration = None	# Simulated seconds to evaluate for, None for the worker default (full length)
+		self.pendingChange = None	# ("mutate" or "crossover", config, partner creature or None) not yet applied
+		self.parentGenome = None	# Cached genome of the parent while a change is pending, for the delta
+		self.source = None			# Creature whose motor controller is shared until materialize copies it
+		self.materializeLock = threading.Lock()	# Held while materializing, so a child is never seen half changed
+
+	# Locks can't be pickled, e.g. when islands send creatures to the trainer process
+	def __getstate__(self):
+		self.materialize()
+		state = dict(self.__dict__)
+		del state["materializeLock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.materializeLock = threading.Lock()
 
 	# Picks a random number in a rangeStr (which is on format "FROM-TO")
 	@staticmethod
@@ -32,11 +62,19 @@ class Creature():
 		return random.uniform(float(rangeNumeric[0]), float(rangeNumeric[1]))
 
 	def getJson(self):
+		self.materialize()
 		return { "structure": self.structure.getJson(), "motorController": self.motorController.getJson() }
 
 	def serialize(self):
 		return json.dumps(self.getJson())
 
+	# Returns (genomeHash, genome) of the binary genome encoding
+	def getGenome(self):
+		if self.genome == None:
+			genome = encodeGenome(self.getJson())
+			self.genome = (getGenomeHash(genome), genome)
+		return self.genome
+
 	def createStructure(self):
 		def normalize(v, tolerance=0.00001):
 			mag2 = sum(n * n for n in v)
@@ -70,21 +108,61 @@ class Creature():
 			"")
 		structure.addCapsule(capsule)
 
+		innerHeights = []
+		radii = []
 		for i in range(0, int(self.generatorJson["numCapsules"])-1):
-			capsule = structure.addCapsuleWithConstraint(
-				Creature.pickRandomNumberFromRange(self.generatorJson["capsuleInnerHeightRange"]),
-				Creature.pickRandomNumberFromRange(self.generatorJson["capsuleRadiusRange"]),
-				capsule,
-				self.generatorJson["motors"])
+			innerHeights.append(Creature.pickRandomNumberFromRange(self.generatorJson["capsuleInnerHeightRange"]))
+			radii.append(Creature.pickRandomNumberFromRange(self.generatorJson["capsuleRadiusRange"]))
+		structure.addCapsuleChainWithConstraint(innerHeights, radii, capsule, self.generatorJson["motors"])
 		
 		return structure
 
+	# Copy to turn into a child with mutate or crossover. The structure is never changed after creation so it is shared.
+	# The motor controller is shared too until materialize gives the child its own parameter array.
+	def copy(self):
+		child = copy.copy(self)
+		child.source = self
+		child.materializeLock = threading.Lock()
+		return child
+
+	# Called on a copy of the parent. The parent genome is still cached if it was ever encoded, otherwise
+	# no worker can hold it and there is no point in remembering a delta.
+	def setDeltaFromParent(self, changedIndices, parentGenome):
+		self.delta = (parentGenome[0], sorted(changedIndices)) if parentGenome else None
+
 	def mutate(self, configJson):
-		self.id = str(uuid.uuid4())
-		self.motorController.mutate(configJson)
-		self.generatorType = "mutate"
+		self.prepareChange("mutate", configJson, None)
 
 	def crossover(self, creature, configJson):
+		self.prepareChange("crossover", configJson, creature)
+
+	# Called on a copy of the parent
+	def prepareChange(self, generatorType, configJson, partner):
+		self.parentGenome = self.genome
 		self.id = str(uuid.uuid4())
-		self.motorController.crossover(creature, configJson)
-		self.generatorType = "crossover"
\ No newline at end of file
+		self.genome = None
+		self.delta = None
+		self.generatorType = generatorType
+		self.pendingChange = (generatorType, configJson, partner)
+
+	# Copies the parameters shared with the source and applies the pending change from mutate or crossover, if any
+	def materialize(self):
+		if self.source == None and self.pendingChange == None:
+			return
+
+		with self.materializeLock:
+			if self.source != None:
+				self.source.materialize()
+				self.motorController = self.source.motorController.copy()
+				self.source = None
+			if self.pendingChange == None:
+				return		# Another thread got here first, or a plain copy
+			generatorType, configJson, partner = self.pendingChange
+			if generatorType == "mutate":
+				changedIndices = self.motorController.mutate(configJson)
+			else:
+				partner.materialize()
+				changedIndices = self.motorController.crossover(partner, configJson)
+			self.setDeltaFromParent(changedIndices, self.parentGenome)
+			self.parentGenome = None
+			self.pendingChange = None
\ No newline at end of file
@@ -1,36 +1,76 @@
 # This class must exactly match the CreatureStructure c++ class in MachineWorker.
 
 from collections import namedtuple
+import numpy as np
 import json
 import uuid
 from pprint import pprint
 
 CAPSULE = namedtuple("CAPSULE", "id innerHeight radius positionX positionY positionZ quaternionX quaternionY quaternionZ quaternionW constraint")
 
+CREATURE_INPUT_KEYS = ["root-orientation-x", "root-orientation-y", "root-orientation-z", "root-orientation-w", "z-position", "velocity-x", "velocity-y", "velocity-z"]
+CAPSULE_INPUT_KEYS = ["capsule-position-x", "capsule-position-y", "capsule-position-z", "capsule-velocity-x", "capsule-velocity-y", "capsule-velocity-z", "capsule-angular-velocity-x", "capsule-angular-velocity-y", "capsule-angular-velocity-z"]
+MOTOR_ANGLE_INPUT_KEYS = ["motor-angle-x", "motor-angle-y", "motor-angle-z"]
+ROTATION_KEYS = ["x-rotation", "y-rotation", "z-rotation"]
+
+# Capsules are stored column wise: ids and constraints in lists, sizes, positions and quaternions in arrays and which
+# rotations each constraint enables as a bool array. A structure isn't changed once its creature is created (children
+# share it), so the input/output layout and the json are computed on first use and kept until something changes.
+# The arrays are views of buffers that grow with doubling capacity, so adding capsules one at a time stays linear.
 class CreatureStructure:
+	COLUMNS = [("sizes", 2, np.float64), ("positions", 3, np.float64), ("quaternions", 4, np.float64), ("rotations", 3, bool)]
+
 	def __init__(self, jsonData = None):
-		self.capsules = []
+		self.ids = []
+		self.constraints = []							# Constraint config per capsule, empty for capsules without one
+		self.buffers = { name: np.empty((0, width), dtype=dtype) for name, width, dtype in self.COLUMNS }
+		self.sizes = self.buffers["sizes"]				# innerHeight, radius
+		self.positions = self.buffers["positions"]
+		self.quaternions = self.buffers["quaternions"]	# x, y, z, w like in c++
+		self.rotations = self.buffers["rotations"]		# x, y, z rotation enabled by the constraint
 		self.numFeedbacks = 0
 		self.inputs = {}
-		
+		self.layout = None
+		self.json = None
+
 		if jsonData != None:
 			self.buildFromJson(jsonData)
 
+	# Only the used rows are pickled, e.g. when islands send creatures to the trainer process
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state["buffers"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.buffers = { name: getattr(self, name) for name, width, dtype in self.COLUMNS }
+
+	# Called on every change, so the cached layout and json are computed again
+	def invalidate(self):
+		self.layout = None
+		self.json = None
+
 	def setInputs(self, inputs):
 		self.inputs = inputs
+		self.invalidate()
 
 	def setNumFeedbacks(self, num):
 		self.numFeedbacks = num
+		self.invalidate()
 
 	def setOscillatorStart(self, startRatio):
 		self.oscillatorStart = startRatio
+		self.invalidate()
 
 	def setOscillatorMultiplier(self, multiplier):
 		self.oscillatorMultiplier = multiplier
+		self.invalidate()
 
 	def setOscillatorCount(self, count):
 		self.oscillatorCount = count
-		
+		self.invalidate()
+
 	def buildFromJson(self, jsonData):
 		self.numFeedbacks = jsonData["feedbacks"]
 		self.oscillatorStart = jsonData["oscillators"]["start"]
@@ -38,117 +78,111 @@ class CreatureStructure:
 		self.oscillatorCount = jsonData["oscillators"]["count"]
 		self.inputs = jsonData["inputs"]
 
-		for item in jsonData["capsules"]:
-			capsule = CAPSULE(item["id"], item["innerHeight"], item["radius"], item["positionX"], item["positionY"], item["positionZ"], item["quaternionX"], item["quaternionY"], item["quaternionZ"], item["quaternionW"], item["constraint"])
-			self.addCapsule(capsule)
+		capsules = jsonData["capsules"]
+		self.appendCapsules([item["id"] for item in capsules], [(item["innerHeight"], item["radius"]) for item in capsules],
+			[(item["positionX"], item["positionY"], item["positionZ"]) for item in capsules],
+			[(item["quaternionX"], item["quaternionY"], item["quaternionZ"], item["quaternionW"]) for item in capsules],
+			[item["constraint"] for item in capsules])
+
+	def appendCapsules(self, ids, sizes, positions, quaternions, constraints):
+		first = len(self.ids)
+		self.ids += ids
+		self.constraints += constraints
+		count = len(self.ids)
+
+		capacity = len(self.buffers["sizes"])
+		if count > capacity:
+			capacity = max(count, 2*capacity, 4)
+			for name, width, dtype in self.COLUMNS:
+				buffer = np.empty((capacity, width), dtype=dtype)
+				buffer[:first] = self.buffers[name][:first]
+				self.buffers[name] = buffer
+
+		rotations = [[bool(constraint) and key in constraint for key in ROTATION_KEYS] for constraint in constraints]
+		for name, values in [("sizes", sizes), ("positions", positions), ("quaternions", quaternions), ("rotations", rotations)]:
+			buffer = self.buffers[name]
+			buffer[first:count] = np.asarray(values, dtype=buffer.dtype).reshape(count - first, -1)
+			setattr(self, name, buffer[:count])
+		self.invalidate()
 
 	def addCapsule(self, capsule):
-		self.capsules.append(capsule)
+		self.appendCapsules([capsule.id], [(capsule.innerHeight, capsule.radius)], [(capsule.positionX, capsule.positionY, capsule.positionZ)],
+			[(capsule.quaternionX, capsule.quaternionY, capsule.quaternionZ, capsule.quaternionW)], [capsule.constraint])
 
 	# configJson: A dictonary with configuration details for the constraint. As of 17/9 in structure/generator/motors.
 	def addCapsuleWithConstraint(self, innerHeight, radius, parentCapsule, configJson):
-		# inner functions are quaternion linear algebra helper functions to avoid importing external libraries
-		def quaternion_conjugate(q):
-			w, x, y, z = q
-			return (w, -x, -y, -z)
-
-		def quaternion_mult(q1, q2):
-			w1, x1, y1, z1 = q1
-			w2, x2, y2, z2 = q2
-			w = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
-			x = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
-			y = w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2
-			z = w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
-			return w, x, y, z
-
-		def quaternion_vector_mult(q1, v1):
-			q2 = (0.0,) + v1
-			return quaternion_mult(quaternion_mult(q1, q2), quaternion_conjugate(q1))[1:]
-
-		middlePosition = (0, 0, .5*parentCapsule.innerHeight + parentCapsule.radius + .5*innerHeight + radius)
-		parentQuaternion = (parentCapsule.quaternionW, parentCapsule.quaternionX, parentCapsule.quaternionY, parentCapsule.quaternionZ)		# Using w,x,y,z notation - not x,y,z,w like I do in c++
-		rotatedPosition = quaternion_vector_mult(parentQuaternion, middlePosition)
-		newPosition = (rotatedPosition[0] + parentCapsule.positionX, rotatedPosition[1] + parentCapsule.positionY, rotatedPosition[2] + parentCapsule.positionZ)
-
-		configWithParent = configJson.copy()
-		configWithParent["parentId"] = parentCapsule.id
-		capsule = CAPSULE(str(uuid.uuid4()), innerHeight, radius, newPosition[0], newPosition[1], newPosition[2], parentCapsule.quaternionX, parentCapsule.quaternionY, parentCapsule.quaternionZ, parentCapsule.quaternionW, configWithParent)
-		self.addCapsule(capsule)
-		return capsule
+		return self.addCapsuleChainWithConstraint([innerHeight], [radius], parentCapsule, configJson)[0]
+
+	# Adds capsules one after the other along the z axis of parentCapsule, each constrained to the one before with
+	# configJson and with the orientation of parentCapsule. Positions of the whole chain are computed at once.
+	# Returns the added capsules.
+	def addCapsuleChainWithConstraint(self, innerHeights, radii, parentCapsule, configJson):
+		halfLengths = .5*np.asarray(innerHeights, dtype=np.float64) + np.asarray(radii, dtype=np.float64)
+		offsets = .5*parentCapsule.innerHeight + parentCapsule.radius + 2*np.cumsum(halfLengths) - halfLengths		# Along z, from the middle of the parent
+
+		# z axis of the parent: q*(0,0,1)*conjugate(q)
+		x, y, z, w = parentCapsule.quaternionX, parentCapsule.quaternionY, parentCapsule.quaternionZ, parentCapsule.quaternionW
+		axis = np.array([2*(x*z + w*y), 2*(y*z - w*x), w*w - x*x - y*y + z*z])
+		positions = np.array([parentCapsule.positionX, parentCapsule.positionY, parentCapsule.positionZ]) + offsets[:, None]*axis
+
+		ids = [str(uuid.uuid4()) for i in range(0, len(offsets))]
+		constraints = []
+		for parentId in [parentCapsule.id] + ids[:-1]:
+			configWithParent = configJson.copy()
+			configWithParent["parentId"] = parentId
+			constraints.append(configWithParent)
+
+		first = len(self.ids)
+		self.appendCapsules(ids, np.stack([innerHeights, radii], axis=1), positions, np.tile([x, y, z, w], (len(ids), 1)), constraints)
+		return [self.getCapsule(i) for i in range(first, len(self.ids))]
+
+	def getCapsule(self, index):
+		return CAPSULE(self.ids[index], *self.sizes[index].tolist(), *self.positions[index].tolist(), *self.quaternions[index].tolist(), self.constraints[index])
 
 	def getCapsules(self):
-		return self.capsules
-
-	def getJson(self):
-		capsules = []
-		for capsule in self.capsules:
-			capsuleDictionary = capsule._asdict()
+		return [self.getCapsule(i) for i in range(0, len(self.ids))]
 
-			capsules.append(capsuleDictionary)
+	def getNumCapsules(self):
+		return len(self.ids)
 
-		oscillators = { "start": self.oscillatorStart, "multiplier": self.oscillatorMultiplier, "count": self.oscillatorCount }
+	# The json is shared by all callers and must not be modified
+	def getJson(self):
+		if self.json == None:
+			capsules = [capsule._asdict() for capsule in self.getCapsules()]
+			oscillators = { "start": self.oscillatorStart, "multiplier": self.oscillatorMultiplier, "count": self.oscillatorCount }
+			self.json = { "capsules": capsules, "feedbacks": self.numFeedbacks, "oscillators": oscillators, "inputs": self.inputs }
 
-		return { "capsules": capsules, "feedbacks": self.numFeedbacks, "oscillators": oscillators, "inputs": self.inputs }
+		return self.json
 
 	def serialize(self):
-		return json.dumps(getJson())
+		return json.dumps(self.getJson())
 
-	def getNumInputs(self):
-		# Per creature:
-		numPerCreature = 0
-		creatureKeys = ["root-orientation-x", "root-orientation-y", "root-orientation-z", "root-orientation-w", "z-position", "velocity-x", "velocity-y", "velocity-z"]
-		for key in creatureKeys:
-			if self.inputs[key] == 1:
-				numPerCreature += 1
-		if self.inputs["oscillators"] == 1:
-			numPerCreature += self.oscillatorCount
-
-		# Per capsule:
-		numPerCapsule = 0
-		capsuleKeys = ["capsule-position-x", "capsule-position-y", "capsule-position-z", "capsule-velocity-x", "capsule-velocity-y", "capsule-velocity-z", "capsule-angular-velocity-x", "capsule-angular-velocity-y", "capsule-angular-velocity-z"]
-		for key in capsuleKeys:
-			if self.inputs[key] == 1:
-				numPerCapsule += 1
-
-		# For motors:
-		numForMotors = 0
-		for capsule in self.capsules:
-			if capsule.constraint:
-				if "x-rotation" in capsule.constraint and self.inputs["motor-angle-x"] == 1:
-					numForMotors += 1
-				if "y-rotation" in capsule.constraint and self.inputs["motor-angle-y"] == 1:
-					numForMotors += 1
-				if "z-rotation" in capsule.constraint and self.inputs["motor-angle-z"] == 1:
-					numForMotors += 1
-
-		# For feedbacks:
-		numForFeedbacks = 0
-		if self.inputs["feedbacks"] == 1:
-			numForFeedbacks = self.numFeedbacks
-
-		return numPerCreature + len(self.capsules) * numPerCapsule + numForMotors + numForFeedbacks
+	# Number of inputs, outputs and constraints, and the motors as (capsule index, axis index) in output order:
+	# per constrained capsule its enabled x, y and z rotation
+	def getLayout(self):
+		if self.layout == None:
+			numPerCreature = sum(1 for key in CREATURE_INPUT_KEYS if self.inputs[key] == 1)
+			if self.inputs["oscillators"] == 1:
+				numPerCreature += self.oscillatorCount
 
-	def getNumOutputs(self):
-		num = 0
+			numPerCapsule = sum(1 for key in CAPSULE_INPUT_KEYS if self.inputs[key] == 1)
 
-		for capsule in self.capsules:
-			if capsule.constraint:
-				if "x-rotation" in capsule.constraint:
-					num += 1
-				if "y-rotation" in capsule.constraint:
-					num += 1
-				if "z-rotation" in capsule.constraint:
-					num += 1
+			capsuleIndices, axisIndices = np.nonzero(self.rotations)
+			motorAngles = np.array([self.inputs[key] == 1 for key in MOTOR_ANGLE_INPUT_KEYS])
+			numForMotors = int(motorAngles[axisIndices].sum())
 
-		num += self.numFeedbacks
+			numForFeedbacks = self.numFeedbacks if self.inputs["feedbacks"] == 1 else 0
 
-		return num
+			self.layout = { "numInputs": numPerCreature + len(self.ids)*numPerCapsule + numForMotors + numForFeedbacks, "numOutputs": len(capsuleIndices) + self.numFeedbacks,
+				"numConstraints": sum(1 for constraint in self.constraints if constraint), "motors": list(zip(capsuleIndices.tolist(), axisIndices.tolist())) }
 
-	def getNumConstraints(self):
-		num = 0
+		return self.layout
 
-		for capsule in self.capsules:
-			if capsule.constraint:
-				num = num + 1
+	def getNumInputs(self):
+		return self.getLayout()["numInputs"]
+
+	def getNumOutputs(self):
+		return self.getLayout()["numOutputs"]
 
-		return num
\ No newline at end of file
+	def getNumConstraints(self):
+		return self.getLayout()["numConstraints"]
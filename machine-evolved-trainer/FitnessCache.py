@@ -0,0 +1,34 @@
+from Genome import GenomeCache
+import threading
+
+# Fitness of recently evaluated genomes keyed by genome hash, least recently used evicted first.
+# Children identical to an evaluated genome (crossover or mutation that changed nothing, duplicates in a loaded
+# population) get their fitness from here instead of being simulated again. Counts lookups, so the hit rate can be shown.
+class FitnessCache():
+	def __init__(self, maxSize):
+		self.entries = GenomeCache(maxSize)
+		self.lock = threading.Lock()	# Looked up and added to outside the algorithm lock
+		self.numHits = 0
+		self.numLookups = 0
+
+	# Returns the fitness of genomeHash, or None if it isn't cached
+	def get(self, genomeHash):
+		with self.lock:
+			fitness = self.entries.get(genomeHash)
+			self.numLookups += 1
+			if fitness != None:
+				self.numHits += 1
+			return fitness
+
+	def add(self, genomeHash, fitness):
+		with self.lock:
+			self.entries.add(genomeHash, fitness)
+
+	def getJson(self):
+		with self.lock:
+			return { "size": len(self.entries), "maxSize": self.entries.maxSize, "hits": self.numHits, "lookups": self.numLookups,
+				"hitRate": self.numHits/self.numLookups if self.numLookups > 0 else 0 }
+
+	def getStatus(self):
+		cache = self.getJson()
+		return "fitness cache hits={} ({:.1f}%)".format(cache["hits"], 100*cache["hitRate"])
@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from array import array
+import hashlib
+import base64
+import struct
+import json
+import sys
+
+# Compact binary form of a creature (structure + motor controller), used instead of creature json in work units.
+#
+# Layout:
+#	GENOME_HEADER: magic, format version, number of layers, length of structure json
+#	structure json: canonical (sorted keys, no whitespace) utf-8 json of CreatureStructure.getJson()
+#	per layer LAYER_HEADER: length of activation name, number of weights, number of biases, followed by the activation name
+#	parameters: little endian float32, the weights of all layers followed by the biases of all layers
+#
+# The parameter order is the same as LinearMotorController.parameters, so parameter indices are the same in both.
+# The content hash identifies a genome independently of creature id, so re-issued and identical creatures share it.
+#
+# Versions differ in the biases of a layer: version 1 has one per weight (numInputs x numOutputs, summed per output when
+# evaluated), version 2 has one per output. Work units carry the version in "genomeVersion", also when they carry
+# creature json, so workers know which layout they get. Version 1 genomes still decode.
+GENOME_ENCODING = "binary-v2"
+GENOME_MAGIC = b"MEGN"
+GENOME_VERSION = 2
+GENOME_VERSIONS = [1, 2]
+GENOME_HEADER = struct.Struct("<4sBHI")
+LAYER_HEADER = struct.Struct("<BII")
+
+def getGenomeHash(genome):
+	return hashlib.blake2b(genome, digest_size=16).hexdigest()
+
+def float32Bytes(values):
+	parameters = array("f", values)
+	if sys.byteorder == "big":
+		parameters.byteswap()
+	return parameters.tobytes()
+
+# creatureJson: { "structure": ..., "motorController": ... } as returned by Creature.getJson()
+# version: bias layout of the motor controller in creatureJson
+def encodeGenome(creatureJson, version = GENOME_VERSION):
+	structure = json.dumps(creatureJson["structure"], sort_keys=True, separators=(",", ":")).encode("utf-8")
+	layers = creatureJson["motorController"]["layers"]
+
+	parts = [GENOME_HEADER.pack(GENOME_MAGIC, version, len(layers), len(structure)), structure]
+	for layer in layers:
+		activation = layer["activation"].encode("utf-8")
+		parts.append(LAYER_HEADER.pack(len(activation), len(layer["weights"]), len(layer["biases"])))
+		parts.append(activation)
+
+	parameters = []
+	for layer in layers:
+		parameters.extend(layer["weights"])
+	for layer in layers:
+		parameters.extend(layer["biases"])
+	parts.append(float32Bytes(parameters))
+
+	return b"".join(parts)
+
+# Returns the creature json ({ "structure": ..., "motorController": ... }) of an encoded genome
+def decodeGenome(genome):
+	magic, version, numLayers, structureLength = GENOME_HEADER.unpack_from(genome, 0)
+	if magic != GENOME_MAGIC or not version in GENOME_VERSIONS:
+		raise ValueError("Not a version " + " or ".join(str(v) for v in GENOME_VERSIONS) + " genome")
+	offset = GENOME_HEADER.size
+
+	structure = json.loads(bytes(genome[offset:offset+structureLength]))
+	offset += structureLength
+
+	layers = []
+	for i in range(0, numLayers):
+		activationLength, numWeights, numBiases = LAYER_HEADER.unpack_from(genome, offset)
+		offset += LAYER_HEADER.size
+		activation = bytes(genome[offset:offset+activationLength]).decode("utf-8")
+		offset += activationLength
+		layers.append({ "activation": activation, "numWeights": numWeights, "numBiases": numBiases })
+
+	parameters = array("f")
+	parameters.frombytes(bytes(genome[offset:]))
+	if sys.byteorder == "big":
+		parameters.byteswap()
+	parameters = parameters.tolist()
+
+	index = 0
+	for key, sizeKey in (("weights", "numWeights"), ("biases", "numBiases")):
+		for layer in layers:
+			layer[key] = parameters[index:index+layer[sizeKey]]
+			index += layer[sizeKey]
+	for layer in layers:
+		del layer["numWeights"]
+		del layer["numBiases"]
+
+	return { "structure": structure, "motorController": { "name": "LinearMotorController", "layers": layers } }
+
+# Returns the byte offset of the float32 parameters in genome
+def getParametersOffset(genome):
+	magic, version, numLayers, structureLength = GENOME_HEADER.unpack_from(genome, 0)
+	offset = GENOME_HEADER.size + structureLength
+	for i in range(0, numLayers):
+		activationLength, numWeights, numBiases = LAYER_HEADER.unpack_from(genome, offset)
+		offset += LAYER_HEADER.size + activationLength
+	return offset
+
+# Offspring only differ from their parent in a few parameters. A delta references the parent genome by hash and
+# carries the changed parameter indices (uint32) and their new float32 values, base64 encoded.
+def encodeGenomeDelta(parentHash, genome, changedIndices):
+	offset = getParametersOffset(genome)
+	indices = array("I", changedIndices)
+	values = [struct.unpack_from("<f", genome, offset + 4*i)[0] for i in changedIndices]
+	if sys.byteorder == "big":
+		indices.byteswap()
+	return { "parent": parentHash, "indices": encodeGenomeText(indices.tobytes()), "values": encodeGenomeText(float32Bytes(values)) }
+
+# Returns the genome created by applying genomeDelta (from encodeGenomeDelta) to parentGenome
+def applyGenomeDelta(parentGenome, genomeDelta):
+	indices = array("I")
+	indices.frombytes(decodeGenomeText(genomeDelta["indices"]))
+	values = array("f")
+	values.frombytes(decodeGenomeText(genomeDelta["values"]))
+	if sys.byteorder == "big":
+		indices.byteswap()
+		values.byteswap()
+
+	genome = bytearray(parentGenome)
+	offset = getParametersOffset(genome)
+	for i, value in zip(indices, values):
+		struct.pack_into("<f", genome, offset + 4*i, value)
+	return bytes(genome)
+
+def encodeGenomeText(genome):
+	return base64.b64encode(genome).decode("ascii")
+
+def decodeGenomeText(text):
+	return base64.b64decode(text)
+
+# Least recently used cache of genomes keyed by genome hash.
+# Workers keep decoded genomes in it. The trainer keeps a mirror without values per worker session: both sides touch
+# the same hashes in the same order (the order of work units in responses), so the mirror knows exactly which genomes
+# the worker still holds without the worker having to report evictions.
+class GenomeCache():
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.entries = OrderedDict()
+
+	def __contains__(self, genomeHash):
+		return genomeHash in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	# Marks genomeHash as most recently used. Returns False if it isn't cached.
+	def touch(self, genomeHash):
+		if not genomeHash in self.entries:
+			return False
+		self.entries.move_to_end(genomeHash)
+		return True
+
+	def get(self, genomeHash):
+		if not self.touch(genomeHash):
+			return None
+		return self.entries[genomeHash]
+
+	def add(self, genomeHash, value = None):
+		self.entries[genomeHash] = value
+		self.entries.move_to_end(genomeHash)
+		while len(self.entries) > self.maxSize:
+			self.entries.popitem(last=False)
+
+	# Returns the value of a cached genome without marking it as used, so a mirror of the cache stays in step
+	def peek(self, genomeHash):
+		return self.entries.get(genomeHash)
+
+	# Hashes from least to most recently used
+	def getHashes(self):
+		return list(self.entries.keys())
+
+# Sets up the genome cache mirror of a session from a HELLO request. Returns the genome cache part of the HELLO response.
+def helloGenomeCache(data, session):
+	response = {}
+	if "genomeCache" in data:
+		cacheConfig = data["genomeCache"]
+		session.genomeCache = GenomeCache(int(cacheConfig["size"]))
+		for genomeHash in cacheConfig.get("hashes", []):
+			session.genomeCache.add(genomeHash)
+		response["genomeCache"] = { "size": session.genomeCache.maxSize, "encoding": GENOME_ENCODING }
+	return response
+
+# Sessions with a genome cache get the genome hash, plus the binary genome only if the worker doesn't hold it already.
+# Offspring of a genome the worker holds are sent as a delta to it when that is smaller.
+# Everyone else gets the full creature json.
+# creature: anything with getJson(), getGenome() returning (genome hash, genome), delta (None or (parent hash, changed indices))
+# and genomeVersion
+def addCreatureToWork(work, creature, session):
+	work["genomeVersion"] = creature.genomeVersion
+	if session == None or session.genomeCache == None:
+		work["creature"] = creature.getJson()
+		return
+
+	genomeHash, genome = creature.getGenome()
+	work["genomeHash"] = genomeHash
+	if session.genomeCache.touch(genomeHash):
+		return
+
+	# Delta: 4 bytes index + 4 bytes value per changed parameter, worth it when well below the full genome size
+	delta = creature.delta
+	if delta and 8*len(delta[1]) < len(genome)/2 and session.genomeCache.touch(delta[0]):
+		work["genomeDelta"] = encodeGenomeDelta(delta[0], genome, delta[1])
+	else:
+		work["genome"] = encodeGenomeText(genome)
+	session.genomeCache.add(genomeHash)
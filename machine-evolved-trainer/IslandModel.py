@@ -0,0 +1,285 @@
+import multiprocessing
+import traceback
+import random
+import queue
+import time
+import copy
+import uuid
+import threading
+import sys
+
+# Island model: the population is split into islands that evolve independently, each a GeneticAlgorithm (or
+# SteadyStateGeneticAlgorithm) in its own process, so dispatch and offspring generation scale with cores.
+# Every migrationInterval accepted results an island sends copies of its numMigrants best creatures, with their
+# fitness, to its neighbours. The topology decides who the neighbours are:
+#	ring: the next island
+#	fully-connected: all other islands
+#	random: one other island picked at random for every migration
+#
+# The trainer process only routes: work is taken from the islands in turn, results are sent back to the island that
+# handed out the creature. Same interface towards Trainer as GeneticAlgorithm.
+#
+# islandsConfig: { "count": 4, "algorithmType": "GeneticAlgorithm", "migrationInterval": 500, "numMigrants": 2, "topology": "ring" }
+class IslandModel():
+	TOPOLOGIES = ["ring", "fully-connected", "random"]
+	OWNER_SWEEP_INTERVAL = 60	# Seconds between checks for owners of creatures no longer in their island population
+
+	def __init__(self, populationConfig, crossoverConfig, mutationConfig, structureConfig, callbacks, islandsConfig):
+		self.populationConfig = populationConfig
+		self.callbacks = callbacks
+		self.saveStateTimestamp = time.time()
+		self.lock = threading.Lock()	# Guards owners, ownerSweepTimestamp, nextIsland and saveStateTimestamp
+		self.owners = {}				# creature id -> (island index, creature) of creatures handed out
+		self.ownerSweepTimestamp = time.time()
+		self.nextIsland = 0
+
+		numIslands = int(islandsConfig.get("count", multiprocessing.cpu_count()))
+		topology = islandsConfig.get("topology", "ring")
+		if not topology in self.TOPOLOGIES:
+			raise ValueError("Unknown island topology '" + topology + "'. Use one of " + ", ".join(self.TOPOLOGIES))
+
+		# Each island gets its share of the population and of the loaded creatures. The first islands get the remainder.
+		def getShare(total, i, minimum):
+			return max(total // numIslands + (1 if i < total % numIslands else 0), minimum)
+
+		creatures = structureConfig["creatures"] or []
+
+		inboxes = [multiprocessing.Queue() for i in range(0, numIslands)]
+		sys.stdout.flush()	# Forked islands would print what is buffered again
+		self.islands = []
+		islandSizes = []
+		for i in range(0, numIslands):
+			islandPopulationConfig = dict(populationConfig)
+			islandPopulationConfig["size"] = getShare(int(populationConfig["size"]), i, 2)
+			if "numUnevaluated" in populationConfig:
+				islandPopulationConfig["numUnevaluated"] = getShare(int(populationConfig["numUnevaluated"]), i, 1)
+			islandSizes.append(islandPopulationConfig["size"])
+			islandStructureConfig = dict(structureConfig)
+			islandStructureConfig["creatures"] = creatures[i::numIslands]
+			neighbours = [inboxes[(i + 1) % numIslands]] if topology == "ring" else [inboxes[j] for j in range(0, numIslands) if j != i]
+			connection, islandConnection = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=runIsland, daemon=True, args=(islandConnection, inboxes[i], neighbours, islandsConfig.get("algorithmType", "GeneticAlgorithm"),
+				copy.deepcopy(islandPopulationConfig), crossoverConfig, mutationConfig, islandStructureConfig, islandsConfig, topology))
+			process.start()
+			self.islands.append({ "connection": connection, "lock": threading.Lock(), "process": process })
+
+		print("Started " + str(numIslands) + " islands of " + "/".join(str(size) for size in sorted(set(islandSizes), reverse=True)) + " individuals, " + str(sum(islandSizes)) + " in total, " + topology + " topology")
+
+	# Sends a command to an island process and returns its response
+	def request(self, islandIndex, command, *args):
+		island = self.islands[islandIndex]
+		with island["lock"]:
+			island["connection"].send((command, args))
+			isOk, response = island["connection"].recv()
+		if not isOk:
+			raise RuntimeError("Island " + str(islandIndex) + " failed on " + command + ": " + response)
+		return response
+
+	def requestAll(self, command, *args):
+		return [self.request(i, command, *args) for i in range(0, len(self.islands))]
+
+	# Islands maintain their own population whenever they are asked for work. Left here is forgetting the owners of
+	# creatures that were handed out but are no longer in their island population, and saving state. Late results are
+	# accepted as long as the creature is still in the population, same as GeneticAlgorithm.
+	def maintainPopulation(self):
+		with self.lock:
+			isOwnerSweepDue = time.time() - self.ownerSweepTimestamp > self.OWNER_SWEEP_INTERVAL
+			if isOwnerSweepDue:
+				self.ownerSweepTimestamp = time.time()
+				idsPerIsland = {}
+				for creatureId, (islandIndex, creature) in self.owners.items():
+					idsPerIsland.setdefault(islandIndex, []).append(creatureId)
+
+			isSaveStateDue = time.time() - self.saveStateTimestamp > 60*60	# 1hr, same as GeneticAlgorithm
+			if isSaveStateDue:
+				self.saveStateTimestamp = time.time()
+
+		if isOwnerSweepDue:
+			for islandIndex, creatureIds in idsPerIsland.items():
+				activeIds = set(self.request(islandIndex, "getActiveCreatureIds", creatureIds))
+				with self.lock:
+					for creatureId in creatureIds:
+						if not creatureId in activeIds:
+							self.owners.pop(creatureId, None)
+
+		if isSaveStateDue:
+			self.callbacks["saveState"]()
+
+	def getForFitness(self):
+		picked = self.getForFitnessBatch(1)
+		return picked[0] if picked else None
+
+	# Takes work from one island after the other, starting with a different island every call
+	def getForFitnessBatch(self, maxCount):
+		with self.lock:
+			firstIsland = self.nextIsland
+			self.nextIsland = (self.nextIsland + 1) % len(self.islands)
+
+		picked = []
+		for i in range(0, len(self.islands)):
+			if len(picked) >= maxCount:
+				break
+			islandIndex = (firstIsland + i) % len(self.islands)
+			creatures = self.request(islandIndex, "getForFitnessBatch", maxCount - len(picked))
+			with self.lock:
+				for creature in creatures:
+					self.owners[creature.id] = (islandIndex, creature)
+			picked += creatures
+
+		return picked
+
+	# Sends each result to the island that handed out the creature. Returns a (creature, stored fitness) per result,
+	# same as GeneticAlgorithm.setCreatureFitnessBatch.
+	def setCreatureFitnessBatch(self, creatureFitnesses, simulatedTimes = None):
+		outcomes = [(None, None)]*len(creatureFitnesses)
+		resultsPerIsland = {}
+		with self.lock:
+			for position, (creatureId, fitness) in enumerate(creatureFitnesses):
+				owner = self.owners.pop(creatureId, None)
+				if owner:
+					resultsPerIsland.setdefault(owner[0], []).append((position, owner[1], fitness))
+
+		for islandIndex, results in resultsPerIsland.items():
+			islandSimulatedTimes = [simulatedTimes[position] for position, creature, fitness in results] if simulatedTimes else None
+			accepted = self.request(islandIndex, "setCreatureFitnessBatch", [(creature.id, fitness) for position, creature, fitness in results], islandSimulatedTimes)
+			for (position, creature, fitness), (isAccepted, storedFitness) in zip(results, accepted):
+				if isAccepted:
+					outcomes[position] = (creature, storedFitness)
+
+		for creature, fitness in outcomes:
+			if fitness != None and creature.nextFitnessLog:
+				print("Fitness=" + str(fitness) + ". " + creature.nextFitnessLog)
+		return outcomes
+
+	def setCreatureFitness(self, creatureId, fitness, printLog = True, simulatedTime = None):
+		return self.setCreatureFitnessBatch([(creatureId, fitness)], [simulatedTime])[0][0]
+
+	# Sums up the islands. Also keeps populationConfig["generation"] at the generation of the slowest island.
+	def getSummary(self):
+		summaries = self.requestAll("getSummary")
+		self.populationConfig["generation"] = min(summary["generation"] for summary in summaries)
+		return summaries
+
+	def getAverageFitness(self):
+		summaries = self.getSummary()
+		numWithFitness = sum(summary["numWithFitness"] for summary in summaries)
+		return sum(summary["fitnessSum"] for summary in summaries)/numWithFitness if numWithFitness > 0 else 0
+
+	def getIndexBestIsland(self):
+		summaries = self.getSummary()
+		bestFitness = [summary["bestFitness"] for summary in summaries]
+		return max(range(0, len(summaries)), key=lambda i: bestFitness[i] if bestFitness[i] == bestFitness[i] else float("-inf"))	# NaN last
+
+	def getBestFitness(self):
+		return self.getSummary()[self.getIndexBestIsland()]["bestFitness"]
+
+	def getBestCreature(self):
+		return self.request(self.getIndexBestIsland(), "getBestCreature")
+
+	def getPopulationSize(self):
+		return sum(summary["populationSize"] for summary in self.getSummary())
+
+	def getNumWithFitness(self):
+		return sum(summary["numWithFitness"] for summary in self.getSummary())
+
+	def getStatusNumeric(self):
+		summaries = self.getSummary()
+		status = {}
+		for key in ["numInFlight", "numWithFitness", "populationSize", "fitnessCacheHits", "fitnessCacheLookups"]:
+			status[key] = sum(summary[key] for summary in summaries)
+		return status
+
+	def getStatus(self):
+		status = self.getStatusNumeric()
+
+		text = "Islands(" + str(len(self.islands)) + "x" + str(status["populationSize"]//len(self.islands)) + "): in flight = " + str(status["numInFlight"]) + " w/fitness=" + str(status["numWithFitness"])
+		if status["fitnessCacheLookups"] > 0:
+			text += " fitness cache hits={} ({:.1f}%)".format(status["fitnessCacheHits"], 100*status["fitnessCacheHits"]/status["fitnessCacheLookups"])
+		return text
+
+	def getInFlightMetrics(self):
+		islands = self.requestAll("getInFlightMetrics")
+		numPerEvaluationCount = [0]*max(len(island["numPerEvaluationCount"]) for island in islands)
+		for island in islands:
+			for count, num in enumerate(island["numPerEvaluationCount"]):
+				numPerEvaluationCount[count] += num
+		return { "populationSize": sum(island["populationSize"] for island in islands), "numWithFitness": sum(island["numWithFitness"] for island in islands),
+			"numInFlight": sum(island["numInFlight"] for island in islands), "numPerEvaluationCount": numPerEvaluationCount, "islands": islands }
+
+	# Returns a dictionary with { "fitness": value, "data": creatureObjectStructure }, all islands after each other
+	def getCreaturesWithFitnessJson(self):
+		creatures = []
+		for islandCreatures in self.requestAll("getCreaturesWithFitnessJson"):
+			creatures += islandCreatures
+		return creatures
+
+	def getConsistencyErrors(self):
+		errors = []
+		for i, islandErrors in enumerate(self.requestAll("getConsistencyErrors")):
+			errors += ["Island " + str(i) + ": " + error for error in islandErrors]
+		return errors
+
+# Main loop of an island process: serves commands from IslandModel and exchanges migrants with its neighbours
+def runIsland(connection, inbox, neighbours, algorithmType, populationConfig, crossoverConfig, mutationConfig, structureConfig, islandsConfig, topology):
+	from Trainer import GeneticAlgorithm, SteadyStateGeneticAlgorithm	# Here since Trainer imports this module
+
+	algorithmClass = SteadyStateGeneticAlgorithm if algorithmType == "SteadyStateGeneticAlgorithm" else GeneticAlgorithm
+	algorithm = algorithmClass(populationConfig, crossoverConfig, mutationConfig, structureConfig, { "saveState": lambda: None })
+	migrationInterval = int(islandsConfig.get("migrationInterval", 500))
+	numMigrants = int(islandsConfig.get("numMigrants", 2))
+	numAcceptedSinceMigration = 0
+
+	def emigrate():
+		migrants = algorithm.getBestCreaturesWithFitness(numMigrants)
+		targets = [random.choice(neighbours)] if topology == "random" else neighbours
+		for target in targets:
+			target.put(migrants)
+
+	def immigrate():
+		while True:
+			try:
+				migrants = inbox.get_nowait()
+			except queue.Empty:
+				return
+			for creature, fitness in migrants:
+				creature.id = str(uuid.uuid4())	# The original stays on its island
+				creature.generatorType = "migrated"
+			algorithm.addImmigrants(migrants)
+
+	while True:
+		try:
+			command, args = connection.recv()
+		except EOFError:
+			return		# Trainer is gone
+
+		try:
+			if neighbours:
+				immigrate()
+
+			if command == "getForFitnessBatch":
+				algorithm.maintainPopulation()
+				response = algorithm.getForFitnessBatch(*args)
+				for creature in response:
+					creature.getGenome()	# Encoded on the island, so the trainer process only routes
+			elif command == "setCreatureFitnessBatch":
+				response = [(creature != None, fitness) for creature, fitness in algorithm.setCreatureFitnessBatch(*args)]
+				numAcceptedSinceMigration += sum(isAccepted for isAccepted, fitness in response)
+				if neighbours and numAcceptedSinceMigration >= migrationInterval:
+					numAcceptedSinceMigration = 0
+					emigrate()
+			elif command == "getActiveCreatureIds":
+				response = [creatureId for creatureId in args[0] if creatureId in algorithm.creatureIndexLookup]
+			elif command == "getSummary":
+				status = algorithm.getStatusNumeric()
+				response = { "fitnessSum": algorithm.getAverageFitness()*status["numWithFitness"], "bestFitness": algorithm.getBestFitness(), "generation": populationConfig["generation"],
+					"numWithFitness": status["numWithFitness"], "numInFlight": status["numInFlight"], "populationSize": status["populationSize"] }
+				fitnessCache = algorithm.fitnessCache.getJson() if algorithm.fitnessCache else { "hits": 0, "lookups": 0 }
+				response["fitnessCacheHits"] = fitnessCache["hits"]
+				response["fitnessCacheLookups"] = fitnessCache["lookups"]
+			else:
+				response = getattr(algorithm, command)(*args)
+
+			connection.send((True, response))
+		except Exception as e:
+			traceback.print_exc()
+			connection.send((False, str(e)))
@@ -1,79 +1,113 @@
+import numpy as np
 import random
 import json
+import copy
 import sys
 import math
+import os
 
+rng = np.random.default_rng()
+
+# A forked process (an island of IslandModel) would otherwise draw the same numbers as its parent and its siblings
+def reseedAfterFork():
+	global rng
+	rng = np.random.default_rng()
+
+os.register_at_fork(after_in_child=reseedAfterFork)
+
+# All parameters live in one contiguous float32 array: the weights of all layers followed by the biases of all layers,
+# the same order as the parameters of an encoded genome. A parameter index is an index into this array.
+# The json form (layers of activation, weights and biases) is unchanged.
+#
+# There is one bias per output (genome v2). Genome v1 had one bias per weight, numInputs x numOutputs of them, which
+# only ever were summed per output. Such layers are folded into one bias per output when loaded.
 class LinearMotorController():
-	# generatorJson: 
+	# generatorJson:
 	def __init__(self, numInputs, numOutputs, stateJson = None, generatorJson = None):
-		def createRandomizedWeights(num):
-			weights = []
-			for i in range(0, num):
-				weights.append(random.gauss(0, 1))
-			return weights
-
-		self.layers = []
+		self.numInputs = numInputs
+		self.numOutputs = numOutputs
+		self.activations = []
+		self.numWeights = []	# Per layer
+		self.numBiases = []		# Per layer
 		if stateJson == None:
 			# Create new randomized
 			currentNumInputs = numInputs
 			for layerConfig in generatorJson["layers"]:
 				outputSize = layerConfig["neurons"] if "neurons" in layerConfig else numOutputs	# hidden layer neurons or output layer output
-				layerState = { "activation": layerConfig["activation"], "weights": createRandomizedWeights(currentNumInputs*outputSize), "biases": createRandomizedWeights(currentNumInputs*outputSize) }
-
-				self.layers.append(layerState)
+				self.activations.append(layerConfig["activation"])
+				self.numWeights.append(currentNumInputs*outputSize)
+				self.numBiases.append(outputSize)
 				currentNumInputs = outputSize
+			self.parameters = rng.standard_normal(sum(self.numWeights) + sum(self.numBiases)).astype(np.float32)
 		else:
-			for i in range(0, len(stateJson["layers"])):
-				self.layers.append(stateJson["layers"][i])
+			layers = stateJson["layers"]
+			biases = []
+			currentNumInputs = numInputs
+			for l in layers:
+				outputSize = len(l["weights"]) // currentNumInputs
+				if outputSize*currentNumInputs != len(l["weights"]):
+					raise ValueError("Layer of " + str(len(l["weights"])) + " weights doesn't take " + str(currentNumInputs) + " inputs")
+				self.activations.append(l["activation"])
+				self.numWeights.append(len(l["weights"]))
+				self.numBiases.append(outputSize)
+				biases.append(foldBiases(l["biases"], outputSize))
+				currentNumInputs = outputSize
+			self.parameters = np.concatenate([np.array([w for l in layers for w in l["weights"]], dtype=np.float32)] + biases)
+
+	# Returns (start, end) of the weights and of the biases of each layer in self.parameters
+	def getLayerRanges(self):
+		ranges = []
+		weightStart = 0
+		biasStart = sum(self.numWeights)
+		for numWeights, numBiases in zip(self.numWeights, self.numBiases):
+			ranges.append(((weightStart, weightStart + numWeights), (biasStart, biasStart + numBiases)))
+			weightStart += numWeights
+			biasStart += numBiases
+		return ranges
 
 	def getJson(self):
-		return { "name": "LinearMotorController", "layers": self.layers }
+		layers = []
+		for activation, (weights, biases) in zip(self.activations, self.getLayerRanges()):
+			layers.append({ "activation": activation, "weights": self.parameters[weights[0]:weights[1]].tolist(), "biases": self.parameters[biases[0]:biases[1]].tolist() })
+		return { "name": "LinearMotorController", "layers": layers }
 
 	def serialize(self):
-		return json.dumps(getJson())
+		return json.dumps(self.getJson())
 
-	# Returns list of (layerIndex, weightIndex, key)
-	def getWeightIndices(self, numParametersRatio):
-		numParametersToChange = int(numParametersRatio * 2*self.getNumWeights())
+	# Motor forces for inputs, an array (numInputs) or a batch (batchSize x numInputs) of creature states. See getMotorForcesBatch.
+	def getMotorForces(self, inputs):
+		forces = getMotorForcesBatch([self], inputs)[0]
+		return forces[0] if np.ndim(inputs) == 1 else forces
 
-		indices = list(range(0, 2*self.getNumWeights()))
-		random.shuffle(indices)
-		layerWeightIndices = []
-		for i in indices[:numParametersToChange]:
-			layerWeightIndices.append(self.transformWeightIndex(i))
-		return layerWeightIndices
+	# Copy with its own parameter array. Layer sizes and activations never change, so they are shared.
+	def copy(self):
+		controller = copy.copy(self)
+		controller.parameters = self.parameters.copy()
+		return controller
 
-	# Takes weightIndex into all weights independent of layer and return a tupple (layerIndex, weightIndexIntoLayerWeights)
-	def transformWeightIndex(self, weightIndex):
-		weightStart = 0
-		for key in ("weights", "biases"):
-			for i in range(0, len(self.layers)):
-				l = self.layers[i]
-				if weightIndex >= weightStart and weightIndex < weightStart + len(l["weights"]):
-					return (i, weightIndex - weightStart, key)
-				weightStart += len(l["weights"])
+	# Returns a random selection of parameter indices, without duplicates
+	def pickWeightIndices(self, numParametersRatio):
+		numParametersToChange = int(numParametersRatio * len(self.parameters))
+		return rng.choice(len(self.parameters), size=numParametersToChange, replace=False, shuffle=False)
 
 	def getNumWeights(self):
-		num = 0
-		for l in self.layers:
-			num += len(l["weights"])
-		return num
+		return sum(self.numWeights)
 
+	# Returns the indices of the changed weights
 	def crossover(self, partnerCreature, configJson):
 		numWeightsToChangeRatio = self.pickRandomNumberFromRange(configJson["numParameterChangedRatioRange"], "-")
 		changeRatio = self.pickRandomNumberFromRange(configJson["changeRatioRange"], "-")
 
-		for lw in self.getWeightIndices(numWeightsToChangeRatio):
-			layerIndex = lw[0]
-			weightIndex = lw[1]
-			key = lw[2]
-			delta = partnerCreature.motorController.layers[layerIndex][key][weightIndex] - self.layers[layerIndex][key][weightIndex]
-			self.layers[layerIndex][key][weightIndex] += changeRatio * delta
+		indices = self.pickWeightIndices(numWeightsToChangeRatio)
+		self.parameters[indices] += np.float32(changeRatio) * (partnerCreature.motorController.parameters[indices] - self.parameters[indices])
+
+		return np.sort(indices).tolist()
 
 	def pickRandomNumberFromRange(self, rangeStr, seperator):
 		rangeNumeric = rangeStr.split(seperator)
 		return random.uniform(float(rangeNumeric[0]), float(rangeNumeric[1]))
 
+	# Returns the indices of the changed weights
 	def mutate(self, configJson):
 		numWeightsToChangeRatio = self.pickRandomNumberFromRange(configJson["numParameterChangedRatioRange"], "-")
 
@@ -82,9 +116,48 @@ class LinearMotorController():
 		if "randomizeSign" in configJson and configJson["randomizeSign"] == "yes" and random.random() < .5:
 			offset = offset * (-1);
 
-		for lw in self.getWeightIndices(numWeightsToChangeRatio):
-			layerIndex = lw[0]
-			weightIndex = lw[1]
-			key = lw[2]
-
-			self.layers[layerIndex][key][weightIndex] += offset
\ No newline at end of file
+		indices = self.pickWeightIndices(numWeightsToChangeRatio)
+		self.parameters[indices] += np.float32(offset)
+
+		return np.sort(indices).tolist()
+
+# Returns the biases of a layer as float32, one per output. Genome v1 biases (one per weight, numOutputs x numInputs)
+# are summed per output, which is how they were evaluated. The sum is done in float64 and rounded once.
+def foldBiases(biases, numOutputs):
+	biases = np.asarray(biases, dtype=np.float64)
+	if len(biases) != numOutputs:
+		if len(biases) % numOutputs != 0:
+			raise ValueError("Layer of " + str(numOutputs) + " outputs can't have " + str(len(biases)) + " biases")
+		biases = biases.reshape(numOutputs, -1).sum(axis=1)
+	return biases.astype(np.float32)
+
+# Forward pass of many controllers with the same layer sizes at once, the same math as MachineWorker
+# LinearMotorController::multiplyMatrix for each layer:
+#	output[i] = activation(biases[i] + sum over j of input[j]*weights[i*numInputs + j])
+# where activation is tanh, anything else is linear. The weights of all controllers are stacked, so each layer is one
+# batched float32 matmul. Matches MachineWorker up to float32 rounding of the summation order.
+# inputs: (batchSize x numInputs) shared by all controllers, or (numControllers x batchSize x numInputs).
+# Returns (numControllers x batchSize x numOutputs).
+def getMotorForcesBatch(controllers, inputs):
+	first = controllers[0]
+	for controller in controllers:
+		if controller.numWeights != first.numWeights or controller.numBiases != first.numBiases or controller.activations != first.activations:
+			raise ValueError("Controllers in a batch must have the same layers")
+
+	values = np.asarray(inputs, dtype=np.float32)
+	if values.ndim == 1:
+		values = values[None, :]
+	if values.ndim == 2:
+		values = np.broadcast_to(values, (len(controllers),) + values.shape)
+	if values.shape[-1] != first.numInputs:
+		raise ValueError("Got " + str(values.shape[-1]) + " inputs, controllers take " + str(first.numInputs))
+
+	parameters = np.stack([controller.parameters for controller in controllers])
+	for activation, (weights, biases) in zip(first.activations, first.getLayerRanges()):
+		numInputs = values.shape[-1]
+		matrix = parameters[:, weights[0]:weights[1]].reshape(len(controllers), -1, numInputs)	# (controller, output, input)
+		values = np.matmul(values, matrix.transpose(0, 2, 1)) + parameters[:, None, biases[0]:biases[1]]
+		if activation == "tanh":
+			values = np.tanh(values)
+
+	return values
@@ -0,0 +1,95 @@
+import threading
+import math
+import time
+
+# Histogram of durations in seconds with logarithmic buckets, 4 per doubling from 1 microsecond up to about 17 minutes.
+# Recording is O(1) and needs no samples kept, percentiles are accurate to within one bucket (about 19%).
+class Histogram():
+	MIN_VALUE = 1e-6
+	BUCKETS_PER_DOUBLING = 4
+	NUM_BUCKETS = 4*30 + 1		# Bucket 0 counts everything below MIN_VALUE
+
+	def __init__(self):
+		self.counts = [0]*self.NUM_BUCKETS
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def add(self, value):
+		if value < self.MIN_VALUE:
+			bucket = 0
+		else:
+			bucket = min(int(math.log2(value/self.MIN_VALUE)*self.BUCKETS_PER_DOUBLING) + 1, self.NUM_BUCKETS - 1)
+		self.counts[bucket] += 1
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+
+	# Upper bound of the bucket holding the value at quantile (0-1), capped by the largest value seen
+	def getPercentile(self, quantile):
+		if self.count == 0:
+			return 0
+		rank = quantile*self.count
+		accumulated = 0
+		for bucket in range(0, self.NUM_BUCKETS):
+			accumulated += self.counts[bucket]
+			if accumulated >= rank:
+				return min(self.MIN_VALUE*2**(bucket/self.BUCKETS_PER_DOUBLING), self.max)
+		return self.max
+
+	def getJson(self):
+		return { "count": self.count, "total": self.total, "mean": self.total/self.count if self.count > 0 else 0,
+			"p50": self.getPercentile(0.5), "p95": self.getPercentile(0.95), "p99": self.getPercentile(0.99), "max": self.max }
+
+# Counters per message type, recorded by the communicators for every request they serve: number of requests, bytes
+# received and sent (frame headers included) and time spent in the handler.
+class Metrics():
+	def __init__(self):
+		self.lock = threading.Lock()	# Handler threads record concurrently
+		self.startTime = time.time()
+		self.messages = {}
+		self.compression = {}	# "compressed"/"decompressed" -> counts, plain and compressed bytes, CPU time
+
+	def record(self, messageType, bytesIn, bytesOut, handlerTime):
+		with self.lock:
+			message = self.messages.get(messageType)
+			if message == None:
+				message = { "count": 0, "bytesIn": 0, "bytesOut": 0, "handlerTime": Histogram() }
+				self.messages[messageType] = message
+			message["count"] += 1
+			message["bytesIn"] += bytesIn
+			message["bytesOut"] += bytesOut
+			message["handlerTime"].add(handlerTime)
+
+	# plainBytes were compressed to (or decompressed from) compressedBytes, taking cpuTime seconds of CPU
+	def recordCompression(self, direction, plainBytes, compressedBytes, cpuTime):
+		with self.lock:
+			compression = self.compression.get(direction)
+			if compression == None:
+				compression = { "count": 0, "plainBytes": 0, "compressedBytes": 0, "cpuTime": 0 }
+				self.compression[direction] = compression
+			compression["count"] += 1
+			compression["plainBytes"] += plainBytes
+			compression["compressedBytes"] += compressedBytes
+			compression["cpuTime"] += cpuTime
+
+	# Short summary for the status line, empty if nothing was compressed
+	def getCompressionStatus(self):
+		with self.lock:
+			parts = []
+			for direction, compression in sorted(self.compression.items()):
+				parts.append("{} {:.1f}x in {:.2f}s CPU".format(direction, compression["plainBytes"]/max(compression["compressedBytes"], 1), compression["cpuTime"]))
+			return ", ".join(parts)
+
+	def getJson(self):
+		with self.lock:
+			uptime = time.time() - self.startTime
+			messages = {}
+			for messageType, message in self.messages.items():
+				messages[messageType] = { "count": message["count"], "perSecond": message["count"]/uptime, "bytesIn": message["bytesIn"], "bytesOut": message["bytesOut"],
+					"handlerTime": message["handlerTime"].getJson() }
+			compression = {}
+			for direction, values in self.compression.items():
+				compression[direction] = dict(values)
+				compression[direction]["ratio"] = values["plainBytes"]/max(values["compressedBytes"], 1)
+			return { "uptime": uptime, "messages": messages, "compression": compression }
@@ -0,0 +1,408 @@
+# PhysicsEvaluator
+#
+# Evaluates MOVE_FAR work units without MachineWorker. Each creature structure is compiled to a MJCF model and simulated
+# in one of a pool of pybullet DIRECT servers, driven by the Python LinearMotorController forward pass. The forward pass
+# runs batched for all creatures with the same layers, one tick at a time over all servers. The servers of one
+# PhysicsEvaluator are stepped one after the other on the calling thread; run several worker processes to use more cores.
+#
+# Mirrors the MachineWorker setup: gravity -200, ground friction 4, 1/60 s per tick, capsule masses and inertia as
+# BulletInterface::addCapsule, velocity motors with max force 2000 and the same state inputs as BulletCreature::getState.
+# MachineWorker joins capsules with a btGeneric6DofConstraint; here the enabled x/y/z rotations are hinges of a
+# pybullet multibody, so fitness is close to but not the same as fitness from MachineWorker.
+#
+# Used by the trainer with --local-evaluators (and --local-evaluator-processes), or as a standalone worker:
+#	python PhysicsEvaluator.py --trainer 127.0.0.1:9999 --servers 16
+
+import pybullet as p
+from CreatureStructure import CreatureStructure
+from LinearMotorController import LinearMotorController, getMotorForcesBatch
+from WorkerSession import WorkerSession
+import numpy as np
+import tempfile
+import traceback
+import argparse
+import time
+import math
+import uuid
+import os
+
+GRAVITY = -200
+TICKS_PER_SECOND = 60
+DEFAULT_DURATION = 60				# Simulated seconds of a work unit without "duration", as MOVE_FAR_TASK::NUMBER_OF_TICKS
+GROUND_FRICTION = 4
+CAPSULE_FRICTION = .5				# Bullet default for rigid bodies
+MAX_MOTOR_FORCE = 2000
+NUM_SOLVER_ITERATIONS = 10			# Bullet default, pybullet defaults to 50
+AXES = ["x", "y", "z"]
+
+# Same calibration of the state inputs as BulletCreature::getState
+CALIBRATION_Z_POSITION = 5
+CALIBRATION_VELOCITY = 7
+CALIBRATION_CAPSULE_POSITION = 2
+CALIBRATION_CAPSULE_TRANSLATION_VELOCITY = 7
+CALIBRATION_CAPSULE_ANGULAR_VELOCITY = 1
+CALIBRATION_CONSTRAINT_ANGLE = 3
+
+# Rotation limits in format "-0.5;2" as ratio of PI, same as BulletInterface::getRange. Anything else locks the rotation.
+def getRange(rangeStr):
+	parts = rangeStr.split(";")
+	if len(parts) != 2:
+		return (0, 0)
+	return (float(parts[0])*math.pi, float(parts[1])*math.pi)
+
+# Capsule mass and inertia exactly as BulletInterface::addCapsule with btCapsuleShapeZ
+def getCapsuleMass(innerHeight, radius):
+	mass = math.pi*radius*radius*innerHeight + 12/math.pi*radius*radius*radius
+	return mass*0.0001
+
+def getCapsuleInertia(innerHeight, radius, mass):
+	lx = 2*radius
+	ly = 2*radius
+	lz = 2*(radius + .5*innerHeight)
+	return (mass/12*(ly*ly + lz*lz), mass/12*(lx*lx + lz*lz), mass/12*(lx*lx + ly*ly))
+
+def quaternionConjugate(q):
+	w, x, y, z = q
+	return (w, -x, -y, -z)
+
+def quaternionMult(q1, q2):
+	w1, x1, y1, z1 = q1
+	w2, x2, y2, z2 = q2
+	return (w1*w2 - x1*x2 - y1*y2 - z1*z2, w1*x2 + x1*w2 + y1*z2 - z1*y2, w1*y2 + y1*w2 + z1*x2 - x1*z2, w1*z2 + z1*w2 + x1*y2 - y1*x2)
+
+def quaternionRotate(q, v):
+	return quaternionMult(quaternionMult(q, (0.0,) + tuple(v)), quaternionConjugate(q))[1:]
+
+# Returns the MJCF model of structure as a string. Capsule i is body "c<i>" with hinge joints "c<i>-x", "c<i>-y", "c<i>-z"
+# for the rotations its constraint enables, placed at the connect point on its parent. Capsules without a constraint are
+# top level bodies, in order.
+def compileMjcf(structure):
+	capsules = structure.getCapsules()
+	indexById = { capsule.id: i for i, capsule in enumerate(capsules) }
+	children = {}
+	roots = []
+	for i, capsule in enumerate(capsules):
+		if capsule.constraint:
+			children.setdefault(indexById[capsule.constraint["parentId"]], []).append(i)
+		else:
+			roots.append(i)
+
+	def compileBody(index, parentIndex):
+		capsule = capsules[index]
+		position = (capsule.positionX, capsule.positionY, capsule.positionZ)
+		quaternion = (capsule.quaternionW, capsule.quaternionX, capsule.quaternionY, capsule.quaternionZ)	# MJCF uses w,x,y,z
+		if parentIndex != None:
+			parent = capsules[parentIndex]
+			parentInverse = quaternionConjugate((parent.quaternionW, parent.quaternionX, parent.quaternionY, parent.quaternionZ))
+			position = quaternionRotate(parentInverse, (position[0] - parent.positionX, position[1] - parent.positionY, position[2] - parent.positionZ))
+			quaternion = quaternionMult(parentInverse, quaternion)
+
+		xml = "<body name='c{}' pos='{} {} {}' quat='{} {} {} {}'>".format(index, *position, *quaternion)
+		if capsule.constraint:
+			for axisIndex, axis in enumerate(AXES):
+				key = axis + "-rotation"
+				if key in capsule.constraint:
+					lower, upper = getRange(capsule.constraint[key].get("range", ""))
+					axisVector = [0, 0, 0]
+					axisVector[axisIndex] = 1
+					xml += "<joint name='{}' type='hinge' pos='0 0 {}' axis='{} {} {}' limited='true' range='{} {}' damping='0' stiffness='0' armature='0'/>".format(
+						getJointName(index, axisIndex), -.5*capsule.innerHeight - capsule.radius, *axisVector, lower, upper)
+		xml += "<geom name='g{}' type='capsule' size='{} {}' friction='{}'/>".format(index, capsule.radius, .5*capsule.innerHeight, CAPSULE_FRICTION)
+		for childIndex in children.get(index, []):
+			xml += compileBody(childIndex, index)
+		return xml + "</body>"
+
+	bodies = "".join(compileBody(index, None) for index in roots)
+	return "<mujoco model='creature'><worldbody><geom name='floor' type='plane' size='0 0 1' friction='{}'/>{}</worldbody></mujoco>".format(GROUND_FRICTION, bodies)
+
+# Returns i of a body or link named "c<i>", None for anything else
+def getCapsuleIndex(name):
+	name = name.decode("utf-8")
+	return int(name[1:]) if name.startswith("c") and name[1:].isdigit() else None
+
+def getJointName(capsuleIndex, axisIndex):
+	return "c{}-{}".format(capsuleIndex, AXES[axisIndex])
+
+# A pool of pybullet DIRECT servers simulating one creature each
+class PhysicsEvaluator():
+	def __init__(self, numServers):
+		self.modelDirectory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()	# loadMJCF only reads files
+		self.servers = []
+		for i in range(0, numServers):
+			id = 0
+			while id == 0:		# Same as estimator/PhysicsServerPool, server 0 is skipped
+				id = p.connect(p.DIRECT)
+			self.servers.append({ "id": id, "simulation": None })
+
+	def close(self):
+		for server in self.servers:
+			p.disconnect(physicsClientId=server["id"])
+		self.servers = []
+
+	# Pulls work with getWork(maxCount) -> list of work units whenever servers are free and hands finished results to
+	# registerResults(results), until isStopped() is true. Waits noWorkDelay before asking again when there was no work.
+	def run(self, getWork, registerResults, isStopped, noWorkDelay = 0.2):
+		nextWorkTime = 0
+		while not isStopped():
+			freeServers = [server for server in self.servers if server["simulation"] == None]
+			if freeServers and time.time() >= nextWorkTime:
+				workUnits = getWork(len(freeServers))
+				for server, work in zip(freeServers, workUnits):
+					try:
+						self.load(server, work)
+					except Exception:
+						# The work unit stays in flight at the trainer until it times out, the server takes the next one
+						print("Failed to load work unit " + str(work.get("task", {}).get("id")) + ":")
+						traceback.print_exc()
+						server["simulation"] = None
+				if not workUnits:
+					nextWorkTime = time.time() + noWorkDelay
+
+			if not any(server["simulation"] for server in self.servers):
+				time.sleep(noWorkDelay)
+				continue
+
+			results = self.tick()
+			if results:
+				registerResults(results)
+
+	def load(self, server, work):
+		task = work["task"]
+		if task["name"] != "MOVE_FAR":
+			print("Ignoring work of unknown task " + task["name"])
+			return
+
+		structure = CreatureStructure(work["creature"]["structure"])
+		controller = LinearMotorController(structure.getNumInputs(), structure.getNumOutputs(), work["creature"]["motorController"])
+		id = server["id"]
+
+		capsuleLinks, jointsByName = self.loadModel(server, structure)
+
+		innerHeights, radii = structure.sizes[:, 0], structure.sizes[:, 1]
+		masses = getCapsuleMass(innerHeights, radii)
+		inertias = np.stack(getCapsuleInertia(innerHeights, radii, masses), axis=1)
+		for i in range(0, structure.getNumCapsules()):
+			body, link = capsuleLinks[i]
+			p.changeDynamics(body, link, mass=masses[i], localInertiaDiagonal=inertias[i].tolist(), lateralFriction=CAPSULE_FRICTION, physicsClientId=id)
+
+		# Motors in output order
+		motors = [jointsByName[getJointName(capsuleIndex, axisIndex)] + (AXES[axisIndex],) for capsuleIndex, axisIndex in structure.getLayout()["motors"]]
+		motorsByBody = {}
+		for outputIndex, (body, jointIndex, axis) in enumerate(motors):
+			jointIndices, outputIndices = motorsByBody.setdefault(body, ([], []))
+			jointIndices.append(jointIndex)
+			outputIndices.append(outputIndex)
+
+		rootIndex = max(i for i, constraint in enumerate(structure.constraints) if not constraint)	# The last one, as BulletCreature
+		simulation = { "work": work, "structure": structure, "controller": controller, "capsuleLinks": [capsuleLinks[i] for i in range(0, structure.getNumCapsules())],
+			"root": capsuleLinks[rootIndex], "motors": motors, "motorsByBody": motorsByBody, "masses": masses,
+			"totalLength": float(structure.sizes.sum()), "feedbacks": np.zeros(structure.numFeedbacks, dtype=np.float32),
+			"tick": 0, "numTicks": max(1, int(task.get("duration", DEFAULT_DURATION)*TICKS_PER_SECOND)), "maxDistance": 0. }
+		server["simulation"] = simulation
+
+		self.setMotorVelocities(server, np.zeros(len(motors), dtype=np.float32))
+		positions, velocities, angularVelocities = self.getCapsuleStates(server)
+		simulation["startPosition"] = self.getCenterOfMass(simulation, positions)[0:2]
+
+	# Resets the server and loads the model of structure. Returns capsuleLinks, capsule index -> (body, link index or -1
+	# for a base), and jointsByName, joint name -> (body, joint index). Raises ValueError if a capsule or a motor of
+	# structure has no counterpart in the loaded model.
+	def loadModel(self, server, structure):
+		id = server["id"]
+		p.resetSimulation(physicsClientId=id)
+		p.setGravity(0, 0, GRAVITY, physicsClientId=id)
+		p.setPhysicsEngineParameter(fixedTimeStep=1./TICKS_PER_SECOND, numSubSteps=1, numSolverIterations=NUM_SOLVER_ITERATIONS, physicsClientId=id)
+
+		filename = os.path.join(self.modelDirectory, str(uuid.uuid4()) + ".xml")
+		try:
+			with open(filename, "w") as file:
+				file.write(compileMjcf(structure))
+			bodies = p.loadMJCF(filename, flags=p.URDF_USE_SELF_COLLISION | p.URDF_USE_SELF_COLLISION_EXCLUDE_PARENT, physicsClientId=id)
+		finally:
+			os.remove(filename)
+
+		# Find the link and joints of every capsule. Bodies with more than one joint get extra links without geometry.
+		capsuleLinks = {}
+		jointsByName = {}
+		for body in bodies:
+			baseIndex = getCapsuleIndex(p.getBodyInfo(body, physicsClientId=id)[0])
+			if baseIndex == None:
+				p.changeDynamics(body, -1, lateralFriction=GROUND_FRICTION, physicsClientId=id)	# The floor
+				continue
+			capsuleLinks[baseIndex] = (body, -1)
+			for jointIndex in range(0, p.getNumJoints(body, physicsClientId=id)):
+				info = p.getJointInfo(body, jointIndex, physicsClientId=id)
+				jointsByName[info[1].decode("utf-8")] = (body, jointIndex)
+				linkIndex = getCapsuleIndex(info[12])
+				if linkIndex != None and p.getCollisionShapeData(body, jointIndex, physicsClientId=id):
+					capsuleLinks[linkIndex] = (body, jointIndex)
+				p.changeDynamics(body, jointIndex, linearDamping=0, angularDamping=0, jointDamping=0, physicsClientId=id)
+			p.changeDynamics(body, -1, linearDamping=0, angularDamping=0, physicsClientId=id)
+
+		missingCapsules = [i for i in range(0, structure.getNumCapsules()) if not i in capsuleLinks]
+		if missingCapsules:
+			raise ValueError("No link in the loaded model for capsules " + ", ".join(str(i) for i in missingCapsules))
+		missingJoints = [getJointName(capsuleIndex, axisIndex) for capsuleIndex, axisIndex in structure.getLayout()["motors"] if not getJointName(capsuleIndex, axisIndex) in jointsByName]
+		if missingJoints:
+			raise ValueError("No joint in the loaded model for motors " + ", ".join(missingJoints))
+
+		return capsuleLinks, jointsByName
+
+	# Returns positions, linear and angular velocities (capsules x 3) of the capsule centers of mass
+	def getCapsuleStates(self, server):
+		id = server["id"]
+		capsuleLinks = server["simulation"]["capsuleLinks"]
+		states = np.empty((3, len(capsuleLinks), 3))
+		for i, (body, link) in enumerate(capsuleLinks):
+			if link == -1:
+				states[0, i] = p.getBasePositionAndOrientation(body, physicsClientId=id)[0]
+				states[1, i], states[2, i] = p.getBaseVelocity(body, physicsClientId=id)
+			else:
+				linkState = p.getLinkState(body, link, computeLinkVelocity=1, physicsClientId=id)
+				states[0, i] = linkState[0]
+				states[1, i] = linkState[6]
+				states[2, i] = linkState[7]
+		return states
+
+	def getCenterOfMass(self, simulation, values):
+		masses = simulation["masses"]
+		return (masses[:, None]*values).sum(axis=0)/masses.sum()
+
+	def setMotorVelocities(self, server, outputs):
+		for body, (jointIndices, outputIndices) in server["simulation"]["motorsByBody"].items():
+			p.setJointMotorControlArray(body, jointIndices, p.VELOCITY_CONTROL, targetVelocities=outputs[outputIndices].tolist(),
+				forces=[MAX_MOTOR_FORCE]*len(jointIndices), physicsClientId=server["id"])
+
+	# Inputs of the motor controller, same order and scaling as BulletCreature::getState
+	def getState(self, server, positions, velocities, angularVelocities):
+		simulation = server["simulation"]
+		structure = simulation["structure"]
+		inputs = structure.inputs
+		totalLength = simulation["totalLength"]
+		state = []
+
+		body, link = simulation["root"]
+		if link == -1:
+			orientation = p.getBasePositionAndOrientation(body, physicsClientId=server["id"])[1]
+		else:
+			orientation = p.getLinkState(body, link, physicsClientId=server["id"])[1]
+		for i, axis in enumerate(["x", "y", "z", "w"]):
+			if inputs["root-orientation-" + axis] == 1:
+				state.append(orientation[i])
+
+		centerPosition = self.getCenterOfMass(simulation, positions)
+		centerVelocity = self.getCenterOfMass(simulation, velocities)
+		if inputs["z-position"] == 1:
+			state.append(centerPosition[2]/totalLength*CALIBRATION_Z_POSITION)
+		for i, axis in enumerate(AXES):
+			if inputs["velocity-" + axis] == 1:
+				state.append(centerVelocity[i]/totalLength*CALIBRATION_VELOCITY)
+
+		if inputs["oscillators"] == 1:
+			seconds = simulation["tick"]/TICKS_PER_SECOND
+			current = structure.oscillatorStart
+			for i in range(0, structure.oscillatorCount):
+				state.append(math.sin(current*seconds))
+				current *= structure.oscillatorMultiplier
+
+		relativePositions = (positions - centerPosition)/totalLength*CALIBRATION_CAPSULE_POSITION
+		relativeVelocities = (velocities - centerVelocity)/totalLength*CALIBRATION_CAPSULE_TRANSLATION_VELOCITY
+		relativeAngularVelocities = angularVelocities/math.pi*CALIBRATION_CAPSULE_ANGULAR_VELOCITY
+		perCapsule = [(values, axisIndex) for values, prefix in [(relativePositions, "capsule-position-"), (relativeVelocities, "capsule-velocity-"), (relativeAngularVelocities, "capsule-angular-velocity-")]
+			for axisIndex, axis in enumerate(AXES) if inputs[prefix + axis] == 1]
+		for i in range(0, len(positions)):
+			state += [values[i, axisIndex] for values, axisIndex in perCapsule]
+
+		for body, jointIndex, axis in simulation["motors"]:
+			if inputs["motor-angle-" + axis] == 1:
+				state.append(p.getJointState(body, jointIndex, physicsClientId=server["id"])[0]/math.pi*CALIBRATION_CONSTRAINT_ANGLE)
+
+		if inputs["feedbacks"] == 1:
+			state += simulation["feedbacks"].tolist()
+
+		return state
+
+	# Steps every server with a creature one tick. Returns the results of the creatures that finished.
+	def tick(self):
+		active = [server for server in self.servers if server["simulation"]]
+		states = []
+		centers = []
+		for server in active:
+			p.stepSimulation(physicsClientId=server["id"])
+			server["simulation"]["tick"] += 1
+			positions, velocities, angularVelocities = self.getCapsuleStates(server)
+			states.append(self.getState(server, positions, velocities, angularVelocities))
+			centers.append(self.getCenterOfMass(server["simulation"], positions))
+
+		# One batched forward pass per group of controllers with the same layers
+		groups = {}
+		for i, server in enumerate(active):
+			controller = server["simulation"]["controller"]
+			groups.setdefault((tuple(controller.numWeights), tuple(controller.numBiases), tuple(controller.activations)), []).append(i)
+		outputs = [None]*len(active)
+		for indices in groups.values():
+			forces = getMotorForcesBatch([active[i]["simulation"]["controller"] for i in indices], np.array([states[i] for i in indices], dtype=np.float32)[:, None, :])
+			for i, force in zip(indices, forces):
+				outputs[i] = force[0]
+
+		results = []
+		for server, output, center in zip(active, outputs, centers):
+			simulation = server["simulation"]
+			numFeedbacks = simulation["structure"].numFeedbacks
+			self.setMotorVelocities(server, output)
+			if numFeedbacks > 0:
+				simulation["feedbacks"] = output[-numFeedbacks:]
+
+			distance = float(np.linalg.norm(center[0:2] - simulation["startPosition"]))
+			simulation["maxDistance"] = max(simulation["maxDistance"], distance)
+
+			if simulation["tick"] >= simulation["numTicks"]:
+				task = simulation["work"]["task"]
+				results.append({ "id": task["id"], "experimentId": task["experimentId"], "maxDistance": simulation["maxDistance"], "simulatedTime": simulation["tick"]/TICKS_PER_SECOND })
+				server["simulation"] = None
+
+		return results
+
+# Runs the evaluator as a worker of a trainer (or relay). Results go back with the next request for work.
+def runWorker(config):
+	session = WorkerSession(config["host"], config["port"])
+	while True:
+		try:
+			session.hello(config["genomeCacheSize"])
+			break
+		except (ConnectionError, OSError) as e:
+			print("Trainer at " + config["host"] + ":" + str(config["port"]) + " not reachable (" + str(e) + "). Retrying....")
+			session.close()
+			time.sleep(1)
+	evaluator = PhysicsEvaluator(config["servers"])
+	pendingResults = []
+
+	def getWork(maxCount):
+		if pendingResults:
+			response = session.doStepBatch(pendingResults, maxCount)
+			del pendingResults[:]
+		else:
+			response = session.getWorkBatch(maxCount)
+		return response["workUnits"]
+
+	print("Evaluating with " + str(config["servers"]) + " physics servers for " + config["host"] + ":" + str(config["port"]))
+	try:
+		evaluator.run(getWork, pendingResults.extend, lambda: False, config["noWorkDelay"])
+	except (ConnectionError, OSError) as e:
+		print("Lost connection to trainer: " + str(e))
+	finally:
+		evaluator.close()
+
+def getConfig():
+	parser = argparse.ArgumentParser(description="Evaluates creatures of a Machine Evolved trainer with pybullet.")
+	parser.add_argument("--trainer", default="127.0.0.1:9999", help="host:port of the trainer (or of a relay). default: 127.0.0.1:9999")
+	parser.add_argument("--servers", type=int, default=16, help="number of pybullet physics servers, each simulating one creature at a time. default: 16")
+	parser.add_argument("--no-work-delay", type=float, default=0.2, help="seconds to wait before asking again when the trainer had no work. default: 0.2")
+	parser.add_argument("--genome-cache-size", type=int, default=4096, help="genomes cached from the trainer, 0 to receive creature json. default: 4096")
+	args = parser.parse_args()
+
+	host, port = args.trainer.rsplit(":", 1)
+	return { "host": host, "port": int(port), "servers": args.servers, "noWorkDelay": args.no_work_delay, "genomeCacheSize": args.genome_cache_size }
+
+if __name__ == "__main__":
+	runWorker(getConfig())
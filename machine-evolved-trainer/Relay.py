@@ -0,0 +1,269 @@
+from Communicator import Communicator, ProtocolError, helloCompression
+from WorkerSession import WorkerSession
+from Genome import helloGenomeCache, addCreatureToWork, encodeGenome, getGenomeHash
+from collections import deque
+import argparse
+import json
+import time
+import threading
+
+# A work unit received from the trainer. Has the parts of the Creature interface addCreatureToWork needs, so workers
+# behind the relay get the same genome caching as workers connected to the trainer directly.
+class RelayedCreature():
+	def __init__(self, creatureJson, genome, genomeVersion):
+		self.json = creatureJson
+		self.genome = genome	# (genome hash, genome), None if the trainer sent creature json
+		self.delta = None
+		self.genomeVersion = genomeVersion
+
+	def getJson(self):
+		return self.json
+
+	def getGenome(self):
+		if self.genome == None:
+			genome = encodeGenome(self.json, self.genomeVersion)
+			self.genome = (getGenomeHash(genome), genome)
+		return self.genome
+
+# Fans out work from one trainer to the workers of one host (or rack). Workers connect to the relay exactly as they
+# would to the trainer, legacy or framed.
+#
+# A single upstream session to the trainer keeps a queue of prefetched work units filled and carries the results
+# collected from workers back in the same STEP_BATCH requests, so the trainer sees one client doing large batches
+# instead of many small connections.
+#
+# Backpressure: every host may hold at most maxLeasedPerHost work units that haven't been returned yet. A host that
+# is slow or has lost work gets fewer units until its results arrive or its leases expire, so it can't drain the
+# queue other hosts are waiting on.
+class Relay():
+	def __init__(self, config):
+		self.config = config
+		self.upstream = WorkerSession(config["upstreamHost"], config["upstreamPort"])		# Used by the upstream thread only
+		self.passthrough = WorkerSession(config["upstreamHost"], config["upstreamPort"])	# Requests forwarded one at a time, e.g. GET_BEST_CREATURE
+		self.passthroughLock = threading.Lock()
+
+		self.lock = threading.Lock()		# Guards everything below
+		self.wakeup = threading.Event()		# Set when the upstream thread has something to do
+		self.readyWork = deque()			# (task, RelayedCreature) prefetched from the trainer, oldest first
+		self.pendingResults = []			# Results from workers not sent upstream yet
+		self.leases = {}					# creature id -> (host, time handed out) of work not returned yet
+		self.numLeasedByHost = {}
+		self.status = "...waiting for trainer..."	# Trainer status as of the last upstream exchange
+		self.statistics = { "workUnitsIn": 0, "workUnitsOut": 0, "resultsIn": 0, "resultsOut": 0, "throttled": 0, "expired": 0, "upstreamRequests": 0, "timeStamp": time.time() }
+		self.isStopped = False
+
+		self.communicator = Communicator(self.getWork, self.getWorkBatch, self.doStepBatch, self.registerResult, self.getServerStatus, self.getBestCreature, self.hello, config["host"], config["port"], self.getMetrics, config["compression"])
+
+	def start(self):
+		upstreamThread = threading.Thread(target=self.runUpstream, daemon=True)
+		upstreamThread.start()
+		try:
+			self.communicator.start()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.stop()
+
+	def stop(self):
+		self.isStopped = True
+		self.wakeup.set()
+		if not self.communicator.isStopped:
+			self.communicator.stop()
+
+	# Upstream thread: keeps readyWork filled and forwards results, one STEP_BATCH round trip at a time.
+	# An exchange is due when the queue is below half of prefetch, or once resultBatchSize results are pending or the
+	# oldest has waited resultFlushInterval seconds. Every exchange tops up the queue, since results may let the
+	# trainer proceed to the next generation.
+	def runUpstream(self):
+		isConnected = False
+		lastExchangeTime = time.time()
+		noWorkUntil = 0		# The trainer had no work to hand out, don't ask again before this time
+		while not self.isStopped:
+			currentTime = time.time()
+			with self.lock:
+				self.expireLeases(currentTime)
+				numWanted = self.config["prefetch"] - len(self.readyWork)
+				isDue = (numWanted >= self.config["prefetch"]/2 and currentTime >= noWorkUntil) or len(self.pendingResults) >= self.config["resultBatchSize"] or \
+					(len(self.pendingResults) > 0 and currentTime - lastExchangeTime >= self.config["resultFlushInterval"])
+				if isDue:
+					results = self.pendingResults
+					self.pendingResults = []
+				else:
+					self.wakeup.clear()
+
+			self.printStatus(currentTime)
+			if not isDue:
+				self.wakeup.wait(self.config["resultFlushInterval"])
+				continue
+
+			try:
+				if not isConnected:
+					self.upstream.hello(self.config["genomeCacheSize"], self.config["compression"] != None)
+					isConnected = True
+				response = self.upstream.doStepBatch(results, max(numWanted, 0))
+			except (OSError, ProtocolError) as e:
+				print("Trainer at " + self.config["upstreamHost"] + ":" + str(self.config["upstreamPort"]) + " not reachable (" + str(e) + "). Retrying....")
+				self.upstream.close()
+				isConnected = False
+				with self.lock:
+					self.pendingResults[0:0] = results	# The trainer ignores results it already has, so resending is safe
+				time.sleep(1)
+				continue
+
+			# Keep the binary genome the trainer sent, so workers with a genome cache don't need it re-encoded
+			workUnits = []
+			for work in response["workUnits"]:
+				genome = None
+				if "genomeHash" in work:
+					genome = (work["genomeHash"], work["binaryGenome"])
+				workUnits.append((work["task"], RelayedCreature(work["creature"], genome, work.get("genomeVersion", 1))))	# Trainers before version 2 don't say
+
+			lastExchangeTime = time.time()
+			if numWanted > 0 and len(workUnits) == 0:
+				noWorkUntil = lastExchangeTime + self.config["noWorkDelay"]
+
+			with self.lock:
+				self.readyWork.extend(workUnits)
+				self.status = response["status"]
+				self.statistics["workUnitsIn"] += len(workUnits)
+				self.statistics["resultsOut"] += len(results)
+				self.statistics["upstreamRequests"] += 1
+
+	# Must be called with self.lock held
+	def expireLeases(self, currentTime):
+		expired = [creatureId for creatureId, lease in self.leases.items() if currentTime - lease[1] > self.config["leaseTimeout"]]
+		for creatureId in expired:
+			self.releaseLease(creatureId)
+		self.statistics["expired"] += len(expired)
+
+	# Must be called with self.lock held
+	def releaseLease(self, creatureId):
+		lease = self.leases.pop(creatureId, None)
+		if lease:
+			self.numLeasedByHost[lease[0]] -= 1
+			if self.numLeasedByHost[lease[0]] == 0:
+				del self.numLeasedByHost[lease[0]]
+
+	def printStatus(self, currentTime):
+		deltaTime = currentTime - self.statistics["timeStamp"]
+		if deltaTime < 10:
+			return
+
+		with self.lock:
+			statistics = dict(self.statistics)
+			for key in ("workUnitsIn", "workUnitsOut", "resultsIn", "resultsOut", "throttled", "expired", "upstreamRequests"):
+				self.statistics[key] = 0
+			self.statistics["timeStamp"] = currentTime
+			numReady = len(self.readyWork)
+			numLeased = len(self.leases)
+			numHosts = len(self.numLeasedByHost)
+
+		print(time.strftime("%H:%M:%S: ") + "{:.1f} work units/sec in, {:.1f} out, {:.1f} results/sec in, {:.1f} out, {:.1f} upstream requests/sec. ready={}, leased={} by {} hosts, throttled={}, expired={}".format(
+			statistics["workUnitsIn"]/deltaTime, statistics["workUnitsOut"]/deltaTime, statistics["resultsIn"]/deltaTime, statistics["resultsOut"]/deltaTime, statistics["upstreamRequests"]/deltaTime,
+			numReady, numLeased, numHosts, statistics["throttled"], statistics["expired"]))
+
+	# Hands out up to maxWorkUnits prefetched work units, fewer if that would take the host over maxLeasedPerHost
+	def takeWork(self, maxWorkUnits, session):
+		host = session.clientAddress[0] if session and session.clientAddress else None
+		currentTime = time.time()
+		taken = []
+		with self.lock:
+			numAllowed = min(maxWorkUnits, self.config["maxLeasedPerHost"] - self.numLeasedByHost.get(host, 0), len(self.readyWork))
+			if numAllowed < maxWorkUnits and len(self.readyWork) >= maxWorkUnits:
+				self.statistics["throttled"] += 1
+			for i in range(0, max(numAllowed, 0)):
+				task, creature = self.readyWork.popleft()
+				self.releaseLease(task["id"])	# The trainer re-issued work it gave up on
+				self.leases[task["id"]] = (host, currentTime)
+				self.numLeasedByHost[host] = self.numLeasedByHost.get(host, 0) + 1
+				taken.append((task, creature))
+			self.statistics["workUnitsOut"] += len(taken)
+			if len(self.readyWork) <= self.config["prefetch"]/2:
+				self.wakeup.set()
+
+		# Outside the lock: only touches the session, which serves one request at a time
+		workUnits = []
+		for task, creature in taken:
+			work = { "status": "OK", "task": task }
+			addCreatureToWork(work, creature, session)
+			workUnits.append(work)
+		return workUnits
+
+	def addResults(self, results):
+		with self.lock:
+			for result in results:
+				self.releaseLease(result["id"])
+			self.pendingResults.extend(results)
+			self.statistics["resultsIn"] += len(results)
+			if len(self.pendingResults) >= self.config["resultBatchSize"]:
+				self.wakeup.set()
+
+	def getWork(self, getBestForPlayback = False, session = None):
+		workUnits = self.takeWork(1, session)
+		return json.dumps(workUnits[0] if workUnits else { "status": "NO_WORK" })
+
+	def getWorkBatch(self, data, session = None):
+		return json.dumps({ "workUnits": self.takeWork(data["maxWorkUnits"], session) })
+
+	def doStepBatch(self, data, session = None):
+		self.addResults(data["results"])
+		response = { "workUnits": self.takeWork(data["maxWorkUnits"], session) }
+		with self.lock:
+			response["status"] = self.status
+		return json.dumps(response)
+
+	# Results are acknowledged when queued. Whether the trainer accepts them is only known after the next upstream exchange.
+	def registerResult(self, data):
+		self.addResults([data])
+		return "OK"
+
+	def getServerStatus(self):
+		with self.lock:
+			return json.dumps({ "status": self.status })
+
+	def getBestCreature(self, session = None):
+		with self.passthroughLock:
+			try:
+				return self.passthrough.request("GET_BEST_CREATURE")
+			except (OSError, ProtocolError) as e:
+				self.passthrough.close()
+				print("Could not forward GET_BEST_CREATURE: " + str(e))
+				return json.dumps({ "status": "NO_WORK" })
+
+	def hello(self, data, session):
+		response = helloGenomeCache(data, session)
+		response.update(helloCompression(data, session))
+		return json.dumps(response)
+
+	def getMetrics(self):
+		metrics = self.communicator.metrics.getJson()
+		with self.lock:
+			metrics["relay"] = { "numReady": len(self.readyWork), "numPendingResults": len(self.pendingResults), "numLeased": len(self.leases),
+				"numLeasedByHost": { str(host): numLeased for host, numLeased in self.numLeasedByHost.items() } }
+		return json.dumps(metrics)
+
+def getConfig():
+	parser = argparse.ArgumentParser(description="Relays work from a Machine Evolved trainer to the workers of another host.")
+	parser.add_argument("--upstream", default="127.0.0.1:9999", help="host:port of the trainer (or of another relay). default: 127.0.0.1:9999")
+	parser.add_argument("--host", default="0.0.0.0", help="address to listen on for workers. default: 0.0.0.0")
+	parser.add_argument("--port", type=int, default=9999, help="port to listen on for workers. default: 9999")
+	parser.add_argument("--prefetch", type=int, default=256, help="number of work units to keep ready for workers. default: 256")
+	parser.add_argument("--result-batch-size", type=int, default=64, help="send results upstream once this many are pending. default: 64")
+	parser.add_argument("--result-flush-interval", type=float, default=0.1, help="max seconds a result waits before being sent upstream. default: 0.1")
+	parser.add_argument("--max-leased-per-host", type=int, default=128, help="max work units a worker host may hold without returning results. default: 128")
+	parser.add_argument("--lease-timeout", type=float, default=60, help="seconds after which work not returned no longer counts against its host. default: 60")
+	parser.add_argument("--no-work-delay", type=float, default=0.2, help="seconds to wait before asking again when the trainer had no work. default: 0.2")
+	parser.add_argument("--compression-level", type=int, default=6, choices=range(0, 10), help="zlib level offered to workers, 0 disables compression. the upstream session asks for compression unless 0. default: 6")
+	parser.add_argument("--compression-threshold", type=int, default=16384, help="only compress messages of at least this many bytes. default: 16384")
+	parser.add_argument("--genome-cache-size", type=int, default=4096, help="genomes cached from the trainer, 0 to receive creature json. default: 4096")
+	args = parser.parse_args()
+
+	upstreamHost, upstreamPort = args.upstream.rsplit(":", 1)
+	return { "upstreamHost": upstreamHost, "upstreamPort": int(upstreamPort), "host": args.host, "port": args.port,
+		"prefetch": args.prefetch, "resultBatchSize": args.result_batch_size, "resultFlushInterval": args.result_flush_interval,
+		"maxLeasedPerHost": args.max_leased_per_host, "leaseTimeout": args.lease_timeout, "noWorkDelay": args.no_work_delay,
+		"genomeCacheSize": args.genome_cache_size,
+		"compression": { "level": args.compression_level, "threshold": args.compression_threshold } if args.compression_level > 0 else None }
+
+if __name__ == "__main__":
+	Relay(getConfig()).start()
@@ -0,0 +1,67 @@
+import numpy as np
+
+# Tournament selection over the individuals of a population.
+#
+# Competitors are sampled without replacement from an explicit array of candidate indices (the individuals with
+# fitness), so the time taken only depends on the number and size of tournaments, never on how many individuals lack
+# fitness. Competition sizes larger than the number of candidates are clamped to it.
+class TournamentSelection():
+	def __init__(self, rng = None):
+		self.rng = rng if rng is not None else np.random.default_rng()
+
+	# Returns an array (numSamples x k) of rows of k distinct positions in range(n), each row uniformly distributed.
+	# Floyd's algorithm, run for all rows at once: k random draws per row and no retries.
+	def samplePositions(self, n, k, numSamples):
+		samples = np.empty((numSamples, k), dtype=np.int64)
+		for column, j in enumerate(range(n - k, n)):
+			drawn = self.rng.integers(0, j + 1, size=numSamples)
+			isTaken = (samples[:, :column] == drawn[:, None]).any(axis=1)
+			samples[:, column] = np.where(isTaken, j, drawn)
+		return samples
+
+	# Runs numTournaments independent tournaments of competitionSize candidates each and returns the index of each
+	# winner: the highest fitness, or the lowest with selectLowest. The same individual may win several tournaments.
+	# fitness: array indexed by individual. candidates: array of individual indices to draw competitors from.
+	def select(self, fitness, candidates, competitionSize, numTournaments, selectLowest = False):
+		if numTournaments == 0:
+			return np.empty(0, dtype=np.int64)
+		if len(candidates) == 0:
+			raise ValueError("Tournament selection needs at least one candidate")
+
+		competitors = candidates[self.samplePositions(len(candidates), min(competitionSize, len(candidates)), numTournaments)]
+		competitorFitness = fitness[competitors]
+		winners = np.argmin(competitorFitness, axis=1) if selectLowest else np.argmax(competitorFitness, axis=1)
+		return competitors[np.arange(numTournaments), winners]
+
+	# Runs one tournament per entry of competitionSizes, in order, where each winner is removed from the candidates
+	# before the next tournament. Returns the distinct winners, e.g. the individuals to eliminate in a generation.
+	def selectDistinct(self, fitness, candidates, competitionSizes, selectLowest = False):
+		if len(competitionSizes) > len(candidates):
+			raise ValueError("Can't select " + str(len(competitionSizes)) + " distinct winners from " + str(len(candidates)) + " candidates")
+
+		# Tournaments run one after the other, so this is plain Python over lists with all random numbers drawn up front
+		pool = [int(i) for i in candidates]
+		fitnessValues = fitness.tolist()
+		uniforms = self.rng.random(sum(competitionSizes)).tolist()
+		numDrawn = 0
+		numInPool = len(pool)
+		winners = np.empty(len(competitionSizes), dtype=np.int64)
+		for tournament, competitionSize in enumerate(competitionSizes):
+			# Floyd's algorithm, see samplePositions
+			positions = []
+			for j in range(numInPool - min(competitionSize, numInPool), numInPool):
+				drawn = int(uniforms[numDrawn]*(j + 1))
+				numDrawn += 1
+				positions.append(j if drawn in positions else drawn)
+
+			if selectLowest:
+				position = min(positions, key=lambda position: fitnessValues[pool[position]])
+			else:
+				position = max(positions, key=lambda position: fitnessValues[pool[position]])
+			winners[tournament] = pool[position]
+
+			# Swap the winner out of the active part of the pool
+			numInPool -= 1
+			pool[position] = pool[numInPool]
+
+		return winners
@@ -1,259 +1,596 @@
-from Communicator import Communicator
+from Communicator import Communicator, helloCompression
+from AsyncCommunicator import AsyncCommunicator
 from Creature import Creature
+from TournamentSelection import TournamentSelection
+from FitnessCache import FitnessCache
+from Genome import helloGenomeCache, addCreatureToWork
+from IslandModel import IslandModel
 import json
 import uuid
 import time
 import copy
 import random
 import math
+import heapq
 import gc
 import os
 import argparse
 from pprint import pprint
+from collections import deque
+import numpy as np
 import sys
 import signal
-
+import threading
+import multiprocessing
+
+# All population bookkeeping is guarded by self.lock, since request handler threads call in concurrently.
+# Critical sections are kept short: slow work like creature serialization and saving state happens outside the lock.
+#
+# Per individual metadata is stored column wise in NumPy arrays indexed like self.creatures, so statistics and
+# selection run as array operations. Sum of fitness and the best individual are maintained incrementally.
+#
+# populationConfig["fitnessCacheSize"] (optional, default 10000, 0 disables) is how many genome hashes to remember the
+# fitness of. Individuals identical to one of them get that fitness when they come up for evaluation instead of being sent.
+#
+# populationConfig["racing"] (optional) enables racing: individuals are first evaluated for shortDuration simulated
+# seconds. Max distance never decreases with time, so the short result is a lower bound of the full length fitness and
+# is kept as fitness for those below the promoteQuantile of the last window short results. The rest are promoted to
+# numFullEvaluations evaluations of fullDuration (optional, default 60 as the worker), averaged into their fitness.
+# Results are told apart by their simulated time, so workers that ignore the task duration count as full evaluations.
+#	{ "shortDuration": 10, "fullDuration": 60, "promoteQuantile": 0.5, "numFullEvaluations": 1, "window": 1000 }
 class GeneticAlgorithm():
-	individuals = []
-	FITNESS = 0		# Key into individuals item tuple
-	CREATURE = 1	# Key into individuals item tuple
-	IN_FLIGHT = 2	# Key into individuals item tuple
-
-	indicesMissingFitness = []
-	indicesInFlight = []
-	creatureIndexLookup = {}	# A dictionary that maps creature.id to index into individuals.
+	GENERATOR_TYPES = ["loaded", "randomized", "crossover", "mutate", "migrated"]	# Values of generatorTypes, index = code
+	GENERATOR_TYPE_CODES = { name: i for i, name in enumerate(GENERATOR_TYPES) }
+	RACING_SHORT = 0	# Values of racingStages
+	RACING_FULL = 1
+	RACING_MIN_SAMPLES = 20		# Short results needed before anyone is left unpromoted
 
 	def __init__(self, populationConfig, crossoverConfig, mutationConfig, structureConfig, callbacks):
+		self.creatures = []				# Creature of each individual
+		self.fitness = None				# float64 per individual, NaN until evaluated
+		self.inFlight = None			# float64 per individual, time sent to a worker, NaN when not in flight
+		self.generatorTypes = None		# int8 per individual, code of creature.generatorType
+		self.evaluationCounts = None	# int32 per individual, fitness results received. Reported by getInFlightMetrics
+		self.racingStages = None		# int8 per individual, RACING_SHORT until promoted to full length evaluation
+		self.fullFitnessSums = None		# float64 per individual, sum of full length evaluation results when racing
+		self.fullEvaluationCounts = None	# int32 per individual, number of full length evaluation results when racing
+		self.fitnessSum = 0				# Sum of fitness of individuals with fitness
+		self.bestIndex = -1				# Individual with the highest fitness, -1 when unknown
+		self.indicesMissingFitness = set()
+		self.indicesInFlight = set()
+		self.inFlightDeadlines = []		# Heap of (time sent, index) ordered by time sent. Entries whose individual no longer has that inFlight time are stale and skipped.
+		self.readyQueue = deque()		# FIFO of indices ready to be sent: missing fitness and not in flight. Entries that got fitness or were sent meanwhile are stale and skipped.
+		self.creatureIndexLookup = {}	# A dictionary that maps creature.id to index into individuals.
+		self.selection = TournamentSelection()
+		self.lock = threading.RLock()
+
 		self.populationConfig = populationConfig
 		self.crossoverConfig = crossoverConfig
 		self.mutationConfig = mutationConfig
 		self.structureConfig = structureConfig
 		self.saveStateTimestamp = time.time()
 		self.callbacks = callbacks
-
+		fitnessCacheSize = int(populationConfig.get("fitnessCacheSize", 10000))
+		self.fitnessCache = FitnessCache(fitnessCacheSize) if fitnessCacheSize > 0 else None
+		self.racing = populationConfig.get("racing")
+		if self.racing:
+			self.shortFitnessWindow = deque(maxlen=int(self.racing.get("window", 1000)))
+			self.racingCounts = { "promoted": 0, "stopped": 0 }
+
+		fitness = []
 		if not structureConfig["creatures"]:
 			# Create new creatures
-			self.indicesMissingFitness = list(range(0, int(self.populationConfig["size"])))
-			for i in self.indicesMissingFitness:
-				creature = Creature(None, structureConfig["generator"])
-				self.individuals.append([float("nan"), creature, float("nan")])
-				self.creatureIndexLookup[creature.id] = i
+			for i in range(0, int(self.populationConfig["size"])):
+				self.creatures.append(Creature(None, structureConfig["generator"]))
+				fitness.append(float("nan"))
 		else:
 			# Deserialize existing creatures
-			creatures = structureConfig["creatures"]
-			for i in range(0, len(creatures)):
-				creatureJson = creatures[i]["data"]
-				fitness = float(creatures[i]["fitness"])
-				creature = Creature(creatureJson, structureConfig["generator"])
-				self.individuals.append([fitness, creature, float("nan")])
-				self.creatureIndexLookup[creature.id] = i
-				
-				if math.isnan(fitness):
-					self.indicesMissingFitness.append(i)
+			for creature in structureConfig["creatures"]:
+				self.creatures.append(Creature(creature["data"], structureConfig["generator"]))
+				fitness.append(float(creature["fitness"]))
+
+		numIndividuals = len(self.creatures)
+		self.fitness = np.array(fitness, dtype=np.float64)
+		self.inFlight = np.full(numIndividuals, np.nan)
+		self.generatorTypes = np.array([self.GENERATOR_TYPE_CODES[creature.generatorType] for creature in self.creatures], dtype=np.int8)
+		self.evaluationCounts = np.zeros(numIndividuals, dtype=np.int32)
+		self.racingStages = np.full(numIndividuals, self.RACING_SHORT, dtype=np.int8)
+		self.fullFitnessSums = np.zeros(numIndividuals, dtype=np.float64)
+		self.fullEvaluationCounts = np.zeros(numIndividuals, dtype=np.int32)
+		for i in range(0, numIndividuals):
+			self.creatureIndexLookup[self.creatures[i].id] = i
+			if math.isnan(fitness[i]):
+				self.indicesMissingFitness.add(i)
+				self.readyQueue.append(i)
+			elif self.fitnessCache:
+				self.fitnessCache.add(self.creatures[i].getGenome()[0], fitness[i])
+		self.resetStatistics()
+
+	# Recomputes the incrementally maintained statistics from the columns. Must be called with self.lock held
+	def resetStatistics(self):
+		self.fitnessSum = float(np.nansum(self.fitness))
+		self.bestIndex = -1
 
 	def getAverageFitness(self):
-		count = 0
-		fitnessSum = 0
-		for i in self.individuals:
-			if not math.isnan(i[self.FITNESS]):
-				count += 1
-				fitnessSum += i[self.FITNESS]		
-		return fitnessSum/count if count > 0 else 0
+		with self.lock:
+			numWithFitness = self.getNumWithFitness()
+			return self.fitnessSum/numWithFitness if numWithFitness > 0 else 0
 
 	# Returns a dictionary with { "fitness": value, "data": creatureObjectStructure }
 	def getCreaturesWithFitnessJson(self):
+		with self.lock:
+			snapshot = list(zip(self.fitness.tolist(), self.creatures))
+
+		# Creatures are never modified once in the population, so they can be serialized outside the lock
 		output = []
-		for i in self.individuals:
-			output.append({ "fitness": i[self.FITNESS], "data": i[self.CREATURE].getJson() })
+		for fitness, creature in snapshot:
+			output.append({ "fitness": fitness, "data": creature.getJson() })
 		return output
-	
-	def getIndexBestCreature(self):
-		bestFitness = self.individuals[0][self.FITNESS]
-		bestIndex = -1
-
-		for j in range(0, len(self.individuals)):
-			i = self.individuals[j]
-			if math.isnan(bestFitness) or (not math.isnan(i[self.FITNESS]) and i[self.FITNESS] > bestFitness):
-				bestFitness = i[self.FITNESS]
-				bestIndex = j
 
-		return bestIndex
+	# Returns 0 if no individual has fitness yet
+	def getIndexBestCreature(self):
+		with self.lock:
+			if self.bestIndex == -1 and self.getNumWithFitness() > 0:
+				self.bestIndex = int(np.nanargmax(self.fitness))
+			return max(self.bestIndex, 0)
 
 	def getCreature(self, creatureId):
-		if not creatureId in self.creatureIndexLookup:
-			return None
+		with self.lock:
+			if not creatureId in self.creatureIndexLookup:
+				return None
 
-		creatureIndex = self.creatureIndexLookup[creatureId]
-		return self.individuals[creatureIndex][self.CREATURE]
+			creatureIndex = self.creatureIndexLookup[creatureId]
+			return self.creatures[creatureIndex]
 
 	def getBestFitness(self):
-		return self.individuals[self.getIndexBestCreature()][self.FITNESS]
+		with self.lock:
+			return float(self.fitness[self.getIndexBestCreature()])
 
 	def getBestCreature(self):
-		#print("picked fitness = " + str(self.individuals[self.getIndexBestCreature()][self.FITNESS]))
-		#print("picked in flight = " + str(self.individuals[self.getIndexBestCreature()][self.IN_FLIGHT]))
-		return self.individuals[self.getIndexBestCreature()][self.CREATURE]
+		with self.lock:
+			return self.creatures[self.getIndexBestCreature()]
 
 	def getPopulationSize(self):
-		return len(self.individuals)
+		return len(self.creatures)
 
 	def getNumWithFitness(self):
-		return len(self.individuals) - len(self.indicesMissingFitness)
+		with self.lock:
+			return len(self.creatures) - len(self.indicesMissingFitness)
 
 	def maintainPopulation(self):
-		# Re-live individuals lost in flight
-		numMissingFitness = len(self.indicesMissingFitness)
-		indicesPutBackFromFlight = []
-
-		#print("maintain: numMissing=" + str(numMissingFitness))
-
-		for i in self.indicesInFlight:
-			timeInFlight = time.time() -  self.individuals[i][self.IN_FLIGHT]
-		#	print("maintain: timeInFlight=" + str(timeInFlight))
-			if((numMissingFitness < 10 and timeInFlight > 1) or timeInFlight > 10):
-				indicesPutBackFromFlight.append(i)
-
-		for i in indicesPutBackFromFlight:
-			self.individuals[i][self.IN_FLIGHT] = float("nan")	# Give up, assume will never come back
-			if self.indicesInFlight.count(i) > 0:
-				self.indicesInFlight.remove(i)
-	
-		if len(self.indicesMissingFitness) == 0:
-			self.proceedToNextGeneration()
-
-		if time.time() - self.saveStateTimestamp > 60*60:	# 1hr. TODO: Make command-line configurable
-			self.saveStateTimestamp = time.time()
+		with self.lock:
+			# Re-live individuals lost in flight. The heap has the oldest first, so only expired entries are visited.
+			maxTimeInFlight = 1 if len(self.indicesMissingFitness) < 10 else 10
+			currentTime = time.time()
+			while self.inFlightDeadlines and currentTime - self.inFlightDeadlines[0][0] > maxTimeInFlight:
+				timeSent, i = heapq.heappop(self.inFlightDeadlines)
+				if self.inFlight[i] == timeSent:	# Otherwise stale: fitness arrived or the individual was replaced
+					self.inFlight[i] = np.nan	# Give up, assume will never come back
+					self.indicesInFlight.discard(i)
+					self.readyQueue.append(i)
+
+			# Checked under the lock so only one thread rolls the generation over
+			if len(self.indicesMissingFitness) == 0:
+				self.proceedToNextGeneration()
+
+			isSaveStateDue = time.time() - self.saveStateTimestamp > 60*60	# 1hr. TODO: Make command-line configurable
+			if isSaveStateDue:
+				self.saveStateTimestamp = time.time()
+
+		if isSaveStateDue:
 			self.callbacks["saveState"]()
 
-	# Returns a list of indices into individuals
-	def pickIndividuals(self, numToPick):
-		picked = []
-		while len(picked) < numToPick:
-			i = int(random.random() * len(self.individuals))
-			if not math.isnan(self.individuals[i][self.FITNESS]) and not i in picked:
-				picked.append(i)
-
-		return picked
-
+	# Puts newCreature in place of the individual at atIndex, ready to be sent. Must be called with self.lock held
+	def replaceIndividual(self, atIndex, newCreature):
+		del self.creatureIndexLookup[self.creatures[atIndex].id]
+		if not math.isnan(self.fitness[atIndex]):
+			self.fitnessSum -= self.fitness[atIndex]
+		if atIndex == self.bestIndex:
+			self.bestIndex = -1
+		self.creatures[atIndex] = newCreature
+		self.fitness[atIndex] = np.nan
+		self.inFlight[atIndex] = np.nan
+		self.generatorTypes[atIndex] = self.GENERATOR_TYPE_CODES[newCreature.generatorType]
+		self.evaluationCounts[atIndex] = 0
+		self.racingStages[atIndex] = self.RACING_SHORT
+		self.fullFitnessSums[atIndex] = 0
+		self.fullEvaluationCounts[atIndex] = 0
+		self.creatureIndexLookup[newCreature.id] = atIndex
+		self.indicesMissingFitness.add(atIndex)
+		self.readyQueue.append(atIndex)
+
+	def createCrossoverChild(self, i1, i2):
+		child = self.creatures[i1].copy()
+		child.crossover(self.creatures[i2], self.crossoverConfig)
+
+		#child.nextFitnessLog = "Crossover between " + str(self.fitness[i1]) + " and " + str(self.fitness[i2]) + "."
+
+		return child
+
+	def createMutateChild(self, i1):
+		child = self.creatures[i1].copy()
+		child.mutate(self.mutationConfig["config"])
+		return child
+
+	# Must be called with self.lock held
+	# All tournaments of a generation are run up front among the individuals evaluated so far: parents are picked with
+	# independent tournaments, individuals to eliminate with distinct losers. Parents are copied before any
+	# individual is replaced, so a parent that is also eliminated still gets its child. Children only record their
+	# change here, the parameters are changed when they are first sent (see Creature.materialize).
 	def proceedToNextGeneration(self):
-		def findReproduceIndex(competitionSize):
-			reproduce = self.pickIndividuals(competitionSize)
-			bestIndex = 0
-			bestFitness = 0
-			for i in reproduce:
-				fitness = self.individuals[i][self.FITNESS]
-				if(fitness > bestFitness):
-					bestFitness = fitness
-					bestIndex = i
-
-			return bestIndex
-
-		def findEliminateIndex(competitionSize):			
-			eliminate = self.pickIndividuals(competitionSize)
-			worstIndex = 0
-			worstFitness = 10000000000
-			for i in eliminate:
-				fitness = self.individuals[i][self.FITNESS]
-				if(fitness < worstFitness):
-					worstFitness = fitness
-					worstIndex = i
-
-			return worstIndex
-
-		def replaceIndividual(atIndex, newCreature):
-			del self.creatureIndexLookup[self.individuals[atIndex][self.CREATURE].id]
-			self.individuals[atIndex]= [float("nan"), newCreature, float("nan")]
-			self.creatureIndexLookup[newCreature.id] = atIndex
-			self.indicesMissingFitness.append(atIndex)
-
-
-		# Create children with crossover
-		numCrossoverChildren = 0
 		crossoverRatio = float(self.crossoverConfig["rate"])
 		reproduceCrossoverSize = int(self.crossoverConfig["competitionSize"]["reproduce"])
 		eliminateCrossoverSize = int(self.crossoverConfig["competitionSize"]["eliminate"])
-		
-		while crossoverRatio > 0.00001 and numCrossoverChildren < int(crossoverRatio*len(self.individuals)):
-			numCrossoverChildren = numCrossoverChildren + 1
-
-			i1 = findReproduceIndex(reproduceCrossoverSize)
-			i2 = findReproduceIndex(reproduceCrossoverSize)
-			reproduceCreature1 = self.individuals[i1][self.CREATURE]
-			reproduceCreature2 = self.individuals[i2][self.CREATURE]
-			child = copy.deepcopy(reproduceCreature1)
-			child.crossover(reproduceCreature2, self.crossoverConfig)
-
-			#child.nextFitnessLog = "Crossover between " + str(self.individuals[i1][self.FITNESS]) + " and " + str(self.individuals[i2][self.FITNESS]) + "."
-			
-			replaceIndividual(findEliminateIndex(eliminateCrossoverSize), child)
-
-
-		# Create children with mutation
-		numMutateChildren = 0
-		self.mutationConfig
 		mutationRatio = float(self.mutationConfig["rate"])
 		reproduceMutationSize = int(self.mutationConfig["competitionSize"]["reproduce"])
 		eliminateMutationSize = int(self.mutationConfig["competitionSize"]["eliminate"])
 
-		while mutationRatio > 0.00001 and numMutateChildren < int(mutationRatio*len(self.individuals)):
-			numMutateChildren = numMutateChildren + 1
+		evaluated = np.flatnonzero(~np.isnan(self.fitness))
+		numCrossoverChildren = int(crossoverRatio*len(self.creatures)) if crossoverRatio > 0.00001 else 0
+		numMutateChildren = int(mutationRatio*len(self.creatures)) if mutationRatio > 0.00001 else 0
+		if numCrossoverChildren + numMutateChildren > len(evaluated):
+			print("Crossover and mutation rates ask for more children than the " + str(len(evaluated)) + " individuals with fitness can make room for. Creating fewer children.")
+			numCrossoverChildren = min(numCrossoverChildren, len(evaluated))
+			numMutateChildren = len(evaluated) - numCrossoverChildren
 
-			i1 = findReproduceIndex(reproduceMutationSize)
-			reproduceCreature = self.individuals[i1][self.CREATURE]
-			child = copy.deepcopy(reproduceCreature)
-			child.mutate(self.mutationConfig["config"])
-			
-			replaceIndividual(findEliminateIndex(eliminateMutationSize), child)
+		crossoverParents = self.selection.select(self.fitness, evaluated, reproduceCrossoverSize, 2*numCrossoverChildren).reshape(2, numCrossoverChildren)
+		mutateParents = self.selection.select(self.fitness, evaluated, reproduceMutationSize, numMutateChildren)
+		eliminated = self.selection.selectDistinct(self.fitness, evaluated, [eliminateCrossoverSize]*numCrossoverChildren + [eliminateMutationSize]*numMutateChildren, True)
+
+		children = [self.createCrossoverChild(i1, i2) for i1, i2 in zip(crossoverParents[0], crossoverParents[1])]
+		children += [self.createMutateChild(i1) for i1 in mutateParents]
 
+		for atIndex, child in zip(eliminated, children):
+			self.replaceIndividual(int(atIndex), child)
+
+		self.resetStatistics()	# Keeps rounding errors of the incremental sum from adding up across generations
 		self.populationConfig["generation"] += 1
-		
+
 		print("Proceeded to generation " + str(self.populationConfig["generation"]) + ". " + str(numCrossoverChildren+numMutateChildren) + " children created")
 
 	def getStatusNumeric(self):
-		return { "numInFlight": len(self.indicesInFlight), "numWithFitness": self.getNumWithFitness(), "populationSize": len(self.individuals)}
-	
+		with self.lock:
+			return { "numInFlight": len(self.indicesInFlight), "numWithFitness": self.getNumWithFitness(), "populationSize": len(self.creatures)}
+
 	def getStatus(self):
 		status = self.getStatusNumeric()
 
-		return "GA(" + str(status["populationSize"]) + "): in flight = " + str(status["numInFlight"]) + " w/fitness=" + str(status["numWithFitness"])
+		text = "GA(" + str(status["populationSize"]) + "): in flight = " + str(status["numInFlight"]) + " w/fitness=" + str(status["numWithFitness"])
+		if self.fitnessCache:
+			text += " " + self.fitnessCache.getStatus()
+		if self.racing:
+			text += " racing promoted={promoted} stopped={stopped}".format(**self.racingCounts)
+		return text
+
+	# Number of creatures in flight and how long they have been out in seconds, plus fitness per generator type
+	def getInFlightMetrics(self):
+		currentTime = time.time()
+		with self.lock:
+			inFlight = self.inFlight[~np.isnan(self.inFlight)]
+			hasFitness = ~np.isnan(self.fitness)
+			numPerType = np.bincount(self.generatorTypes[hasFitness], minlength=len(self.GENERATOR_TYPES))
+			fitnessPerType = np.bincount(self.generatorTypes[hasFitness], weights=self.fitness[hasFitness], minlength=len(self.GENERATOR_TYPES))
+			numWithFitness = self.getNumWithFitness()
+			numPerEvaluationCount = np.bincount(self.evaluationCounts)	# More than one with racing or late duplicate results
+
+		ages = np.sort(currentTime - inFlight)
+		def getPercentile(quantile):
+			return float(ages[min(int(quantile*len(ages)), len(ages)-1)]) if len(ages) > 0 else 0
+
+		generatorTypes = {}
+		for code, name in enumerate(self.GENERATOR_TYPES):
+			if numPerType[code] > 0:
+				generatorTypes[name] = { "numWithFitness": int(numPerType[code]), "averageFitness": float(fitnessPerType[code]/numPerType[code]) }
+
+		return { "populationSize": len(self.creatures), "numWithFitness": numWithFitness, "numInFlight": len(ages), "generatorTypes": generatorTypes,
+			"inFlightAge": { "p50": getPercentile(0.5), "p95": getPercentile(0.95), "p99": getPercentile(0.99), "max": float(ages[-1]) if len(ages) > 0 else 0 },
+			"fitnessCache": self.fitnessCache.getJson() if self.fitnessCache else None, "racing": dict(self.racingCounts) if self.racing else None,
+			"numPerEvaluationCount": numPerEvaluationCount.tolist() }
+
+	# Returns up to count (creature, fitness) of the individuals with the highest fitness, best first
+	def getBestCreaturesWithFitness(self, count):
+		with self.lock:
+			evaluated = np.flatnonzero(~np.isnan(self.fitness))
+			best = evaluated[np.argsort(self.fitness[evaluated])[::-1][:count]]
+			return [(self.creatures[i], float(self.fitness[i])) for i in best]
+
+	# Takes in creatures from another population along with their fitness, each in place of the loser of an
+	# elimination tournament among the evaluated individuals
+	def addImmigrants(self, creaturesWithFitness):
+		outcomes = []
+		with self.lock:
+			for creature, fitness in creaturesWithFitness:
+				evaluated = np.flatnonzero(~np.isnan(self.fitness))
+				if len(evaluated) == 0:
+					break
+				eliminated = self.selection.select(self.fitness, evaluated, int(self.mutationConfig["competitionSize"]["eliminate"]), 1, True)
+				self.replaceIndividual(int(eliminated[0]), creature)
+				outcomes.append(self.applyFitness(creature.id, fitness))
+		self.cacheFitness(outcomes)
 
 	def getForFitness(self):
-		picked = None
-		for i in self.indicesMissingFitness:
-			if math.isnan(self.individuals[i][self.IN_FLIGHT]):
-				self.individuals[i][self.IN_FLIGHT] = time.time()
-				self.indicesInFlight.append(i)
-				picked = self.individuals[i][self.CREATURE]
-				break
+		picked = self.getForFitnessBatch(1)
+		return picked[0] if picked else None
+
+	# Marks up to maxCount individuals from the ready queue as in flight and returns their creatures, oldest ready first.
+	# Individuals found in the fitness cache get their fitness right away and are replaced by the next ones in the queue.
+	def getForFitnessBatch(self, maxCount):
+		picked = []
+		while len(picked) < maxCount:
+			candidates = self.takeFromReadyQueue(maxCount - len(picked))
+			for creature in candidates:
+				creature.materialize()	# Children are built here, outside the lock, as they are sent
+			if not candidates or not self.fitnessCache:
+				return picked + candidates
+
+			# Genomes are encoded outside the lock. Sessions with a genome cache need the encoding anyway.
+			cachedFitnesses = []
+			for creature in candidates:
+				fitness = self.fitnessCache.get(creature.getGenome()[0])
+				if fitness == None:
+					picked.append(creature)
+				else:
+					cachedFitnesses.append((creature.id, fitness))
+
+			# Already in the fitness cache, so only the columns are updated
+			with self.lock:
+				for creatureId, fitness in cachedFitnesses:
+					self.applyFitness(creatureId, fitness)
 
 		return picked
-			
 
-	def setCreatureFitness(self, creatureId, fitness):
+	# Marks up to maxCount individuals from the ready queue as in flight and returns their creatures
+	def takeFromReadyQueue(self, maxCount):
+		picked = []
+		with self.lock:
+			timeSent = time.time()
+			while self.readyQueue and len(picked) < maxCount:
+				i = self.readyQueue.popleft()
+				if not math.isnan(self.fitness[i]) or not math.isnan(self.inFlight[i]):
+					continue	# Stale
+				self.inFlight[i] = timeSent
+				self.indicesInFlight.add(i)
+				heapq.heappush(self.inFlightDeadlines, (timeSent, i))
+				creature = self.creatures[i]
+				creature.evaluationDuration = self.racing["shortDuration"] if self.racing and self.racingStages[i] == self.RACING_SHORT else None
+				picked.append(creature)
+
+		return picked
+
+
+	# Sets fitness for a list of (creatureId, fitness) under a single lock. simulatedTimes: simulated seconds of each
+	# result, None for fitness that is final regardless of racing.
+	# Returns a (creature, fitness) per result: (None, None) for ids that are no longer active, otherwise the fitness
+	# stored for the individual, None while it is still racing.
+	def setCreatureFitnessBatch(self, creatureFitnesses, simulatedTimes = None):
+		outcomes = []
+		with self.lock:
+			for j, (creatureId, fitness) in enumerate(creatureFitnesses):
+				outcomes.append(self.applyFitness(creatureId, fitness, simulatedTimes[j] if simulatedTimes else None))
+		self.cacheFitness(outcomes)
+
+		for creature, fitness, isFullLength in outcomes:
+			if fitness != None and creature.nextFitnessLog:
+				print("Fitness=" + str(fitness) + ". " + creature.nextFitnessLog)
+		return [(creature, fitness) for creature, fitness, isFullLength in outcomes]
+
+	# Returns the creature, or None if it is no longer active. A result that leaves the individual racing for another
+	# evaluation still returns the creature, it just doesn't get fitness yet.
+	def setCreatureFitness(self, creatureId, fitness, printLog = True, simulatedTime = None):
+		with self.lock:
+			outcome = self.applyFitness(creatureId, fitness, simulatedTime)
+		self.cacheFitness([outcome])
+		creature, fitness, isFullLength = outcome
+		if printLog and fitness != None and creature.nextFitnessLog:
+			print("Fitness=" + str(fitness) + ". " + creature.nextFitnessLog)
+		return creature
+
+	# Returns (creature, fitness stored for the individual, whether it is a full length result): (None, None, False) if
+	# the creature is no longer active and (creature, None, False) if the result leaves the individual racing for another
+	# evaluation. Must be called with self.lock held
+	def applyFitness(self, creatureId, fitness, simulatedTime = None):
 		if not creatureId in self.creatureIndexLookup:
-			return		# No longer an active creature. Fitness calculation which is a late arrival and was considered lost.
+			return None, None, False	# No longer an active creature. Fitness calculation which is a late arrival and was considered lost.
 
 		i = self.creatureIndexLookup[creatureId]
+		isRacing = self.racing and simulatedTime != None
+		isShortResult = isRacing and simulatedTime < float(self.racing.get("fullDuration", 60))
+		if isShortResult and (self.racingStages[i] != self.RACING_SHORT or not math.isnan(self.fitness[i])):
+			return None, None, False	# Late short result, the individual is beyond that
+
+		self.indicesInFlight.discard(i)
+		self.inFlight[i] = np.nan	# Leaves a stale entry in inFlightDeadlines
+		self.evaluationCounts[i] += 1
+
+		creature = self.creatures[i]
+		if isRacing:
+			fitness = self.race(i, fitness, isShortResult)
+			if fitness == None:
+				return creature, None, False
+		isFullLength = not isShortResult
+
+		previousFitness = self.fitness[i]
+		self.fitness[i] = fitness
+
+		# A late duplicate result replaces the fitness of the first one
+		if math.isnan(previousFitness):
+			self.fitnessSum += fitness
+		else:
+			self.fitnessSum += fitness - previousFitness
+		if self.bestIndex != -1:
+			if i == self.bestIndex and fitness < previousFitness:
+				self.bestIndex = -1		# The best got worse, look for the new best when it is asked for
+			elif fitness > self.fitness[self.bestIndex]:
+				self.bestIndex = i
+
+		self.indicesMissingFitness.discard(i)
+
+		return creature, fitness, isFullLength
+
+	# Adds the full length fitness of outcomes from applyFitness to the fitness cache. Called after releasing self.lock,
+	# since it may encode genomes.
+	def cacheFitness(self, outcomes):
+		if not self.fitnessCache:
+			return
+		for creature, fitness, isFullLength in outcomes:
+			if isFullLength and fitness != None:
+				self.fitnessCache.add(creature.getGenome()[0], fitness)
+
+	# Takes the result of an evaluation of individual i while racing. Returns the fitness the individual ends up with, or
+	# None if it is queued for another evaluation. Must be called with self.lock held
+	def race(self, i, fitness, isShortResult):
+		if isShortResult:
+			self.shortFitnessWindow.append(fitness)
+			if len(self.shortFitnessWindow) < self.RACING_MIN_SAMPLES or fitness >= np.quantile(self.shortFitnessWindow, float(self.racing["promoteQuantile"])):
+				self.racingStages[i] = self.RACING_FULL
+				self.racingCounts["promoted"] += 1
+				self.readyQueue.append(i)
+				return None
+
+			self.racingCounts["stopped"] += 1
+			return fitness
+
+		# Full length results are averaged. Late extra ones still count.
+		self.racingStages[i] = self.RACING_FULL
+		self.fullFitnessSums[i] += fitness
+		self.fullEvaluationCounts[i] += 1
+		if self.fullEvaluationCounts[i] < int(self.racing.get("numFullEvaluations", 1)) and math.isnan(self.fitness[i]):
+			self.readyQueue.append(i)
+			return None
+		return float(self.fullFitnessSums[i]/self.fullEvaluationCounts[i])
+
+	# Returns a list of descriptions of broken bookkeeping invariants. Empty if consistent.
+	def getConsistencyErrors(self):
+		errors = []
+		with self.lock:
+			if len(self.creatureIndexLookup) != len(self.creatures):
+				errors.append("creatureIndexLookup has " + str(len(self.creatureIndexLookup)) + " entries for " + str(len(self.creatures)) + " individuals")
+			for creatureId, i in self.creatureIndexLookup.items():
+				if self.creatures[i].id != creatureId:
+					errors.append("creatureIndexLookup maps " + creatureId + " to individual " + str(i) + " which is another creature")
+
+			missing = set(np.flatnonzero(np.isnan(self.fitness)).tolist())
+			if self.indicesMissingFitness != missing:
+				errors.append("indicesMissingFitness does not match the individuals without fitness")
+
+			inFlight = set(np.flatnonzero(~np.isnan(self.inFlight)).tolist())
+			if self.indicesInFlight != inFlight:
+				errors.append("indicesInFlight does not match the individuals with an in flight timestamp")
+			if not inFlight.issubset(missing):
+				errors.append("individuals with fitness are still in flight")
+
+			deadlines = set(self.inFlightDeadlines)
+			if any((float(self.inFlight[i]), i) not in deadlines for i in inFlight):
+				errors.append("individuals in flight without an entry in inFlightDeadlines")
+
+			if not (missing - inFlight).issubset(self.readyQueue):
+				errors.append("individuals ready to be sent are missing from readyQueue")
+
+			fitnessSum = float(np.nansum(self.fitness))
+			if abs(self.fitnessSum - fitnessSum) > 1e-6*max(1, abs(fitnessSum)):
+				errors.append("fitnessSum is " + str(self.fitnessSum) + ", the sum of fitness is " + str(fitnessSum))
+			if self.bestIndex != -1 and self.fitness[self.bestIndex] != np.nanmax(self.fitness):
+				errors.append("bestIndex does not point to the individual with the highest fitness")
+
+			if any(self.generatorTypes[i] != self.GENERATOR_TYPE_CODES[self.creatures[i].generatorType] for i in range(len(self.creatures))):
+				errors.append("generatorTypes does not match the generator type of the creatures")
+
+		return errors
+
+
+# Steady state variant: instead of waiting for the whole population to be evaluated before creating the next generation,
+# every result that lets the number of individuals without fitness drop below numUnevaluated immediately replaces the
+# loser of a tournament among the evaluated individuals with a new child. There is no generation boundary where workers
+# get NO_WORK while the last results of a generation come in.
+#
+# populationConfig["numUnevaluated"] (optional) is how many individuals are kept waiting for or being evaluated,
+# default the number of children per generation of the generational algorithm. "generation" counts that many children.
+class SteadyStateGeneticAlgorithm(GeneticAlgorithm):
+	def __init__(self, populationConfig, crossoverConfig, mutationConfig, structureConfig, callbacks):
+		GeneticAlgorithm.__init__(self, populationConfig, crossoverConfig, mutationConfig, structureConfig, callbacks)
+
+		numIndividuals = len(self.creatures)
+		childrenRatio = float(self.crossoverConfig["rate"]) + float(self.mutationConfig["rate"])
+		self.numUnevaluated = int(populationConfig.get("numUnevaluated", childrenRatio*numIndividuals))
+		self.numUnevaluated = min(max(self.numUnevaluated, 1), numIndividuals - 1)
+		self.crossoverShare = float(self.crossoverConfig["rate"])/childrenRatio if childrenRatio > 0 else 0
+		self.numChildrenInGeneration = 0
+
+		# Evaluated individuals as a dense array for tournaments, with the position of each individual in it (-1 if not evaluated)
+		self.evaluated = np.empty(numIndividuals, dtype=np.int64)
+		self.evaluatedPositions = np.full(numIndividuals, -1, dtype=np.int64)
+		self.numEvaluated = 0
+		with self.lock:
+			for i in np.flatnonzero(~np.isnan(self.fitness)):
+				self.addEvaluated(int(i))
+			self.createChildren()
+
+	# Must be called with self.lock held
+	def addEvaluated(self, i):
+		if self.evaluatedPositions[i] == -1:
+			self.evaluated[self.numEvaluated] = i
+			self.evaluatedPositions[i] = self.numEvaluated
+			self.numEvaluated += 1
+
+	# Must be called with self.lock held
+	def removeEvaluated(self, i):
+		position = self.evaluatedPositions[i]
+		if position != -1:
+			self.numEvaluated -= 1
+			last = self.evaluated[self.numEvaluated]
+			self.evaluated[position] = last
+			self.evaluatedPositions[last] = position
+			self.evaluatedPositions[i] = -1
+
+	def replaceIndividual(self, atIndex, newCreature):
+		self.removeEvaluated(atIndex)
+		GeneticAlgorithm.replaceIndividual(self, atIndex, newCreature)
+
+	# Must be called with self.lock held
+	def applyFitness(self, creatureId, fitness, simulatedTime = None):
+		creature, fitness, isFullLength = GeneticAlgorithm.applyFitness(self, creatureId, fitness, simulatedTime)
+		if fitness != None and not math.isnan(fitness):	# Not if still racing
+			self.addEvaluated(self.creatureIndexLookup[creatureId])
+			self.createChildren()
+		return creature, fitness, isFullLength
+
+	# Replaces evaluated individuals with new children until numUnevaluated individuals lack fitness. Must be called with self.lock held
+	def createChildren(self):
+		while len(self.indicesMissingFitness) < self.numUnevaluated and self.numEvaluated > 0:
+			evaluated = self.evaluated[:self.numEvaluated]
+			if random.random() < self.crossoverShare:
+				parents = self.selection.select(self.fitness, evaluated, int(self.crossoverConfig["competitionSize"]["reproduce"]), 2)
+				child = self.createCrossoverChild(parents[0], parents[1])
+				eliminateSize = int(self.crossoverConfig["competitionSize"]["eliminate"])
+			else:
+				parents = self.selection.select(self.fitness, evaluated, int(self.mutationConfig["competitionSize"]["reproduce"]), 1)
+				child = self.createMutateChild(parents[0])
+				eliminateSize = int(self.mutationConfig["competitionSize"]["eliminate"])
 
-		#if not math.isnan(self.individuals[i][self.FITNESS]):
-		#	return   # Already has fitness. This is probably because the fitness calculation was given up, but now arrived late. Already have fitness result so ignore
-		#if self.indicesInFlight.count(i) != 1:
-		#	print("malformed: count " + str(i) + " = " + str(self.indicesInFlight.count(i)))
-		
-		if self.indicesInFlight.count(i) != 0:
-			self.indicesInFlight.remove(i)
+			eliminated = self.selection.select(self.fitness, evaluated, eliminateSize, 1, True)
+			self.replaceIndividual(int(eliminated[0]), child)
 
-		creature = self.individuals[i][self.CREATURE]
-		if(creature.nextFitnessLog):
-			print("Fitness=" + str(fitness) + ". " + creature.nextFitnessLog)
-		self.individuals[i][self.FITNESS] = fitness
-		
-		if self.indicesMissingFitness.count(i) != 0:
-			self.indicesMissingFitness.remove(i)
+			self.numChildrenInGeneration += 1
+			if self.numChildrenInGeneration >= self.numUnevaluated:
+				self.numChildrenInGeneration = 0
+				self.resetStatistics()
+				self.populationConfig["generation"] += 1
+				print("Proceeded to generation " + str(self.populationConfig["generation"]) + ". " + str(self.numUnevaluated) + " children created since the last one")
+
+	# Only reached when every individual has fitness, e.g. after loading a fully evaluated population
+	def proceedToNextGeneration(self):
+		self.createChildren()
+
+	def getConsistencyErrors(self):
+		errors = GeneticAlgorithm.getConsistencyErrors(self)
+		with self.lock:
+			evaluated = self.evaluated[:self.numEvaluated]
+			if set(evaluated.tolist()) != set(np.flatnonzero(~np.isnan(self.fitness)).tolist()) or len(set(evaluated.tolist())) != self.numEvaluated:
+				errors.append("evaluated does not match the individuals with fitness")
+			if any(self.evaluatedPositions[i] != position for position, i in enumerate(evaluated)):
+				errors.append("evaluatedPositions does not match evaluated")
+		return errors
 
-		self.individuals[i][self.IN_FLIGHT] = float("nan")
-		
-		
 class Trainer():	
 	def __init__(self, config):
 		def startAlgorithm():
@@ -261,27 +598,32 @@ class Trainer():
 				for creature in creatures:
 					creature["fitness"] = float("NaN")
 
+			algorithmClasses = { "GeneticAlgorithm": GeneticAlgorithm, "SteadyStateGeneticAlgorithm": SteadyStateGeneticAlgorithm, "IslandModel": IslandModel }
 			algorithmType = config["json"]["algorithm"]["type"]
-			if algorithmType == "GeneticAlgorithm":
+			if algorithmType in algorithmClasses:
 				arguments = config["json"]["algorithm"]["arguments"]
 				structure = config["json"]["structure"]
 				
 				if config["resetFitness"] and structure["creatures"]:
 					resetFitness(structure["creatures"])
 
-				self.algorithm = GeneticAlgorithm(
+				extraArguments = [arguments["islands"]] if algorithmType == "IslandModel" else []
+				self.algorithm = algorithmClasses[algorithmType](
 					arguments["population"],
 					arguments["crossover"],
 					arguments["mutation"],
 					structure,
-					{ "saveState": self.saveState })
+					{ "saveState": self.saveState },
+					*extraArguments)
 			else:
-				sys.exit("Only algorithm type 'GeneticAlgorithm' currently implemented. Got '" + algorithmType + "'");
+				sys.exit("Only algorithm types " + ", ".join("'" + name + "'" for name in algorithmClasses) + " currently implemented. Got '" + algorithmType + "'");
 
 		self.config = config
 		self.experimentId = str(uuid.uuid4())
 		self.statistics = { "accumulatedSimulatedTime": 0, "accumulatedFitness": {}, "accumulatedSimulatedCreatures": {}, "timeStamp": time.time() }
 		self.statistics["timeStamp"] = time.time()
+		self.statisticsLock = threading.Lock()	# Guards statistics, best fitness and termination. Taken before, never after, algorithm.lock
+		self.isTerminating = False
 		self.lastStatus = "...waiting..."
 
 		startAlgorithm()
@@ -290,7 +632,10 @@ class Trainer():
 		self.bestFitnessEvaluation = self.algorithm.populationConfig["evaluations"]
 
 		try:
-			self.communicator = Communicator(self.getWork, self.getWorkBatch, self.doStepBatch, self.registerResult, self.getServerStatus, self.getBestCreature)
+			communicatorClass = AsyncCommunicator if config["engine"] == "asyncio" else Communicator
+			self.communicator = communicatorClass(self.getWork, self.getWorkBatch, self.doStepBatch, self.registerResult, self.getServerStatus, self.getBestCreature, self.hello, config["host"], config["port"], self.getMetrics, config["compression"])
+			if config["localEvaluators"] > 0:
+				self.startLocalEvaluation(config["localEvaluators"], config["localEvaluatorProcesses"])	# Results use the communicator
 			self.communicator.start()
 		except KeyboardInterrupt:
 			self.saveState()
@@ -298,12 +643,53 @@ class Trainer():
 			print(e)
 			pass
 
+	# Evaluates creatures on this host with a pool of pybullet physics servers, next to any remote workers.
+	# With one process the servers are stepped one after the other by a thread of the trainer process, which saves the
+	# network hop but uses a single core. With more, the servers are spread over that many worker processes, which
+	# connect to this trainer over loopback like any other worker.
+	def startLocalEvaluation(self, numServers, numProcesses = 1):
+		try:
+			from PhysicsEvaluator import PhysicsEvaluator, runWorker
+		except ImportError as e:
+			sys.exit("--local-evaluators needs pybullet: " + str(e))
+
+		if numProcesses > 1:
+			host = "127.0.0.1" if self.config["host"] in ("", "0.0.0.0") else self.config["host"]
+			context = multiprocessing.get_context("spawn")	# Not a fork of the trainer with its threads and sockets
+			for i in range(0, numProcesses):
+				numProcessServers = numServers // numProcesses + (1 if i < numServers % numProcesses else 0)
+				if numProcessServers > 0:
+					context.Process(target=runWorker, daemon=True, args=({ "host": host, "port": self.config["port"], "servers": numProcessServers, "noWorkDelay": 0.2, "genomeCacheSize": 4096 },)).start()
+			print("Evaluating locally with " + str(numServers) + " pybullet physics servers in " + str(min(numProcesses, numServers)) + " worker processes")
+			return
+
+		def registerLocalResults(results):
+			self.registerResults(results)
+			self.getServerStatusUnserialized()	# Prints the status line, which is otherwise only updated when workers ask
+
+		evaluator = PhysicsEvaluator(numServers)
+		thread = threading.Thread(target=evaluator.run, daemon=True, args=(
+			lambda maxCount: self.getWorkBatchUnserialized({ "maxWorkUnits": maxCount })["workUnits"],
+			registerLocalResults,
+			lambda: self.isTerminating))
+		thread.start()
+		print("Evaluating locally with " + str(numServers) + " pybullet physics servers, stepped in one thread")
+
+	# Snapshots the population on the calling thread and lets the communicator decide where the slow serialization and write happens
 	def saveState(self):
 		creatures = self.algorithm.getCreaturesWithFitnessJson()
 		if(creatures != None and len(creatures)>0):
 			self.config["json"]["structure"]["creatures"] = creatures
 
-		serialized = json.dumps(self.config["json"], indent=1, separators=(',', ': '))
+		# Shallow copies of everything the algorithm keeps mutating, so writing can happen on another thread
+		state = dict(self.config["json"])
+		state["structure"] = dict(state["structure"])
+		state["algorithm"] = copy.deepcopy(state["algorithm"])
+
+		self.communicator.runBlocking(self.writeState, state)
+
+	def writeState(self, state):
+		serialized = json.dumps(state, indent=1, separators=(',', ': '))
 		#serialized = json.dumps(config["json"])
 			
 		with open(self.config["filename"], "w") as file:
@@ -314,58 +700,86 @@ class Trainer():
 		print("terminate!!")
 
 	def registerResult(self, data):
-		experimentId = data["experimentId"]
-		if experimentId != self.experimentId:
-			print("Ignoring this result since experimentId of returned result does not match current experimentId.")
-			return "FAIL"
-
-		creatureId = data["id"]
-		creature = self.algorithm.getCreature(creatureId)
-		if not creature:
-			return "FAIL"
-
-		fitness = data["maxDistance"]
-
-		#print("fitness={}".format(fitness))
-
-		simulatedTime = data["simulatedTime"]
-		currentTime = time.time()
-
-		# print(data["type"] + ": " + creatureId + ", fitness=" + str(fitness) + ", best=" + str(self.bestFitness))
-
-		if not creature.generatorType in self.statistics["accumulatedFitness"]:
-			self.statistics["accumulatedFitness"][creature.generatorType] = 0
-			self.statistics["accumulatedSimulatedCreatures"][creature.generatorType] = 0
-
-		self.statistics["accumulatedFitness"][creature.generatorType] += fitness
-		self.statistics["accumulatedSimulatedCreatures"][creature.generatorType] += 1
-		
-		self.statistics["accumulatedSimulatedTime"] += simulatedTime
-
-		self.algorithm.populationConfig["evaluations"] += 1
-		self.algorithm.setCreatureFitness(creatureId, fitness)
-		
-		if fitness > self.bestFitness or math.isnan(self.bestFitness):
-			self.bestFitness = fitness
-			self.bestFitnessEvaluation = self.algorithm.populationConfig["evaluations"]
-			print("--> new best creature found through {}! Fitness={}".format(creature.generatorType, fitness))
+		return "OK" if self.registerResults([data]) == 1 else "FAIL"
+
+	# Applies a batch of results in one pass: experimentId is checked for the batch, the algorithm updates all fitness values
+	# under a single lock, statistics are summed per generator type and termination is checked once.
+	# Returns the number of results accepted.
+	def registerResults(self, results):
+		if not results:
+			return 0
+
+		if any(result["experimentId"] != self.experimentId for result in results):
+			results = [result for result in results if result["experimentId"] == self.experimentId]
+			print("Ignoring results since experimentId of returned result does not match current experimentId.")
+
+		outcomes = self.algorithm.setCreatureFitnessBatch([(result["id"], result["maxDistance"]) for result in results], [result["simulatedTime"] for result in results])
+
+		# Sum up the batch before touching shared statistics. Fitness statistics only use the fitness the algorithm
+		# stored, not results of individuals that are still racing.
+		accepted = [i for i in range(0, len(results)) if outcomes[i][0] != None]	# Others are no longer active creatures
+		numAccepted = len(accepted)
+		if numAccepted == 0:
+			return 0
+		simulatedTimeSum = sum(results[i]["simulatedTime"] for i in accepted)
+
+		evaluated = [(offset, outcomes[i]) for offset, i in enumerate(accepted, 1) if outcomes[i][1] != None]
+		codes = np.array([GeneticAlgorithm.GENERATOR_TYPE_CODES[creature.generatorType] for offset, (creature, fitness) in evaluated], dtype=np.int64)
+		fitnesses = np.array([fitness for offset, (creature, fitness) in evaluated], dtype=np.float64)
+		numGeneratorTypes = len(GeneticAlgorithm.GENERATOR_TYPES)
+		fitnessSums = np.bincount(codes, weights=fitnesses, minlength=numGeneratorTypes)
+		counts = np.bincount(codes, minlength=numGeneratorTypes)
+		if evaluated:
+			bestEvaluationOffset, (bestCreature, bestFitness) = evaluated[int(np.argmax(np.where(np.isnan(fitnesses), -np.inf, fitnesses)))]
+
+		terminateReason = None
+		with self.statisticsLock:
+			for code in np.flatnonzero(counts):
+				generatorType = GeneticAlgorithm.GENERATOR_TYPES[code]
+				self.statistics["accumulatedFitness"][generatorType] = self.statistics["accumulatedFitness"].get(generatorType, 0) + float(fitnessSums[code])
+				self.statistics["accumulatedSimulatedCreatures"][generatorType] = self.statistics["accumulatedSimulatedCreatures"].get(generatorType, 0) + int(counts[code])
+			
+			self.statistics["accumulatedSimulatedTime"] += simulatedTimeSum
 
-		if self.config["terminateEvaluations"] and self.algorithm.populationConfig["evaluations"] >= self.config["terminateEvaluations"]:
-			print("Exiting since max number of fitness evaluations has been performed. terminate-evaluations={}.".format(self.config["terminateEvaluations"]))
-			self.saveState()
-			self.communicator.stop()
-		
-		if self.config["terminateStallEvaluations"] and self.algorithm.populationConfig["evaluations"] - self.bestFitnessEvaluation >= self.config["terminateStallEvaluations"]:
-			print("Exiting since no new best creature has been found for terminate-stall-evaluations={}.".format(self.config["terminateStallEvaluations"]))
+			evaluationsBefore = self.algorithm.populationConfig["evaluations"]
+			self.algorithm.populationConfig["evaluations"] += numAccepted
+			evaluations = self.algorithm.populationConfig["evaluations"]
+			
+			if evaluated and (bestFitness > self.bestFitness or math.isnan(self.bestFitness)):
+				self.bestFitness = bestFitness
+				self.bestFitnessEvaluation = evaluationsBefore + bestEvaluationOffset
+				print("--> new best creature found through {}! Fitness={}".format(bestCreature.generatorType, bestFitness))
+
+			if not self.isTerminating:
+				if self.config["terminateEvaluations"] and evaluations >= self.config["terminateEvaluations"]:
+					terminateReason = "Exiting since max number of fitness evaluations has been performed. terminate-evaluations={}.".format(self.config["terminateEvaluations"])
+				elif self.config["terminateStallEvaluations"] and evaluations - self.bestFitnessEvaluation >= self.config["terminateStallEvaluations"]:
+					terminateReason = "Exiting since no new best creature has been found for terminate-stall-evaluations={}.".format(self.config["terminateStallEvaluations"])
+				self.isTerminating = terminateReason != None
+
+		# Only the thread that flipped isTerminating saves and stops
+		if terminateReason:
+			print(terminateReason)
 			self.saveState()
 			self.communicator.stop()
 
-		return "OK"		# Notify client request handled successfully
+		return numAccepted
 
 	def getServerStatus(self):
 		return json.dumps(self.getServerStatusUnserialized())
+
+	# Request metrics of the communicator plus the state of work in flight, for finding where trainer time goes under load
+	def getMetrics(self):
+		metrics = self.communicator.metrics.getJson()
+		metrics["algorithm"] = self.algorithm.getInFlightMetrics()
+		return json.dumps(metrics)
 	
 	def getServerStatusUnserialized(self):
+		with self.statisticsLock:
+			return self.updateServerStatus()
+
+	# Must be called with self.statisticsLock held
+	def updateServerStatus(self):
 		# This code only works where there is a single client (can have multiple worker threads)
 		currentTime = time.time()
 		deltaTime = currentTime - self.statistics["timeStamp"]
@@ -384,6 +798,9 @@ class Trainer():
 			#self.lastStatus = time.strftime("%H:%M:%S: ") + "{0:.0f}x RT, {1:.1f} creatures/sec  avg fitness={2:.1f}  best fitness={3:.1f}".format(self.statistics["accumulatedSimulatedTime"]/deltaTime, accumulatedSimulatedCreatures/deltaTime, averageFitness, self.bestFitness)
 			self.lastStatus = time.strftime("%H:%M:%S: ") + "{:.0f}x RT, {:.1f} creatures/sec. Fitness: best={:.1f}, avg={:.1f}, new=({:s})".format(self.statistics["accumulatedSimulatedTime"]/deltaTime, accumulatedSimulatedCreatures/deltaTime, self.bestFitness, self.algorithm.getAverageFitness(), generatorTypeStatus)
 			self.lastStatus = self.lastStatus + ". " + self.algorithm.getStatus()
+			compressionStatus = self.communicator.metrics.getCompressionStatus()
+			if compressionStatus:
+				self.lastStatus = self.lastStatus + ". zlib: " + compressionStatus
 
 			for key in self.statistics["accumulatedFitness"].copy():
 				self.statistics["accumulatedFitness"].pop(key, None)
@@ -396,41 +813,36 @@ class Trainer():
 
 		return { "status": self.lastStatus }
 
-	def getBestCreature(self):
-		return self.getWork(True)
+	def getBestCreature(self, session = None):
+		return self.getWork(True, session)
 
-	def doStepBatch(self, data):
+	# Negotiates session capabilities. data: { "genomeCache": { "size": maxGenomes, "hashes": [genomeHashes already held, least recently used first] } }
+	def hello(self, data, session):
+		response = helloGenomeCache(data, session)
+		response.update(helloCompression(data, session))
+		return json.dumps(response)
+
+	def doStepBatch(self, data, session = None):
 		maxNewWorkUnits = data["maxWorkUnits"]
-		index = 0
-		while index < len(data["results"]) and not self.communicator.isStopped:
-			result = data["results"][index]
-			self.registerResult(result)	
-			index += 1
+		if not self.communicator.isStopped:
+			self.registerResults(data["results"])
 
-		response = self.getWorkBatchUnserialized(data)
+		response = self.getWorkBatchUnserialized(data, session)
 		response["status"] = self.getServerStatusUnserialized()["status"]
 
 		return json.dumps(response)
 
-	def getWorkBatch(self, data):
-		return json.dumps(getWorkBatchUnserialized(data))
+	def getWorkBatch(self, data, session = None):
+		return json.dumps(self.getWorkBatchUnserialized(data, session))
 
-	def getWorkBatchUnserialized(self, data):
-		remaining = data["maxWorkUnits"]
-		workUnits = []
-		noWork = False
-		
-		while not noWork and remaining > 0:
-			work = self.getWorkUnserialized(False)
-			if work["status"] == "NO_WORK":
-				noWork = True
-			else:
-				workUnits.append(work)
-				remaining -= 1
+	# The population is maintained once and the whole batch taken from the ready queue under a single lock
+	def getWorkBatchUnserialized(self, data, session = None):
+		self.algorithm.maintainPopulation()
+		creatures = self.algorithm.getForFitnessBatch(data["maxWorkUnits"])
 
-		return { "workUnits": workUnits }
+		return { "workUnits": [self.createWork(creature, session, creature.evaluationDuration) for creature in creatures] }
 
-	def getWorkUnserialized(self, getBestForPlayback):
+	def getWorkUnserialized(self, getBestForPlayback, session = None):
 		if getBestForPlayback:
 			creature = self.algorithm.getBestCreature()
 		else:
@@ -438,16 +850,24 @@ class Trainer():
 			creature = self.algorithm.getForFitness()
 
 		if creature :
-			taskJson = { "name": "MOVE_FAR", "id": creature.id, "experimentId": self.experimentId }
-			work = { "status": "OK", "task": taskJson, "creature": creature.getJson() }
+			work = self.createWork(creature, session, None if getBestForPlayback else creature.evaluationDuration)
 		else:
 			work = { "status": "NO_WORK" }
 		
 		return work
 
+	# duration: simulated seconds to evaluate for, None for the worker default. Taken from creature.evaluationDuration
+	# right after the creature was handed out, since the creature keeps it until it is handed out again.
+	def createWork(self, creature, session, duration = None):
+		taskJson = { "name": "MOVE_FAR", "id": creature.id, "experimentId": self.experimentId }
+		if duration:
+			taskJson["duration"] = duration
+		work = { "status": "OK", "task": taskJson }
+		addCreatureToWork(work, creature, session)
+		return work
 
-	def getWork(self, getBestForPlayback = False):
-		return json.dumps(self.getWorkUnserialized(getBestForPlayback))
+	def getWork(self, getBestForPlayback = False, session = None):
+		return json.dumps(self.getWorkUnserialized(getBestForPlayback, session))
 
 def getJson():
 	def parseCommandLineArguments():
@@ -458,6 +878,13 @@ def getJson():
 		parser.add_argument("--terminate-evaluations", type=int, help="terminate after this many fitness evaluations have been performed. if not specified, never terminate.")
 		parser.add_argument("--terminate-stall-evaluations", type=int, help="terminate after this many fitness evaluations that didn't cause the best fitness to improve. if not specified, never terminate.")
 		parser.add_argument("--result-filename", help="If specified, append the result of the simulation to csv file specified here. Default: Do not write results to file.")
+		parser.add_argument("--host", default="127.0.0.1", help="address to listen on for workers and relays. use 0.0.0.0 to serve other hosts. default: 127.0.0.1")
+		parser.add_argument("--port", type=int, default=9999, help="port to listen on. default: 9999")
+		parser.add_argument("--compression-level", type=int, default=6, choices=range(0, 10), help="zlib level offered to framed workers that ask for compression, 0 disables compression. default: 6")
+		parser.add_argument("--compression-threshold", type=int, default=16384, help="only compress messages of at least this many bytes. default: 16384")
+		parser.add_argument("--local-evaluators", type=int, default=0, help="number of pybullet physics servers evaluating creatures in the trainer process, in addition to remote workers. needs pybullet. default: 0")
+		parser.add_argument("--local-evaluator-processes", type=int, default=1, help="processes the local physics servers are spread over. with more than one, each is a worker connecting to this trainer over loopback, so evaluation uses that many cores. default: 1")
+		parser.add_argument("--engine", choices=["threading", "asyncio"], default="threading", help="server engine: a thread per connection (threading) or a single asyncio event loop (asyncio). default: threading")
 		
 		return parser.parse_args()
 
@@ -467,7 +894,8 @@ def getJson():
 	resetFitness = True if args.resetFitness else False
 
 	with open(filename) as file:
-		return {"resultFilename": args.result_filename, "terminateEvaluations": args.terminate_evaluations, "terminateStallEvaluations": args.terminate_stall_evaluations, "filename": filename, "json": json.load(file), "resetFitness": resetFitness}
+		return {"resultFilename": args.result_filename, "terminateEvaluations": args.terminate_evaluations, "terminateStallEvaluations": args.terminate_stall_evaluations, "filename": filename, "json": json.load(file), "resetFitness": resetFitness, "engine": args.engine, "localEvaluators": args.local_evaluators, "localEvaluatorProcesses": args.local_evaluator_processes, "host": args.host, "port": args.port,
+			"compression": { "level": args.compression_level, "threshold": args.compression_threshold } if args.compression_level > 0 else None}
 
 def writeResult(trainer, filename):
 	generator = config["json"]["structure"]["generator"]
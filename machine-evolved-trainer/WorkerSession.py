@@ -0,0 +1,143 @@
+from Communicator import receiveFrame, encodeFrame, compressBody, decompressBody, FRAME_HEADER, ProtocolError
+from Genome import GenomeCache, decodeGenome, decodeGenomeText, applyGenomeDelta, getGenomeHash
+from collections import deque
+import socket
+import json
+
+# Client side of a persistent framed session with the trainer.
+# One connection is kept open for all requests. Requests can be pipelined with send() and their responses
+# collected in order with receive(), or sent one at a time with request().
+class WorkerSession():
+	def __init__(self, host = "127.0.0.1", port = 9999):
+		self.host = host
+		self.port = port
+		self.socket = None
+		self.headerBuffer = bytearray(FRAME_HEADER.size)
+		self.pendingTypes = deque()	# Message types of requests sent but not yet answered, oldest first
+		self.genomeCache = None		# (genome, decoded creature json) by genome hash, kept across reconnects
+		self.compression = None		# Compression settings negotiated in HELLO, per connection
+
+	def connect(self):
+		self.socket = socket.create_connection((self.host, self.port))
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def close(self):
+		if self.socket:
+			self.socket.close()
+			self.socket = None
+		self.pendingTypes.clear()
+		self.compression = None
+
+	def getNumPending(self):
+		return len(self.pendingTypes)
+
+	# Queues a request on the connection without waiting for its response
+	def send(self, messageType, data = None):
+		if not self.socket:
+			self.connect()
+		self.socket.sendall(self.encodeRequest(messageType, data))
+		self.pendingTypes.append(messageType)
+
+	# Sends several requests (list of (messageType, data)) in a single write
+	def sendMany(self, requests):
+		if not self.socket:
+			self.connect()
+		self.socket.sendall(b"".join([self.encodeRequest(messageType, data) for messageType, data in requests]))
+		for messageType, data in requests:
+			self.pendingTypes.append(messageType)
+
+	def encodeRequest(self, messageType, data):
+		body = json.dumps(data).encode("utf-8") if data is not None else b""
+		body, flags = compressBody(body, self.compression)
+		return encodeFrame(messageType, body, flags)
+
+	# Returns the raw response body (str) of the oldest pending request
+	def receive(self):
+		if not self.pendingTypes:
+			raise ProtocolError("No pending request to receive a response for")
+
+		frame = receiveFrame(self.socket, self.headerBuffer)
+		if frame == None:
+			self.close()
+			raise ProtocolError("Trainer closed the session")
+
+		messageType, flags, body = frame
+		expectedType = self.pendingTypes.popleft()
+		if messageType != expectedType:
+			raise ProtocolError("Expected response to " + expectedType + ", got " + messageType)
+
+		return decompressBody(body, flags).decode("utf-8")
+
+	# Sends a request and blocks until its response arrives. Any earlier pipelined responses must have been received first.
+	def request(self, messageType, data = None):
+		self.send(messageType, data)
+		return self.receive()
+
+	def requestJson(self, messageType, data = None):
+		self.send(messageType, data)
+		return self.receiveJson()
+
+	# Returns the decoded json response of the oldest pending request, with creature json filled in for work units that only carry a genome hash
+	def receiveJson(self):
+		response = json.loads(self.receive())
+		if self.genomeCache != None:
+			if "workUnits" in response:
+				for work in response["workUnits"]:
+					self.resolveCreature(work)
+			elif "genomeHash" in response:
+				self.resolveCreature(response)
+		return response
+
+	# Work units must be resolved in the order they were received, since the trainer mirrors the cache from that order.
+	# Sets work["creature"] and keeps the binary genome in work["binaryGenome"], which later work units of the same
+	# response may already have evicted from the cache.
+	def resolveCreature(self, work):
+		if not "genomeHash" in work:
+			return
+
+		genomeHash = work["genomeHash"]
+		if "genome" in work:
+			genome = decodeGenomeText(work.pop("genome"))
+		elif "genomeDelta" in work:
+			genomeDelta = work.pop("genomeDelta")
+			parent = self.genomeCache.get(genomeDelta["parent"])
+			if parent == None:
+				raise ProtocolError("Trainer assumed parent genome " + genomeDelta["parent"] + " is cached, but it isn't")
+			genome = applyGenomeDelta(parent[0], genomeDelta)
+			if getGenomeHash(genome) != genomeHash:
+				raise ProtocolError("Genome delta for " + genomeHash + " does not reproduce the genome")
+		else:
+			cached = self.genomeCache.get(genomeHash)
+			if cached == None:
+				raise ProtocolError("Trainer assumed genome " + genomeHash + " is cached, but it isn't")
+			work["creature"] = cached[1]
+			work["binaryGenome"] = cached[0]
+			return
+
+		creatureJson = decodeGenome(genome)
+		self.genomeCache.add(genomeHash, (genome, creatureJson))
+		work["creature"] = creatureJson
+		work["binaryGenome"] = genome
+
+	# Negotiates session capabilities. Must be the first request, and is needed again after reconnecting.
+	# With compression, large messages are zlib compressed in both directions if the trainer offers it.
+	def hello(self, genomeCacheSize = 0, compression = False):
+		data = {}
+		if genomeCacheSize > 0:
+			if self.genomeCache == None:
+				self.genomeCache = GenomeCache(genomeCacheSize)
+			data["genomeCache"] = { "size": genomeCacheSize, "hashes": self.genomeCache.getHashes() }
+		if compression:
+			data["compression"] = { "algorithms": ["zlib"] }
+		response = self.requestJson("HELLO", data)
+		self.compression = response.get("compression")
+		return response
+
+	def getWorkBatch(self, maxWorkUnits):
+		return self.requestJson("GET_WORK_BATCH", { "maxWorkUnits": maxWorkUnits })
+
+	def doStepBatch(self, results, maxWorkUnits):
+		return self.requestJson("STEP_BATCH", { "results": results, "maxWorkUnits": maxWorkUnits })
+
+	def getMetrics(self):
+		return self.requestJson("GET_METRICS")
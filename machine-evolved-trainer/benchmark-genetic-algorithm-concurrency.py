@@ -0,0 +1,123 @@
+# Stress test of the GeneticAlgorithm work dispatch bookkeeping under concurrent access.
+#
+# Many threads act like request handler threads: they fetch work the same way Trainer.getWorkBatchUnserialized does and
+# register random fitness results for it. Some work is dropped (lost workers) and some results arrive late, after
+# their creature was given up or replaced. A checker thread verifies the bookkeeping invariants while the
+# population keeps rolling over generations, and once more when all threads are done.
+#
+# Prints the request rate reached and exits with status 1 if any invariant was broken or a thread got stuck.
+
+import argparse
+import random
+import sys
+import threading
+import time
+from Trainer import GeneticAlgorithm, SteadyStateGeneticAlgorithm
+
+GENERATOR = {
+	"numCapsules": 3,
+	"capsuleInnerHeightRange": "5-20",
+	"capsuleRadiusRange": "2-5",
+	"feedbacks": 1,
+	"oscillators": { "start": 0.5, "multiplier": 2, "count": 2 },
+	"motors": { "x-rotation": { "range": "-0.5:0.5" }, "y-rotation": { "range": "-0.5:0.5" } },
+	"inputs": { "root-orientation-x": 1, "root-orientation-y": 1, "root-orientation-z": 1, "root-orientation-w": 1, "z-position": 1, "velocity-x": 1, "velocity-y": 1, "velocity-z": 1, "oscillators": 1,
+		"capsule-position-x": 0, "capsule-position-y": 0, "capsule-position-z": 1, "capsule-velocity-x": 0, "capsule-velocity-y": 0, "capsule-velocity-z": 0,
+		"capsule-angular-velocity-x": 0, "capsule-angular-velocity-y": 0, "capsule-angular-velocity-z": 0, "motor-angle-x": 1, "motor-angle-y": 1, "motor-angle-z": 1, "feedbacks": 1 },
+	"motorController": { "layers": [{ "activation": "tanh", "neurons": 8 }, { "activation": "linear" }] }
+}
+
+def createAlgorithm(populationSize, algorithmClass):
+	population = { "size": populationSize, "generation": 0, "evaluations": 0 }
+	crossover = { "rate": 0.2, "competitionSize": { "reproduce": 3, "eliminate": 3 }, "numParameterChangedRatioRange": "0.1-0.5", "changeRatioRange": "0.1-0.9" }
+	mutation = { "rate": 0.2, "competitionSize": { "reproduce": 3, "eliminate": 3 }, "config": { "numParameterChangedRatioRange": "0.01-0.1", "offsetRange": "0.1;1", "offsetExponent": 2, "randomizeSign": "yes" } }
+	structure = { "creatures": [], "generator": GENERATOR }
+	return algorithmClass(population, crossover, mutation, structure, { "saveState": lambda: None })
+
+def execute():
+	parser = argparse.ArgumentParser(description="Stress test of concurrent GeneticAlgorithm work dispatch.")
+	parser.add_argument("--threads", type=int, default=32, help="number of concurrent handler threads (default: 32)")
+	parser.add_argument("--seconds", type=float, default=10, help="duration of the test (default: 10)")
+	parser.add_argument("--population", type=int, default=500, help="population size (default: 500)")
+	parser.add_argument("--batch", type=int, default=8, help="work units fetched per request (default: 8)")
+	parser.add_argument("--lost-ratio", type=float, default=0.001, help="ratio of work units never returned (default: 0.001)")
+	parser.add_argument("--algorithm", choices=["GeneticAlgorithm", "SteadyStateGeneticAlgorithm"], default="GeneticAlgorithm", help="algorithm type (default: GeneticAlgorithm)")
+	parser.add_argument("--late-ratio", type=float, default=0.01, help="ratio of work units returned late (default: 0.01)")
+	args = parser.parse_args()
+
+	algorithm = createAlgorithm(args.population, GeneticAlgorithm if args.algorithm == "GeneticAlgorithm" else SteadyStateGeneticAlgorithm)
+	isRunning = True
+	counters = { "requests": 0, "workUnits": 0, "results": 0, "lost": 0, "late": 0 }
+	countersLock = threading.Lock()
+	errors = []
+
+	def handlerThread():
+		requests = 0
+		workUnits = 0
+		results = 0
+		lost = 0
+		late = 0
+		previousLateIds = []
+		while isRunning:
+			lateIds = []
+			algorithm.maintainPopulation()
+			creatures = algorithm.getForFitnessBatch(args.batch)
+			for creature in creatures:
+				creature.getJson()
+			requests += 1
+			workUnits += len(creatures)
+
+			for creature in creatures:
+				r = random.random()
+				if r < args.lost_ratio:
+					lost += 1	# Worker died, result never arrives
+				elif r < args.lost_ratio + args.late_ratio:
+					lateIds.append(creature.id)	# Arrives later, probably after being given up
+				else:
+					algorithm.setCreatureFitness(creature.id, random.gauss(10, 3))
+					results += 1
+
+			# Late results from the previous request
+			for creatureId in previousLateIds:
+				algorithm.setCreatureFitness(creatureId, random.gauss(10, 3))
+				late += 1
+			previousLateIds = lateIds
+
+		with countersLock:
+			counters["requests"] += requests
+			counters["workUnits"] += workUnits
+			counters["results"] += results
+			counters["lost"] += lost
+			counters["late"] += late
+
+	def checkerThread():
+		while isRunning:
+			errors.extend(algorithm.getConsistencyErrors())
+			time.sleep(0.1)
+
+	threads = [threading.Thread(target=handlerThread, daemon=True) for i in range(args.threads)]
+	threads.append(threading.Thread(target=checkerThread, daemon=True))
+	startTime = time.time()
+	for thread in threads:
+		thread.start()
+	time.sleep(args.seconds)
+	isRunning = False
+	for thread in threads:
+		thread.join(timeout=30)
+		if thread.is_alive():
+			print("STALLED: a thread did not finish within 30 seconds of the end of the test. Corrupted state can make selection loop forever.")
+			sys.exit(1)
+	deltaTime = time.time() - startTime
+
+	errors.extend(algorithm.getConsistencyErrors())
+
+	print("{} threads, population {}: {:.0f} requests/sec, {:.0f} work units/sec, {:.0f} results/sec, {} lost, {} late, {} generations".format(
+		args.threads, args.population, counters["requests"]/deltaTime, counters["workUnits"]/deltaTime, counters["results"]/deltaTime, counters["lost"], counters["late"], algorithm.populationConfig["generation"]))
+
+	if errors:
+		print("INCONSISTENT: " + str(len(errors)) + " invariant violations, first: " + errors[0])
+		sys.exit(1)
+	print("Consistent.")
+
+if __name__ == "__main__":
+	execute()
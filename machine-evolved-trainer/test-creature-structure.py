@@ -1,13 +1,25 @@
 # A simple test for CreatureStructure
 
 from CreatureStructure import CreatureStructure, CAPSULE
+import json
 
-capsule = CAPSULE(100, 50, 11.725204, 16.815704, 259.013641, 0.623920, -0.739164, -0.121800, 0.222544, None)
+inputs = { "root-orientation-x": 1, "root-orientation-y": 1, "root-orientation-z": 1, "root-orientation-w": 1, "z-position": 1, "velocity-x": 1, "velocity-y": 1, "velocity-z": 1, "oscillators": 1,
+	"capsule-position-x": 1, "capsule-position-y": 0, "capsule-position-z": 1, "capsule-velocity-x": 0, "capsule-velocity-y": 0, "capsule-velocity-z": 1,
+	"capsule-angular-velocity-x": 0, "capsule-angular-velocity-y": 0, "capsule-angular-velocity-z": 0, "motor-angle-x": 1, "motor-angle-y": 0, "motor-angle-z": 1, "feedbacks": 1 }
+motors = { "x-rotation": { "range": "-0.5;0.5" }, "z-rotation": { "range": "-0.25;0.25" } }
+
+capsule = CAPSULE("root", 100, 50, 11.725204, 16.815704, 259.013641, 0.623920, -0.739164, -0.121800, 0.222544, None)
 structure = CreatureStructure()
+structure.setInputs(inputs)
+structure.setNumFeedbacks(2)
+structure.setOscillatorStart(0.5)
+structure.setOscillatorMultiplier(2)
+structure.setOscillatorCount(3)
 structure.addCapsule(capsule)
-structure.addCapsuleWithConstraint(200, 100, capsule)
+child = structure.addCapsuleWithConstraint(200, 100, capsule, motors)
+structure.addCapsuleChainWithConstraint([50, 60], [10, 20], child, motors)
 
-structureCopy = CreatureStructure(structure.serialize())
+structureCopy = CreatureStructure(json.loads(structure.serialize()))
 
 print("numConstraints = " + str(structure.getNumConstraints()))
 print("numMotors = " + str(structure.getNumOutputs()))
@@ -15,3 +27,7 @@ print("stateSize = " + str(structure.getNumInputs()))
 print("----")
 print("structure:" + structure.serialize())
 print("structureCopy:" + structureCopy.serialize())
+
+# 8 creature + 3 oscillators + 4 capsules*3 + 3 constraints*2 motor angles + 2 feedbacks, 3 constraints*2 motors + 2 feedbacks
+isOk = structure.getNumConstraints() == 3 and structure.getNumOutputs() == 8 and structure.getNumInputs() == 31 and structure.serialize() == structureCopy.serialize()
+print("OK" if isOk else "FAILED")
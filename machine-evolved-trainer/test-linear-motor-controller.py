@@ -0,0 +1,96 @@
+# Checks the batched LinearMotorController forward pass against a line by line port of MachineWorker
+# LinearMotorController::multiplyMatrix, and measures its throughput. Also checks that controllers loaded from genome v1
+# json (one bias per weight) evaluate the same as MachineWorker evaluated them before genome v2.
+
+from LinearMotorController import LinearMotorController, getMotorForcesBatch
+from Creature import Creature
+import numpy as np
+import argparse
+import json
+import time
+
+# Same loops and float32 arithmetic as the C++ code, one bias per output
+def multiplyMatrix(inputVector, matrix, biases, activation):
+	inputSize = len(inputVector)
+	outputSize = len(matrix) // inputSize
+	outputVector = [np.float32(biases[i]) for i in range(0, outputSize)]
+	for i in range(0, outputSize):
+		for j in range(0, inputSize):
+			outputVector[i] += inputVector[j] * np.float32(matrix[i*inputSize + j])
+
+	if activation == "tanh":
+		outputVector = [np.tanh(value) for value in outputVector]
+	return outputVector
+
+# The C++ code before genome v2, one bias per weight
+def multiplyMatrixV1(inputVector, matrix, biases, activation):
+	inputSize = len(inputVector)
+	outputSize = len(matrix) // inputSize
+	outputVector = [np.float32(0)]*outputSize
+	for i in range(0, outputSize):
+		for j in range(0, inputSize):
+			outputVector[i] += inputVector[j] * np.float32(matrix[i*inputSize + j]) + np.float32(biases[i*inputSize + j])
+
+	if activation == "tanh":
+		outputVector = [np.tanh(value) for value in outputVector]
+	return outputVector
+
+def getMotorForces(controllerJson, creatureState, multiply = multiplyMatrix):
+	currentValue = [np.float32(value) for value in creatureState]
+	for layer in controllerJson["layers"]:
+		currentValue = multiply(currentValue, layer["weights"], layer["biases"], layer["activation"])
+	return np.array(currentValue, dtype=np.float32)
+
+# Controller json in genome v1 layout: every bias spread over numInputs random parts
+def getJsonV1(controllerJson, numInputs):
+	rng = np.random.default_rng()
+	layers = []
+	for layer in controllerJson["layers"]:
+		biases = []
+		for bias in layer["biases"]:
+			parts = rng.standard_normal(numInputs)
+			parts[-1] = bias - parts[:-1].sum()
+			biases += parts.tolist()
+		layers.append({ "activation": layer["activation"], "weights": layer["weights"], "biases": biases })
+		numInputs = len(layer["biases"])
+	return { "name": "LinearMotorController", "layers": layers }
+
+parser = argparse.ArgumentParser(description="Test of the batched LinearMotorController forward pass.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("config", help="trainer config file, creatures are created with its generator")
+parser.add_argument("--creatures", type=int, default=200, help="number of creatures in the batch")
+parser.add_argument("--states", type=int, default=64, help="number of creature states per creature")
+args = parser.parse_args()
+
+generatorJson = json.load(open(args.config))["structure"]["generator"]
+creatures = [Creature(None, generatorJson) for i in range(0, args.creatures)]
+controllers = [creature.motorController for creature in creatures]
+states = np.random.default_rng().standard_normal((args.states, controllers[0].numInputs)).astype(np.float32)
+
+startTime = time.time()
+forces = getMotorForcesBatch(controllers, states)
+deltaTime = time.time() - startTime
+print("{} creatures x {} states: {:.0f} forward passes/sec".format(args.creatures, args.states, args.creatures*args.states/deltaTime))
+
+maxError = 0
+for i in range(0, min(args.creatures, 5)):
+	controllerJson = controllers[i].getJson()
+	for j in range(0, min(args.states, 4)):
+		expected = getMotorForces(controllerJson, states[j])
+		maxError = max(maxError, float(np.max(np.abs(forces[i, j] - expected)/np.maximum(1, np.abs(expected)))))
+		if not np.allclose(controllers[i].getMotorForces(states[j]), forces[i, j], rtol=1e-4, atol=1e-5):
+			print("Single controller forward pass differs from the batch")
+
+maxErrorV1 = 0
+for i in range(0, min(args.creatures, 5)):
+	controllerJsonV1 = getJsonV1(controllers[i].getJson(), controllers[i].numInputs)
+	controller = LinearMotorController(controllers[i].numInputs, controllers[i].numOutputs, controllerJsonV1)
+	if len(controller.parameters) != len(controllers[i].parameters):
+		print("Genome v1 biases were not folded")
+		maxErrorV1 = float("inf")
+	for j in range(0, min(args.states, 4)):
+		expected = getMotorForces(controllerJsonV1, states[j], multiplyMatrixV1)
+		maxErrorV1 = max(maxErrorV1, float(np.max(np.abs(controller.getMotorForces(states[j]) - expected)/np.maximum(1, np.abs(expected)))))
+
+print("Max relative difference to the C++ port: " + str(maxError))
+print("Max relative difference of folded genome v1 controllers to the C++ port before v2: " + str(maxErrorV1))
+print("OK" if maxError < 1e-4 and maxErrorV1 < 1e-4 else "FAILED")
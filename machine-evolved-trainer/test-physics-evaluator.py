@@ -0,0 +1,70 @@
+# Smoke test of PhysicsEvaluator: loads generated creatures into pybullet, checks that every capsule and every motor
+# was found in the loaded model and simulates them for a short duration. Also checks that a work unit that fails to
+# load is skipped without stopping the evaluator.
+
+from PhysicsEvaluator import PhysicsEvaluator, getJointName, TICKS_PER_SECOND
+from Creature import Creature
+import argparse
+import copy
+
+GENERATOR = {
+	"numCapsules": 4,
+	"capsuleInnerHeightRange": "5-20",
+	"capsuleRadiusRange": "2-5",
+	"feedbacks": 1,
+	"oscillators": { "start": 0.5, "multiplier": 2, "count": 2 },
+	"motors": { "x-rotation": { "range": "-0.5;0.5" }, "y-rotation": { "range": "-0.25;0.25" }, "z-rotation": { "range": "-0.5;0.5" } },
+	"inputs": { "root-orientation-x": 1, "root-orientation-y": 1, "root-orientation-z": 1, "root-orientation-w": 1, "z-position": 1, "velocity-x": 1, "velocity-y": 1, "velocity-z": 1, "oscillators": 1,
+		"capsule-position-x": 1, "capsule-position-y": 1, "capsule-position-z": 1, "capsule-velocity-x": 1, "capsule-velocity-y": 1, "capsule-velocity-z": 1,
+		"capsule-angular-velocity-x": 1, "capsule-angular-velocity-y": 1, "capsule-angular-velocity-z": 1, "motor-angle-x": 1, "motor-angle-y": 1, "motor-angle-z": 1, "feedbacks": 1 },
+	"motorController": { "layers": [{ "activation": "tanh", "neurons": 8 }, { "activation": "linear" }] }
+}
+
+parser = argparse.ArgumentParser(description="Smoke test of PhysicsEvaluator.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--creatures", type=int, default=8, help="number of generated creatures")
+parser.add_argument("--servers", type=int, default=4, help="number of pybullet physics servers")
+parser.add_argument("--duration", type=float, default=2, help="simulated seconds per creature")
+args = parser.parse_args()
+
+creatures = [Creature(None, GENERATOR) for i in range(0, args.creatures)]
+workUnits = [{ "status": "OK", "task": { "name": "MOVE_FAR", "id": creature.id, "experimentId": "test", "duration": args.duration }, "creature": creature.getJson() } for creature in creatures]
+isOk = True
+
+evaluator = PhysicsEvaluator(args.servers)
+server = evaluator.servers[0]
+for creature in creatures:
+	capsuleLinks, jointsByName = evaluator.loadModel(server, creature.structure)
+	if sorted(capsuleLinks) != list(range(0, creature.structure.getNumCapsules())):
+		print("Capsules " + str(sorted(capsuleLinks)) + " found for " + str(creature.structure.getNumCapsules()) + " capsules")
+		isOk = False
+	missingJoints = [getJointName(capsuleIndex, axisIndex) for capsuleIndex, axisIndex in creature.structure.getLayout()["motors"] if not getJointName(capsuleIndex, axisIndex) in jointsByName]
+	if missingJoints:
+		print("Motors without a joint: " + ", ".join(missingJoints))
+		isOk = False
+
+# A broken work unit in the middle of the queue
+brokenWork = copy.deepcopy(workUnits[0])
+brokenWork["task"]["id"] = "broken"
+brokenWork["creature"]["motorController"]["layers"][0]["weights"] = brokenWork["creature"]["motorController"]["layers"][0]["weights"][:-1]
+queue = workUnits[:len(workUnits)//2] + [brokenWork] + workUnits[len(workUnits)//2:]
+results = []
+
+def getWork(maxCount):
+	work = queue[:maxCount]
+	del queue[:maxCount]
+	return work
+
+evaluator.run(getWork, results.extend, lambda: len(results) >= len(workUnits) or (not queue and not any(server["simulation"] for server in evaluator.servers)), 0)
+evaluator.close()
+
+expectedTime = int(args.duration*TICKS_PER_SECOND)/TICKS_PER_SECOND
+resultIds = [result["id"] for result in results]
+if sorted(resultIds) != sorted(creature.id for creature in creatures):
+	print("Got " + str(len(results)) + " results for " + str(len(creatures)) + " creatures")
+	isOk = False
+for result in results:
+	print("{}: maxDistance={:.3f} simulatedTime={}".format(result["id"], result["maxDistance"], result["simulatedTime"]))
+	if result["simulatedTime"] != expectedTime or not result["maxDistance"] >= 0:
+		isOk = False
+
+print("OK" if isOk else "FAILED")
@@ -0,0 +1,150 @@
+# Runs a trainer and several relays on loopback and drives them with simulated workers.
+#
+# The trainer listens on --port, relay i on --port+1+i. Each relay gets framed workers (with a genome cache, using
+# STEP_BATCH) and legacy workers (json over a new connection per request, like MachineWorker), which return a random
+# fitness for every work unit. The trainer is started with --terminate-evaluations, so the test ends when enough
+# results have made it through the relays.
+#
+# The config file is copied first, the trainer saves its state to the copy.
+#
+# Exits with status 1 if the trainer doesn't terminate in time.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from WorkerSession import WorkerSession
+
+def createResult(task):
+	return { "id": task["id"], "experimentId": task["experimentId"], "maxDistance": random.gauss(10, 3), "simulatedTime": 10 }
+
+def legacyRequest(port, request):
+	connection = socket.create_connection(("127.0.0.1", port))
+	try:
+		connection.sendall(json.dumps(request).encode("utf-8"))
+		if request["type"] == "RESULT":
+			return None
+		blocks = []
+		block = connection.recv(65536)
+		while block:
+			blocks.append(block)
+			block = connection.recv(65536)
+		return json.loads(b"".join(blocks))
+	finally:
+		connection.close()
+
+def execute():
+	parser = argparse.ArgumentParser(description="Loopback test of trainer + relays + simulated workers.")
+	parser.add_argument("config", help="trainer config json")
+	parser.add_argument("--port", type=int, default=9990, help="trainer port, relays use the following ports (default: 9990)")
+	parser.add_argument("--relays", type=int, default=3, help="number of relay processes (default: 3)")
+	parser.add_argument("--framed-workers", type=int, default=2, help="framed workers per relay (default: 2)")
+	parser.add_argument("--legacy-workers", type=int, default=1, help="legacy workers per relay (default: 1)")
+	parser.add_argument("--batch", type=int, default=16, help="work units per framed worker request (default: 16)")
+	parser.add_argument("--evaluations", type=int, default=5000, help="terminate-evaluations of the trainer (default: 5000)")
+	parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the trainer to terminate (default: 120)")
+	args = parser.parse_args()
+
+	directory = tempfile.mkdtemp()
+	configFilename = os.path.join(directory, "config.json")
+	shutil.copyfile(args.config, configFilename)
+
+	processes = []
+	counters = { "workUnits": 0, "results": 0, "errors": 0 }
+	countersLock = threading.Lock()
+	isRunning = True
+
+	def framedWorker(port):
+		session = WorkerSession("127.0.0.1", port)
+		results = []
+		while isRunning:
+			try:
+				if session.socket == None:
+					session.hello(1024)
+				response = session.doStepBatch(results, args.batch)
+			except (OSError, ValueError):
+				session.close()
+				with countersLock:
+					counters["errors"] += 1
+				time.sleep(0.2)
+				continue
+			with countersLock:
+				counters["workUnits"] += len(response["workUnits"])
+				counters["results"] += len(results)
+			results = [createResult(work["task"]) for work in response["workUnits"]]
+			if not results:
+				time.sleep(0.05)
+		session.close()
+
+	def legacyWorker(port):
+		while isRunning:
+			try:
+				work = legacyRequest(port, { "type": "GET_WORK" })
+				if work["status"] != "OK":
+					time.sleep(0.05)
+					continue
+				legacyRequest(port, { "type": "RESULT", "data": createResult(work["task"]) })
+			except (OSError, ValueError):
+				with countersLock:
+					counters["errors"] += 1
+				time.sleep(0.2)
+				continue
+			with countersLock:
+				counters["workUnits"] += 1
+				counters["results"] += 1
+
+	try:
+		here = os.path.dirname(os.path.abspath(__file__))
+		trainer = subprocess.Popen([sys.executable, os.path.join(here, "Trainer.py"), configFilename, "--port", str(args.port), "--terminate-evaluations", str(args.evaluations)])
+		processes.append(trainer)
+		time.sleep(1)
+		for i in range(0, args.relays):
+			processes.append(subprocess.Popen([sys.executable, os.path.join(here, "Relay.py"), "--upstream", "127.0.0.1:" + str(args.port), "--host", "127.0.0.1", "--port", str(args.port + 1 + i),
+				"--prefetch", str(4*args.batch*args.framed_workers), "--max-leased-per-host", str(8*args.batch*args.framed_workers)]))
+		time.sleep(1)
+
+		threads = []
+		for i in range(0, args.relays):
+			for j in range(0, args.framed_workers):
+				threads.append(threading.Thread(target=framedWorker, args=(args.port + 1 + i,), daemon=True))
+			for j in range(0, args.legacy_workers):
+				threads.append(threading.Thread(target=legacyWorker, args=(args.port + 1 + i,), daemon=True))
+		startTime = time.time()
+		for thread in threads:
+			thread.start()
+
+		try:
+			trainer.wait(timeout=args.timeout)
+		except subprocess.TimeoutExpired:
+			pass
+		deltaTime = time.time() - startTime
+		isRunning = False
+
+		# The trainer saves its state when it terminates
+		with open(configFilename) as file:
+			evaluations = json.load(file)["algorithm"]["arguments"]["population"]["evaluations"]
+	finally:
+		for process in processes:
+			if process.poll() == None:
+				process.terminate()
+		for process in processes:
+			process.wait()
+		shutil.rmtree(directory)
+
+	print("{} relays, {} workers: {:.0f} work units/sec, {:.0f} results/sec sent by workers, {} connection errors".format(
+		args.relays, len(threads), counters["workUnits"]/deltaTime, counters["results"]/deltaTime, counters["errors"]))
+
+	if evaluations < args.evaluations:
+		print("FAILED: trainer did not reach " + str(args.evaluations) + " evaluations within " + str(args.timeout) + " seconds, saved state has " + str(evaluations) + ".")
+		sys.exit(1)
+	print("Trainer reached " + str(evaluations) + " evaluations through the relays.")
+
+if __name__ == "__main__":
+	execute()